@@ -0,0 +1,326 @@
+"""benchmarks.py
+
+Times the data preparation and spatial processing functions on synthetic data, so performance can be
+measured without the SOV workbooks, shapefiles and census files.
+
+Example:
+    python benchmarks.py --precincts 10000 --elections 200 --out ../results/benchmarks.json
+
+Results are saved as JSON (one record per function), with the versions of python, pandas and geopandas
+and the git revision, so runs from different versions can be compared.
+"""
+
+import argparse
+import json
+import math
+import platform
+import os
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import data_prep_functions as dpf
+import validation_functions as vf
+
+
+######## SYNTHETIC DATA ########
+
+def make_precinct_names(n_precincts):
+    """Four-digit precinct names, like the SF ones."""
+    return(['{:04d}'.format(1000+i) for i in range(n_precincts)])
+
+
+def make_sov_sheet(n_precincts, descriptive=True, pct_split=.02, seed=0):
+    """Make a sheet of election results like read_vote_sheet returns for single-index spreadsheets,
+    with a regular and an absentee row for each precinct.
+    Args:
+        n_precincts (int): number of precincts
+        descriptive (bool): index format. See check_if_descriptive
+        pct_split (float): share of rows for combined precincts like 'PCT 1101/1102'
+        seed (int): random seed
+    Returns:
+        DataFrame: registered, voted, yes and no votes, indexed by the precinct labels
+    """
+    rng = np.random.default_rng(seed)
+    names = np.array(make_precinct_names(n_precincts), dtype=object)
+    n_split = int(n_precincts*pct_split)
+    if n_split:
+        names[-n_split:] = [a+'/'+b for a, b in zip(names[-2*n_split:-n_split], names[-n_split:])]
+
+    if descriptive:
+        labels_v = ['PCT '+p+' - Election Day Reporting' for p in names]
+        labels_a = ['PCT '+p+' - Vote By Mail / Absentee Reporting' for p in names]
+    else:
+        labels_v = ['PCT '+p+'   '+str(i % 10) for i, p in enumerate(names)]
+        labels_a = labels_v
+    labels = np.empty(2*n_precincts, dtype=object)
+    labels[0::2] = labels_v
+    labels[1::2] = labels_a
+
+    registered = rng.integers(200, 1500, n_precincts)
+    voted = (registered*rng.uniform(.2, .8, (2, n_precincts))*[[.7], [.3]]).astype(int)
+    yes = (voted*rng.uniform(.2, .8, voted.shape)).astype(int)
+    no = ((voted-yes)*.9).astype(int)
+    df = pd.DataFrame({'REG': np.ravel(np.vstack([registered, np.zeros(n_precincts, dtype=int)]), order='F'),
+                       'VOTED': np.ravel(voted, order='F'),
+                       'YES': np.ravel(yes, order='F'),
+                       'NO': np.ravel(no, order='F')}, index=pd.Index(labels))
+    return(df)
+
+
+def make_vote_df(n_precincts, seed=0):
+    """Make consolidated, formatted election results: one row per precinct, like format_precincts returns."""
+    sheet = make_sov_sheet(n_precincts, seed=seed, pct_split=0)
+    df = dpf.rename_index_and_cols(dpf.format_df_to_multiindex(sheet))
+    df = dpf.consolidate_abs(df)
+    return(dpf.format_precincts(df))
+
+
+def make_vote_data(n_elections, n_precincts, n_vars=20, seed=0):
+    """Make the nested dictionary of merged election and census data, like the input to combine_dataframes.
+    Args:
+        n_elections (int): number of (date, prop) dataframes
+        n_precincts (int): precincts in each dataframe
+        n_vars (int): number of census variables
+        seed (int): random seed
+    Returns:
+        dict: vote_data[date]['props'][letter]['data']
+    """
+    rng = np.random.default_rng(seed)
+    base = make_vote_df(n_precincts, seed=seed).reset_index()
+    base['precname'] = base['prec_id'].map('{:04d}'.format)
+    for i in range(n_vars):
+        base['var{}_wgt'.format(i)] = rng.random(n_precincts)
+    data = {}
+    for i in range(n_elections):
+        # one election a month from 199601, so every date key is different however many there are
+        date_key = '{}{:02d}'.format(1996+i//12, 1+i % 12)
+        prop_key = 'A'
+        df = dpf.make_election_dummies(base.copy(), date_key, prop_key)
+        data[date_key] = {'filename':'SOV.xls', 'props':{prop_key:{'data':df}}}
+    return(data)
+
+
+def write_census_by_precinct(n_precincts, census_key, path, n_vars=20, seed=0):
+    """Write census data by precinct like save_census_data, for the precincts of make_vote_df.
+    Returns:
+        str: the file name
+    """
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(rng.random((n_precincts, n_vars)), columns=['var{}_wgt'.format(i) for i in range(n_vars)],
+                      index=pd.Index(make_precinct_names(n_precincts), name='precname'))
+    df['prop_area'] = 1.
+    df['area_m'] = 1e5
+    filename = os.path.join(path, 'census_by_precinct_{}.csv'.format(census_key))
+    df.to_csv(filename, index=True)
+    return(filename)
+
+
+def make_polygon_grid(n, bounds, crs='epsg:26910'):
+    """Make a grid of about n rectangles covering bounds (xmin, ymin, xmax, ymax). The whole area is covered, so there may be a few more than n."""
+    from geopandas import GeoDataFrame
+    from shapely.geometry import box
+
+    xmin, ymin, xmax, ymax = bounds
+    nx = max(1, int(round(math.sqrt(n))))
+    ny = max(1, int(math.ceil(n/nx)))
+    dx = (xmax-xmin)/nx
+    dy = (ymax-ymin)/ny
+    geoms = [box(xmin+i*dx, ymin+j*dy, xmin+(i+1)*dx, ymin+(j+1)*dy) for j in range(ny) for i in range(nx)]
+    return(GeoDataFrame(geometry=geoms, crs=crs))
+
+
+def make_boundaries(n_precincts, n_bgs, size=12000.):
+    """Make synthetic precinct and block group boundaries that overlap like the real ones do.
+    Args:
+        n_precincts (int): number of precincts
+        n_bgs (int): number of block groups
+        size (float): width of the study area in meters
+    Returns:
+        GeoDataFrame: precincts with precname and area_m
+        GeoDataFrame: block groups with geoid and area_m
+    """
+    bounds = (540000., 4170000., 540000.+size, 4170000.+size)
+    pre_df = make_polygon_grid(n_precincts, bounds)
+    pre_df['precname'] = make_precinct_names(len(pre_df))
+    pre_df['area_m'] = pre_df.geometry.area
+    bg_df = make_polygon_grid(n_bgs, bounds)
+    bg_df['geoid'] = ['06075{:07d}'.format(i) for i in range(len(bg_df))]
+    bg_df['area_m'] = bg_df.geometry.area
+    return(pre_df[['precname','area_m','geometry']], bg_df[['geoid','area_m','geometry']])
+
+
+def make_blocks(bg_df, n_blocks, seed=0):
+    """Make synthetic census blocks, as points spread over the block groups (about 7000 for SF).
+    Returns:
+        GeoDataFrame: bg_geoid, pop and a point for each block
+    """
+    from geopandas import GeoDataFrame
+    from shapely import points
+
+    rng = np.random.default_rng(seed)
+    bg_idx = rng.integers(0, len(bg_df), n_blocks)
+    bounds = bg_df.geometry.bounds.to_numpy()[bg_idx]
+    x = rng.uniform(bounds[:, 0], bounds[:, 2])
+    y = rng.uniform(bounds[:, 1], bounds[:, 3])
+    return(GeoDataFrame({'bg_geoid':bg_df['geoid'].to_numpy()[bg_idx], 'pop':rng.integers(0, 300, n_blocks)},
+                        geometry=points(x, y), crs=bg_df.crs))
+
+
+def make_census(geoids, n_vars=20, seed=0):
+    """Make census data by block group.
+    Returns:
+        DataFrame: geoid and the census variables
+        list: names of the census variables
+    """
+    rng = np.random.default_rng(seed)
+    var_list = ['var{}'.format(i) for i in range(n_vars)]
+    df = pd.DataFrame(rng.random((len(geoids), n_vars)), columns=var_list)
+    df.insert(0, 'geoid', list(geoids))
+    return(df, var_list)
+
+
+######## TIMING ########
+
+def time_call(func, setup, repeat=3):
+    """Time a function. setup() makes fresh arguments for each call (since many of the functions change their input).
+    Returns:
+        list: seconds for each call
+    """
+    times = []
+    for i in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter()-start)
+    return(times)
+
+
+def get_benchmarks(n_precincts, n_elections, spatial=True):
+    """The benchmarks to run, as a list of (name, function, setup).
+    The census data for merge_vote_census is written to a temporary folder, which dpf.census_path is set to.
+    Args:
+        n_precincts (int): number of precincts
+        n_elections (int): number of (date, prop) dataframes for combine_dataframes
+        spatial (bool): whether to include the spatial functions (needs geopandas)
+    """
+    sheet_desc = make_sov_sheet(n_precincts, descriptive=True)
+    sheet_nondesc = make_sov_sheet(n_precincts, descriptive=False)
+    formatted = dpf.rename_index_and_cols(dpf.format_df_to_multiindex(sheet_desc.copy()))
+    av_input = formatted.copy()
+    av_input.index = pd.MultiIndex.from_arrays([formatted.index.get_level_values(0),
+        np.where(formatted.index.get_level_values(1)=='A', 'Vote By Mail', 'Election Day')])
+    consolidated = dpf.consolidate_abs(formatted)
+    vote_data = make_vote_data(n_elections, n_precincts)
+    combined = dpf.combine_dataframes(vote_data)
+
+    # merge_vote_census reads the census data once per session (get_census_data), so the setup loads it
+    # and the join is what's timed
+    date_key = '201411'
+    census_key = dpf.voting2census_key(date_key)
+    dpf.census_path = tempfile.mkdtemp()+'/'
+    write_census_by_precinct(n_precincts, census_key, dpf.census_path)
+    dpf._census_cache.pop(census_key, None)
+    vote_df = make_vote_df(n_precincts)
+
+    def merge_setup():
+        dpf.get_census_data(census_key)
+        return((vote_df.copy(), date_key))
+
+    benchmarks = [
+        ('format_df_to_multiindex[descriptive]', dpf.format_df_to_multiindex, lambda: (sheet_desc.copy(), True)),
+        ('format_df_to_multiindex[non-descriptive]', dpf.format_df_to_multiindex, lambda: (sheet_nondesc.copy(), False)),
+        ('index_to_av_format', dpf.index_to_av_format, lambda: (av_input.copy(),)),
+        ('consolidate_abs', dpf.consolidate_abs, lambda: (formatted.copy(),)),
+        ('split_prec_rows', dpf.split_prec_rows, lambda: (consolidated.copy(),)),
+        ('format_precincts', dpf.format_precincts, lambda: (consolidated.copy(),)),
+        ('merge_vote_census', dpf.merge_vote_census, merge_setup),
+        ('combine_dataframes', dpf.combine_dataframes, lambda: (vote_data,)),
+        ('validate', vf.validate, lambda: (combined,)),
+    ]
+
+    if spatial:
+        import spatial_processing_functions as spf
+
+        pre_df, bg_df = make_boundaries(n_precincts, max(1, n_precincts//2))
+        xwalk = spf.make_crosswalk(spf.merge_precinct_bg(pre_df, bg_df, 'benchmark'))
+        census_df, var_list = make_census(bg_df.geoid)
+        merged = pd.merge(xwalk, census_df, on='geoid')
+        weights = spf.make_weight_matrix(xwalk)
+        blocks = make_blocks(bg_df, 7*n_precincts)
+        benchmarks += [
+            ('merge_precinct_bg', spf.merge_precinct_bg, lambda: (pre_df, bg_df, 'benchmark')),
+            ('merge_precinct_bg[strtree]', spf.merge_precinct_bg, lambda: (pre_df, bg_df, 'benchmark', 'strtree')),
+            ('intersect_areas', spf.intersect_areas, lambda: (pre_df, bg_df)),
+            ('parallel_intersect_areas', spf.parallel_intersect_areas, lambda: ({'benchmark':(pre_df, bg_df)},)),
+            ('block_crosswalk', spf.block_crosswalk, lambda: (pre_df, blocks)),
+            ('calc_variables', spf.calc_variables, lambda: (merged.copy(), var_list)),
+            ('agg_vars_by_prec', spf.agg_vars_by_prec, lambda: (spf.calc_variables(merged.copy(), var_list),)),
+            ('make_weight_matrix', spf.make_weight_matrix, lambda: (xwalk,)),
+            ('interpolate_vars', spf.interpolate_vars, lambda: (weights, census_df, var_list)),
+        ]
+    return(benchmarks)
+
+
+def get_versions():
+    """Versions of the code and the main packages, saved with the results."""
+    versions = {'python':platform.python_version(), 'pandas':pd.__version__, 'numpy':np.__version__}
+    try:
+        import geopandas
+        versions['geopandas'] = geopandas.__version__
+    except ImportError:
+        pass
+    try:
+        versions['git'] = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return(versions)
+
+
+def run_benchmarks(n_precincts=1000, n_elections=30, repeat=3, spatial=True, only=None):
+    """Run the benchmarks.
+    Args:
+        n_precincts (int): number of precincts
+        n_elections (int): number of (date, prop) dataframes
+        repeat (int): number of times to time each function
+        spatial (bool): whether to include the spatial functions
+        only (list): names of benchmarks to run. Defaults to all of them.
+    Returns:
+        dict: versions, parameters and one record per benchmark
+    """
+    results = []
+    for name, func, setup in get_benchmarks(n_precincts, n_elections, spatial=spatial):
+        if only and name.split('[')[0] not in only and name not in only:
+            continue
+        times = time_call(func, setup, repeat=repeat)
+        results.append({'name':name, 'n_precincts':n_precincts, 'n_elections':n_elections,
+                        'repeat':repeat, 'min_s':min(times), 'median_s':float(np.median(times)), 'times_s':times})
+        print('{:45s} {:10.4f} s'.format(name, min(times)))
+    return({'date':datetime.now().isoformat(timespec='seconds'), 'versions':get_versions(),
+            'params':{'n_precincts':n_precincts, 'n_elections':n_elections, 'repeat':repeat}, 'results':results})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the vote and census processing functions on synthetic data.')
+    parser.add_argument('--precincts', type=int, default=1000, help='number of precincts')
+    parser.add_argument('--elections', type=int, default=30, help='number of (date, prop) dataframes')
+    parser.add_argument('--repeat', type=int, default=3, help='times to run each function')
+    parser.add_argument('--no-spatial', action='store_true', help="skip the spatial functions")
+    parser.add_argument('--only', nargs='*', help='names of the benchmarks to run')
+    parser.add_argument('--out', help='file to save the results to, as JSON')
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.precincts, args.elections, repeat=args.repeat, spatial=not args.no_spatial, only=args.only)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=1)
+        print('saved as '+args.out)
+    return(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+"""catalog_functions.py
+
+This module builds a catalog of the SOV workbooks: for each proposition, the sheet it's on and where its data is
+(header row, precinct, registered, ballots cast, YES and NO columns, and where the footer starts). This is what
+define_excel_params and the hand-edited sheet_names do, but it's found by searching the sheets' headers.
+
+The catalog is saved as a small JSON file keyed by the hash of each workbook, so a workbook is only scanned once
+(and again if it changes). The parameters are in the define_excel_params format, so reading uses exactly those cells:
+
+    catalog = cf.build_catalog('../data/SOV_w_nimby/')
+    vote_data = cf.apply_catalog(vote_data, catalog)
+    vote_data = dpf.define_excel_params(vote_data)  # optional: hand-checked parameters still take precedence
+    sheets = dpf.read_all_workbooks(vote_data, '../data/SOV_w_nimby/')
+"""
+
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import data_prep_functions as dpf
+
+
+catalog_file = dpf.cache_dir+'sov_catalog.json'
+"""Saved catalog"""
+
+_YES_RE = re.compile(r'^\s*yes\s*$', flags=re.IGNORECASE)
+_NO_RE = re.compile(r'^\s*no\s*$', flags=re.IGNORECASE)
+_PRECINCT_RE = re.compile(r'^\s*(?:pct\.?\s*)?\d{4}\b', flags=re.IGNORECASE)
+_REGISTERED_RE = re.compile(r'regist', flags=re.IGNORECASE)
+_VOTED_RE = re.compile(r'ballots|cast|voted|turnout', flags=re.IGNORECASE)
+# e.g. 'PROPOSITION K', 'Prop. K', 'Local Measure D'. State propositions have numbers, so they don't match.
+# Only the keyword ignores case, so words like 'Measure of the city' or 'Prop is' don't give letters.
+_TITLE_RE = re.compile(r'\b(?i:prop(?:osition)?|measure)\.?\s*([A-Z]{1,2})\b')
+
+
+def cell_matches(raw, pattern):
+    """Boolean array (rows x columns) of the text cells of a sheet that match a pattern."""
+    text = raw.apply(lambda col: col.map(lambda x: x if isinstance(x, str) else ''))
+    return(np.column_stack([text[c].str.contains(pattern).to_numpy(dtype=bool) for c in text.columns])
+           if len(text.columns) else np.zeros(raw.shape, dtype=bool))
+
+
+def title_letter(text, letters=None):
+    """Letter of a proposition title like 'Prop. K', or None. If letters is given, only those letters count."""
+    m = _TITLE_RE.search(text)
+    if m is None or (letters is not None and m.group(1) not in letters):
+        return(None)
+    return(m.group(1))
+
+
+def find_titles(raw, header_row, letters=None):
+    """Proposition titles in the rows above the header (and the header itself): list of (row, column, letter).
+    If letters is given, titles with other letters are left out."""
+    titles = []
+    for i in range(header_row+1):
+        for j, x in enumerate(raw.iloc[i]):
+            if isinstance(x, str):
+                letter = title_letter(x, letters)
+                if letter is not None:
+                    titles.append((i, j, letter))
+    return(titles)
+
+
+def match_title(titles, yes_col):
+    """Letter of the title closest above and to the left of a YES column, or None."""
+    candidates = [t for t in titles if t[1]<=yes_col]
+    if not candidates:
+        return(None)
+    return(max(candidates, key=lambda t: (t[1], t[0]))[2])
+
+
+def find_column(matches, row, start):
+    """First column from start that matches in the header row (or the two rows above it), or None."""
+    for i in [row, row-1, row-2]:
+        if i<0:
+            continue
+        cols = np.flatnonzero(matches[i, start:])
+        if len(cols):
+            return(int(cols[0])+start)
+    return(None)
+
+
+def detect_layout(raw, sheet_name='', letters=None):
+    """Find where the data is on a sheet, read with header=None (see scan_workbook).
+    Args:
+        raw (DataFrame): all the cells of the sheet
+        sheet_name (str): name of the sheet, used for the title if there's only one proposition on it
+        letters (list): letters of the election's propositions (from the proposals table). If given, titles
+            with other letters are ignored.
+    Returns:
+        dict: header_row, precinct_col, type_col (None if there isn't one), registered_col, voted_col,
+            first_row and last_row of the precincts, skip_footer, and 'props': a list of
+            {'letter', 'yes_col', 'no_col'} (letter is None if no title was found). None if the sheet has no YES/NO columns.
+    """
+    if raw.shape[0]<2 or raw.shape[1]<2:
+        return(None)
+    is_yes = cell_matches(raw, _YES_RE)
+    is_no = cell_matches(raw, _NO_RE)
+    pair = is_yes[:, :-1] & is_no[:, 1:]
+    rows = np.flatnonzero(pair.any(axis=1))
+    if len(rows)==0:
+        return(None)
+    header_row = int(rows[0])
+    yes_cols = [int(j) for j in np.flatnonzero(pair[header_row])]
+
+    # precinct labels: the column with the most of them below the header
+    is_prec = cell_matches(raw.iloc[header_row+1:], _PRECINCT_RE)
+    counts = is_prec.sum(axis=0)
+    if counts.max()==0:
+        return(None)
+    precinct_col = int(np.argmax(counts))
+    prec_rows = np.flatnonzero(is_prec[:, precinct_col])+header_row+1
+    first_row, last_row = int(prec_rows[0]), int(prec_rows[-1])
+
+    # a second index column with the ballot type (e.g. 'Election Day', 'Absentee') that isn't a number
+    type_col = None
+    registered = cell_matches(raw, _REGISTERED_RE)
+    voted = cell_matches(raw, _VOTED_RE)
+    nxt = precinct_col+1
+    if nxt<min(yes_cols) and not (registered[header_row, nxt] or voted[header_row, nxt]):
+        values = raw.iloc[first_row:last_row+1, nxt].dropna()
+        if len(values) and np.mean([isinstance(v, str) and not v.strip().replace('.', '').isdigit() for v in values])>.5:
+            type_col = nxt
+
+    start = (type_col if type_col is not None else precinct_col)+1
+    registered_col = find_column(registered[:, :min(yes_cols)], header_row, start)
+    if registered_col is None:
+        registered_col = start
+    voted_col = find_column(voted[:, :min(yes_cols)], header_row, registered_col+1)
+    if voted_col is None:
+        voted_col = registered_col+1
+
+    titles = find_titles(raw, header_row, letters)
+    props = [{'letter':match_title(titles, j), 'yes_col':j, 'no_col':j+1} for j in yes_cols]
+    if len(props)==1 and props[0]['letter'] is None:
+        props[0]['letter'] = title_letter(sheet_name, letters)
+
+    return({'header_row':header_row, 'precinct_col':precinct_col, 'type_col':type_col, 'registered_col':registered_col,
+            'voted_col':voted_col, 'first_row':first_row, 'last_row':last_row, 'skip_footer':int(raw.shape[0]-1-last_row),
+            'props':props})
+
+
+def layout_params(layout, prop):
+    """Parameters for reading one proposition (the define_excel_params format) from a sheet layout."""
+    index_cols = [layout['precinct_col']]+([layout['type_col']] if layout['type_col'] is not None else [])
+    cols = index_cols+[layout['registered_col'], layout['voted_col'], prop['yes_col'], prop['no_col']]
+    parse_cols = sorted(cols)
+    # index_col is the position within the columns that are read
+    index_col = [parse_cols.index(c) for c in index_cols]
+    return({'index_col':index_col if len(index_col)>1 else index_col[0], 'skiprows':layout['header_row'],
+            'parse_cols':parse_cols, 'skip_footer':layout['skip_footer']})
+
+
+def scan_workbook(filename, letters=None):
+    """Find the propositions in a workbook and how to read each of them.
+    Args:
+        filename (str): path to the workbook
+        letters (list): letters of the election's propositions, see detect_layout
+    Returns:
+        dict: 'filename', 'letters', 'sheets' ({sheet name: layout}, see detect_layout), 'props' ({letter: {'s_name', 'params'}})
+            and 'unlabeled' (list of {'s_name', 'params'} for YES/NO columns without a title)
+    """
+    letters = sorted(letters) if letters is not None else None
+    entry = {'filename':os.path.basename(filename), 'letters':letters, 'sheets':{}, 'props':{}, 'unlabeled':[]}
+    found = {}
+    with dpf.open_workbook_file(filename) as xl:
+        for sheet in xl.sheet_names:
+            raw = xl.parse(sheet, header=None)
+            layout = detect_layout(raw, str(sheet), letters)
+            if layout is None:
+                continue
+            entry['sheets'][sheet] = layout
+            n_rows = layout['last_row']-layout['first_row']
+            for prop in layout['props']:
+                item = {'s_name':sheet, 'params':layout_params(layout, prop)}
+                if prop['letter'] is None:
+                    entry['unlabeled'].append(item)
+                # if a proposition is on more than one sheet, use the one with the most precinct rows
+                elif prop['letter'] not in found or n_rows>found[prop['letter']]:
+                    entry['props'][prop['letter']] = item
+                    found[prop['letter']] = n_rows
+    return(entry)
+
+
+def load_catalog(filename=None):
+    """Load the saved catalog: {file hash: entry from scan_workbook}. Empty if there isn't one."""
+    filename = catalog_file if filename is None else filename
+    if not os.path.exists(filename):
+        return({})
+    with open(filename) as f:
+        return(json.load(f))
+
+
+def save_catalog(catalog, filename=None):
+    """Save the catalog as JSON."""
+    filename = catalog_file if filename is None else filename
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename+'.tmp', 'w') as f:
+        json.dump(catalog, f, indent=1, default=int)
+    os.replace(filename+'.tmp', filename)
+    return()
+
+
+def build_catalog(path, filenames=None, n_workers=None, rescan=False, letters=None):
+    """Scan the SOV workbooks that aren't in the saved catalog yet (or have changed, or were scanned for other
+    letters), and save it.
+    Args:
+        path (str): path to the excel files
+        filenames (list): workbooks to include. Defaults to all the .xls and .xlsx files in path
+        n_workers (int): number of processes to scan workbooks in parallel. If None, one after another.
+        rescan (bool): scan every workbook again
+        letters (dict): {filename: letters of its election's propositions, from the proposals table}. Titles with
+            other letters are ignored (see detect_layout). If None, or a workbook isn't in it, any letter counts.
+    Returns:
+        dict: {file hash: entry}, for these workbooks
+    """
+    if filenames is None:
+        filenames = sorted(f for f in os.listdir(path) if f.lower().endswith(('.xls','.xlsx')))
+    saved = {} if rescan else load_catalog()
+    letters = dict((f, sorted(letters[f]) if letters is not None and f in letters else None) for f in filenames)
+    hashes = dict((f, dpf.hash_file(path+f)) for f in filenames)
+    to_scan = [f for f in filenames if hashes[f] not in saved or saved[hashes[f]].get('letters')!=letters[f]]
+
+    if n_workers is None:
+        entries = [scan_workbook(path+f, letters[f]) for f in to_scan]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            entries = list(pool.map(scan_workbook, [path+f for f in to_scan], [letters[f] for f in to_scan]))
+    for f, entry in zip(to_scan, entries):
+        print('{}: {} propositions on {} sheets'.format(f, len(entry['props']), len(entry['sheets'])))
+        saved[hashes[f]] = entry
+    if to_scan:
+        save_catalog(saved)
+    return(dict((hashes[f], saved[hashes[f]]) for f in filenames))
+
+
+def apply_catalog(vote_df, catalog):
+    """Fill in each proposition's sheet name and parameters from the catalog.
+    Propositions that are missing from their workbook's entry are left as they are, and printed
+    (they need parameters from define_excel_params). If an election has one proposition and its workbook has
+    one set of YES/NO columns without a title, that's used.
+    Args:
+        vote_df (dict): dictionary of vote data, with 'filename' and the proposition letters in 'props'
+        catalog (dict): from build_catalog
+    Returns:
+        dict: vote_df, changed in place
+    """
+    by_filename = dict((entry['filename'], entry) for entry in catalog.values())
+    for d in vote_df.keys():
+        entry = by_filename.get(vote_df[d]['filename'])
+        if entry is None:
+            print('{}: {} is not in the catalog'.format(d, vote_df[d]['filename']))
+            continue
+        letters = list(vote_df[d]['props'].keys())
+        sheets = []
+        for p in letters:
+            item = entry['props'].get(p)
+            if item is None and len(letters)==1 and len(entry['unlabeled'])==1:
+                item = entry['unlabeled'][0]
+            if item is None:
+                print('{} {}: not found in {}'.format(d, p, entry['filename']))
+                continue
+            # a new dictionary, since the notebook makes the props with dict.fromkeys (all sharing one)
+            old = vote_df[d]['props'][p] or {}
+            new = dict((k, old[k]) for k in old.keys() if k!='data')
+            new.update(s_name=item['s_name'], params=dict(item['params']))
+            vote_df[d]['props'][p] = new
+            if item['s_name'] not in sheets:
+                sheets.append(item['s_name'])
+        vote_df[d]['sheet_names'] = sheets
+    return(vote_df)
@@ -0,0 +1,177 @@
+"""census_api_functions.py
+
+This module gets block group data from the census API (this was the get_census_data notebook).
+
+Requests for each tract are sent concurrently on one session (so connections are reused), and retried
+with backoff when they fail. Responses are saved on disk, keyed by the URL without the API key,
+so re-running only requests what's missing.
+"""
+
+import hashlib
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+
+base_url = 'http://api.census.gov/data/'
+"""Census API URL. Can be changed, e.g. to test against a local server."""
+
+cache_path = os.environ.get('VOTE_CACHE_DIR', os.environ.get('VOTE_RESULTS_ROOT', '../results/')+'cache/')+'census_api/'
+"""Path to saved API responses"""
+
+retry_status = (429, 500, 502, 503, 504)
+"""HTTP status codes that are retried"""
+
+
+def get_var_dict(vars_df, column):
+    """Get the variable names and codes for a year/dataset from the variable codes spreadsheet.
+    Args:
+        vars_df (DataFrame): variable_codes.xlsx
+        column (str): column with the codes, e.g. '2000_sf1', 'acs5', '2012_acs5'
+    Returns:
+        dict: {name: code}
+    """
+    df = vars_df[pd.notnull(vars_df[column])]
+    return(dict(zip(df['name'], df[column])))
+
+
+def make_var_string(var_dict):
+    """Comma-separated list of variable codes for the request."""
+    return(','.join(var_dict.values()))
+
+
+def make_url(year, dataset, var_string, tract, bg='*', state='06', county='075', key=None, base=None):
+    """Make the request URL for the block groups in one tract.
+    Args:
+        year (str): year
+        dataset (str): dataset, e.g. 'sf1' or 'acs5'. Names like '2012_acs5' are requested as 'acs5'.
+        var_string (str): variable codes, from make_var_string
+        tract (str): tract code
+        bg (str): block group, '*' for all of them
+        state, county (str): FIPS codes
+        key (str): API key
+        base (str): API URL. Defaults to base_url
+    Returns:
+        str: URL
+    """
+    if base is None:
+        base = base_url
+    dataset = dataset.split('_')[-1]
+    geog = 'state:{}+county:{}+tract:{}'.format(state, county, tract)
+    url = '{base}{yr}/{ds}?get={v}&for=block+group:{b}&in={geo}'.format(base=base, yr=year, ds=dataset, v=var_string, b=bg, geo=geog)
+    if key:
+        url = url+'&key={}'.format(key)
+    return(url)
+
+
+def strip_key(url):
+    """Take the API key out of a URL."""
+    return(re.sub(r'([?&])key=[^&]*&?', r'\1', url).rstrip('&?'))
+
+
+def cache_filename(url):
+    """Name of the file with the saved response for a URL (the API key isn't part of it)."""
+    return(cache_path+hashlib.sha1(strip_key(url).encode()).hexdigest()+'.json')
+
+
+def make_session(n_workers=8):
+    """Make a requests session with enough pooled connections for the workers."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=n_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return(session)
+
+
+def fetch_json(session, url, retries=5, backoff=.5, timeout=30):
+    """Get a URL and return the JSON response. Retries connection errors and some status codes,
+    waiting backoff, 2*backoff, 4*backoff, ... seconds in between.
+    Returns None if there's no data (the API answers 204 or an empty body for geographies without any).
+    """
+    for attempt in range(retries+1):
+        try:
+            r = session.get(url, timeout=timeout)
+            if r.status_code not in retry_status:
+                r.raise_for_status()
+                if r.status_code==204 or not r.content.strip():
+                    return(None)
+                return(r.json())
+            err = requests.HTTPError('{} for url: {}'.format(r.status_code, strip_key(url)), response=r)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            err = e
+        if attempt<retries:
+            time.sleep(backoff*2**attempt)
+    raise err
+
+
+def fetch_url(session, url, use_cache=True, **kwargs):
+    """Get the JSON response for a URL, from the saved responses if it's there. None if there's no data."""
+    filename = cache_filename(url)
+    if use_cache and os.path.exists(filename):
+        with open(filename) as f:
+            return(json.load(f))
+    results = fetch_json(session, url, **kwargs)
+    if use_cache:
+        os.makedirs(cache_path, exist_ok=True)
+        with open(filename+'.tmp', 'w') as f:
+            json.dump(results, f)
+        os.replace(filename+'.tmp', filename)
+    return(results)
+
+
+def get_block_group_data(year, dataset, var_dict, tracts, key=None, n_workers=8, use_cache=True, base=None, **kwargs):
+    """Get data for all block groups in a list of tracts.
+    Args:
+        year (str): year
+        dataset (str): dataset, e.g. 'sf1' or 'acs5'
+        var_dict (dict): {name: code} of variables to get
+        tracts (list): tract codes
+        key (str): API key
+        n_workers (int): maximum number of requests at the same time
+        use_cache (bool): whether to use the saved responses
+        base (str): API URL. Defaults to base_url
+        kwargs: retries, backoff and timeout for fetch_json
+    Returns:
+        DataFrame: one row per block group, with the variables named as in var_dict. Tracts without data have no rows.
+    """
+    var_string = make_var_string(var_dict)
+    urls = [make_url(year, dataset, var_string, tract, key=key, base=base) for tract in tracts]
+    with make_session(n_workers) as session:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            results = list(pool.map(lambda url: fetch_url(session, url, use_cache=use_cache, **kwargs), urls))
+
+    # first row of each response has the column labels
+    frames = [pd.DataFrame(r[1:], columns=r[0]) for r in results if r]
+    if not frames:
+        return(pd.DataFrame(columns=list(var_dict.keys())))
+    data = pd.concat(frames, ignore_index=True)
+    # match variable names to labels so they are easier to read.
+    rev_vars = dict((v, k) for k, v in var_dict.items())
+    data.columns = [rev_vars.get(col, col) for col in data.columns]
+    return(data)
+
+
+def get_all_data(my_vars, tracts_by_year, years, key=None, **kwargs):
+    """Get data for each year and dataset.
+    Args:
+        my_vars (dict): {year: {dataset: {name: code}}}
+        tracts_by_year (dict): {year: list of tracts}
+        years (list): years to get
+        key (str): API key
+        kwargs: passed to get_block_group_data
+    Returns:
+        dict: {year: {dataset: DataFrame}}
+    """
+    full_data = {}
+    for yr in years:
+        full_data[yr] = {}
+        for ds in my_vars[yr].keys():
+            print(yr, ds)
+            full_data[yr][ds] = get_block_group_data(yr, ds, my_vars[yr][ds], tracts_by_year[yr], key=key, **kwargs)
+    return(full_data)
@@ -6,38 +6,200 @@ This module includes functions needed for data preparation
 import pandas as pd
 import numpy as np
 import re
+import os
+import glob
+import json
+import pickle
+import shutil
+import hashlib
+import functools
+import itertools
 from datetime import date
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
+import instrument_functions as inst
 
-results_path='../results/'
-"""Path to results"""
+
+results_path = os.environ.get('VOTE_RESULTS_ROOT', '../results/')
+"""Path to results. Can be set with the VOTE_RESULTS_ROOT environment variable (see run_pipeline.set_paths)."""
+
+cache_dir = os.environ.get('VOTE_CACHE_DIR', results_path+'cache/')
+"""Path to the caches (parsed sheets, pipeline stages, election store, SOV catalog, census API responses).
+Can be set with the VOTE_CACHE_DIR environment variable."""
+
+sheet_cache_path = cache_dir+'sheets/'
+"""Path to cache of parsed excel sheets"""
+
+sheet_cache_max_bytes = 500*2**20
+"""Size limit of the sheet cache. Least recently used sheets are removed after a write puts it over."""
+
+census_path = results_path+'data_by_precinct/'
+"""Path to census data by precinct"""
+
+census_cache_max_bytes = 200*2**20
+"""Memory limit of the in-process census data cache"""
 
 def find_matching_sheets(wb, to_match, to_not_match):
     """Searches for the right worksheet and return their names as a list.
     Args: 
-        wb: Name of excel workbook with election results
+        wb: excel workbook with election results: an xlrd workbook, or a pd.ExcelFile from open_workbook_file 
+            (which only reads the sheet names, not the sheets)
         to_match (str): phrase to match
         to_not_match (str): phrase to exlude
     """
 
+    if isinstance(wb, pd.ExcelFile):
+        names = wb.sheet_names
+    else:
+        names = [s.name for s in wb.sheets()]
     sheets =[]
-    for s in wb.sheets():
-        s_match = re.search(to_match,s.name, flags=re.IGNORECASE)
-        not_match = re.search(to_not_match,s.name, flags=re.IGNORECASE)
+    for name in names:
+        s_match = re.search(to_match,name, flags=re.IGNORECASE)
+        not_match = re.search(to_not_match,name, flags=re.IGNORECASE)
         if s_match:
             if not not_match:
                 sheets.append(s_match.string)
     return(sheets)
 
 
+def hash_file(filename):
+    """Hash the contents of a file.
+    Args: 
+        filename (str): path to file
+    Returns: 
+        str: hex digest
+    """
+    h = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1<<20), b''):
+            h.update(chunk)
+    return(h.hexdigest())
+
+
+def sheet_cache_key(filename, sheet, params, file_hash=None):
+    """Cache key for a parsed sheet: hash of the workbook's contents, the sheet name and the read parameters.
+    Args: 
+        filename (str): path to workbook
+        sheet (str): sheet name
+        params (dict): parameters from define_excel_params
+        file_hash (str): hash_file(filename), if it's already known
+    Returns: 
+        str: hex digest
+    """
+    if file_hash is None:
+        file_hash = hash_file(filename)
+    h = hashlib.sha1()
+    h.update(file_hash.encode())
+    h.update(json.dumps([sheet, params], sort_keys=True, default=str).encode())
+    return(h.hexdigest())
+
+
+def read_sheet_cache(cache_file):
+    """Read a cached sheet. Returns None if it isn't there."""
+    if os.path.exists(cache_file+'.parquet'):
+        import pyarrow.parquet as pq
+        table = pq.read_table(cache_file+'.parquet')
+        df = table.to_pandas()
+        # column labels can be anything in excel, so they're kept as is in the metadata
+        df.columns = pickle.loads(table.schema.metadata[b'sheet_columns'])
+        cache_file = cache_file+'.parquet'
+    elif os.path.exists(cache_file+'.pkl'):
+        df = pd.read_pickle(cache_file+'.pkl')
+        cache_file = cache_file+'.pkl'
+    else:
+        return(None)
+    # mark as recently used
+    os.utime(cache_file)
+    return(df)
+
+
+def write_sheet_cache(df, cache_file):
+    """Write a parsed sheet to the cache as parquet. Sheets with mixed-type columns, which parquet can't store, are pickled."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    df_str = df.copy()
+    df_str.columns = [str(i) for i in range(len(df.columns))]
+    try:
+        table = pa.Table.from_pandas(df_str)
+        table = table.replace_schema_metadata(dict(table.schema.metadata, sheet_columns=pickle.dumps(list(df.columns))))
+        pq.write_table(table, cache_file+'.parquet.tmp')
+        os.replace(cache_file+'.parquet.tmp', cache_file+'.parquet')
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        df.to_pickle(cache_file+'.pkl')
+    return()
+
+
+def evict_sheet_cache(max_bytes=None):
+    """Remove least recently used sheets from the cache until it is under max_bytes. 
+    Args: 
+        max_bytes (int): size limit. Defaults to sheet_cache_max_bytes
+    """
+    if max_bytes is None:
+        max_bytes = sheet_cache_max_bytes
+    files = [f for f in glob.glob(sheet_cache_path+'*') if f.endswith(('.parquet','.pkl'))]
+    files = sorted(files, key=lambda f: os.stat(f).st_mtime)
+    total = sum(os.path.getsize(f) for f in files)
+    for f in files:
+        if total<=max_bytes:
+            break
+        total -= os.path.getsize(f)
+        os.remove(f)
+    return()
+
+
+def clear_sheet_cache():
+    """Remove all cached sheets."""
+    for f in glob.glob(sheet_cache_path+'*'):
+        os.remove(f)
+    return()
+
+
+def sheet_cache_file(elect_date, prop_letter, filename, sheet, params, file_hash=None):
+    """Name of a proposition's cached sheet, and the prefix shared by all its versions."""
+    prefix = sheet_cache_path+'{}{}_'.format(elect_date, prop_letter)
+    return(prefix, prefix+sheet_cache_key(filename, sheet, params, file_hash)[:16])
+
+
+def replace_sheet_cache(df, prefix, cache_file):
+    """Write a parsed sheet to the cache, removing entries from older versions of the workbook or parameters."""
+    for old in glob.glob(glob.escape(prefix)+'*'):
+        os.remove(old)
+    write_sheet_cache(df, cache_file)
+    return()
+
+
+def open_workbook_file(filename):
+    """Open a workbook to read several sheets from it. .xls files are opened on demand, so only the sheets 
+    that are read get loaded; .xlsx files are read in read-only (streaming) mode. 
+    Returns: 
+        pd.ExcelFile: use as a context manager, or close() it
+    """
+    if filename.lower().endswith('.xls'):
+        return(pd.ExcelFile(filename, engine_kwargs={'on_demand':True}))
+    return(pd.ExcelFile(filename))
+
+
+def read_excel_sheet(filename, sheet, params):
+    """Read a sheet with the parameters from define_excel_params. filename can also be an open pd.ExcelFile. """
+    df=pd.read_excel(filename,sheet_name=sheet,index_col=params['index_col'], skiprows=params['skiprows'], usecols=params['parse_cols'],skipfooter=params['skip_footer'])
+    return(df)
+
+
 # reads a given sheet to a dataframe
 
-def read_vote_sheet(elect_date,prop_letter,vote_df,path):
+def read_vote_sheet(elect_date,prop_letter,vote_df,path,use_cache=True):
     """Read a given sheet to dataframe
+    Parsed sheets are cached in sheet_cache_path, keyed by the workbook's contents and the parameters, 
+    so on later runs excel isn't read at all. If the workbook or its parameters change, the old entry is replaced. 
     Args: 
         elect_date (str): election date string
         prop_letter (str): proposal letter
         vote_df (dict): dictionary of vote data 
+        path (str): path to the excel files
+        use_cache (bool): whether to use the cache
     Return: 
         DataFrame: containing the data. 
     """
@@ -45,10 +207,121 @@ def read_vote_sheet(elect_date,prop_letter,vote_df,path):
     f=vote_df[elect_date]['filename']
     s=vote_df[elect_date]['props'][prop_letter]['s_name']
     params=vote_df[elect_date]['props'][prop_letter]['params']
-    df=pd.read_excel(path+f,sheetname=s,index_col=params['index_col'], skiprows=params['skiprows'], parse_cols=params['parse_cols'],skip_footer=params['skip_footer'])
+    if not use_cache:
+        return(read_excel_sheet(path+f, s, params))
+
+    prefix, cache_file = sheet_cache_file(elect_date, prop_letter, path+f, s, params)
+    df = read_sheet_cache(cache_file)
+    if df is None:
+        df = read_excel_sheet(path+f, s, params)
+        replace_sheet_cache(df, prefix, cache_file)
+        evict_sheet_cache()
     return(df)
 
 
+def read_workbook(elect_date, vote_df, path, use_cache=True, evict=True):
+    """Read the sheets for all the propositions of an election, opening its workbook only once 
+    (and not at all if they're all in the sheet cache). Propositions with the same sheet and parameters are only parsed once. 
+    Args: 
+        elect_date (str): election date string
+        vote_df (dict): dictionary of vote data, with 'filename' and each proposition's 's_name' and 'params'
+        path (str): path to the excel files
+        use_cache (bool): whether to use the sheet cache (see read_vote_sheet)
+        evict (bool): whether to trim the sheet cache afterwards
+    Returns: 
+        dict: {prop_letter: DataFrame}, like read_vote_sheet returns
+    """
+    filename = path+vote_df[elect_date]['filename']
+    props = vote_df[elect_date]['props']
+    file_hash = hash_file(filename) if use_cache else None
+    frames = {}
+    to_read = []
+    for p in props.keys():
+        s = props[p]['s_name']
+        params = props[p]['params']
+        if use_cache:
+            prefix, cache_file = sheet_cache_file(elect_date, p, filename, s, params, file_hash)
+            frames[p] = read_sheet_cache(cache_file)
+            if frames[p] is not None:
+                continue
+            to_read.append((p, s, params, prefix, cache_file))
+        else:
+            to_read.append((p, s, params, None, None))
+
+    if to_read:
+        parsed = {}
+        with open_workbook_file(filename) as xl:
+            for p, s, params, prefix, cache_file in to_read:
+                key = json.dumps([s, params], sort_keys=True, default=str)
+                if key in parsed:
+                    frames[p] = parsed[key].copy()
+                else:
+                    frames[p] = parsed[key] = read_excel_sheet(xl, s, params)
+                if use_cache:
+                    replace_sheet_cache(frames[p], prefix, cache_file)
+        if use_cache and evict:
+            evict_sheet_cache()
+    return(dict((p, frames[p]) for p in props.keys()))
+
+
+def _read_workbook_task(elect_date, election, path, use_cache):
+    """Read one election's workbook in a worker process (see read_all_workbooks)."""
+    return(read_workbook(elect_date, {elect_date:election}, path, use_cache=use_cache, evict=False))
+
+
+def read_all_workbooks(vote_df, path, n_workers=None, use_cache=True, errors=None):
+    """Read the sheets for every election, with the workbooks read in parallel on a process pool. 
+    Args: 
+        vote_df (dict): dictionary of vote data, with 'filename' and each proposition's 's_name' and 'params'
+        path (str): path to the excel files
+        n_workers (int): number of processes. If None, read them one after another.
+        use_cache (bool): whether to use the sheet cache
+        errors (dict): if given, elections that can't be read are added as {date: exception}, 
+            otherwise the error is raised
+    Returns: 
+        dict: {date: {prop_letter: DataFrame}}
+    """
+    dates = [d for d in vote_df.keys() if len(vote_df[d]['props'])>0]
+    # just what's needed from each election, so it can be sent to the workers
+    elections = dict((d, {'filename':vote_df[d]['filename'], 
+                          'props':dict((p, {'s_name':vote_df[d]['props'][p]['s_name'], 'params':vote_df[d]['props'][p]['params']}) 
+                                       for p in vote_df[d]['props'].keys())}) for d in dates)
+    if n_workers is None:
+        results = []
+        for d in dates:
+            try:
+                results.append((_read_workbook_task(d, elections[d], path, use_cache), None))
+            except Exception as err:
+                results.append((None, err))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = [pool.submit(_read_workbook_task, d, elections[d], path, use_cache) for d in dates]
+            results = [(None, f.exception()) if f.exception() else (f.result(), None) for f in futures]
+
+    sheets = {}
+    for d, (frames, err) in zip(dates, results):
+        if err is not None:
+            if errors is None:
+                raise err
+            print('error reading {}: {!r}'.format(d, err))
+            errors[d] = err
+        else:
+            sheets[d] = frames
+    if use_cache:
+        evict_sheet_cache()
+    return(sheets)
+
+
+def format_vote_sheet(data, elect_date):
+    """Put a sheet from read_vote_sheet or read_workbook in the (precinct, type) multiindex format, with the standard column names."""
+    if isinstance(data.index, pd.MultiIndex):
+        data = rename_index_and_cols(data)
+    else:
+        data = format_df_to_multiindex(data, descriptive_labels=check_if_descriptive(elect_date))
+        data = rename_index_and_cols(data)
+    return(data)
+
+
 # When the spreadsheet only has a single index, we need to make it a multiindex.
 def check_if_descriptive(elect_date):
     """Check for the format of the index.
@@ -75,6 +348,16 @@ def check_if_descriptive(elect_date):
         return(False)
 
 
+# compiled patterns for parsing the precinct labels in the index
+_ABSENTEE_RE = re.compile('mail|absent|vbm', flags=re.IGNORECASE)
+_PCT_RE = re.compile('pct', flags=re.IGNORECASE)
+_DASH_MAIL_RE = re.compile('-mail', flags=re.IGNORECASE)
+# everything before the first ' - ' or '   '. Same as re.split(' - |   ',s)[0]
+_PREC_NAME_RE = re.compile(r'^(.*?)(?: - |   |\Z)', flags=re.DOTALL)
+# everything before the first '-'. Same as re.split('-',s)[0]
+_PREC_NAME_DASH_RE = re.compile(r'^(.*?)(?:-|\Z)', flags=re.DOTALL)
+
+
 def get_ballot_type(s): 
     """Find ballot type for descriptive type index
     Args: 
@@ -83,7 +366,7 @@ def get_ballot_type(s):
         Str: ballot type "A" or "V"
     """
 
-    if re.search('mail|absent|vbm',s,flags=re.IGNORECASE):    
+    if _ABSENTEE_RE.search(s):    
         ballot_type='A'
     # if s is not a mail-in ballot
     else:
@@ -100,46 +383,89 @@ def get_prec_name(s):
     Returns: 
         Str: precinct name
     """ 
-    if re.search('pct',s, flags=re.IGNORECASE):
+    if _PCT_RE.search(s):
         split = re.split(' - |   ',s)
         pct = split[0]
-        if re.search('-mail',s, flags=re.IGNORECASE):  # just a few have this pattern
+        if _DASH_MAIL_RE.search(s):  # just a few have this pattern
             split = re.split('-',s)
             pct=split[0]
     else: 
         pct = 'Not a precinct'
     return(pct)
 
+
+def label_strings(labels):
+    """Index labels as a series of strings, for the vectorized parsing functions. 
+    Like get_ballot_type and get_prec_name, raises TypeError if a label isn't a string (e.g. NaN). 
+    """
+    labels = pd.Series(labels, dtype=object)
+    if len(labels) and pd.api.types.infer_dtype(labels, skipna=False)!='string':
+        bad = labels[~labels.map(lambda x: isinstance(x, str))].iloc[0]
+        raise TypeError('index labels should be strings, not {!r}'.format(bad))
+    return(labels)
+
+
+def get_ballot_types(labels):
+    """Vectorized version of get_ballot_type. 
+    Args: 
+        labels (array-like): index strings. 
+    Returns: 
+        ndarray: ballot type "A" or "V" for each label
+    """
+    labels = label_strings(labels)
+    is_abs = labels.str.contains(_ABSENTEE_RE).to_numpy(dtype=bool)
+    return(np.where(is_abs, 'A', 'V').astype(object))
+
+
+def get_prec_names(labels):
+    """Vectorized version of get_prec_name. Gives the same precinct names, but parses the whole index at once.
+    Args: 
+        labels (array-like): index strings. 
+    Returns: 
+        ndarray: precinct name for each label
+    """
+    labels = label_strings(labels)
+    is_pct = labels.str.contains(_PCT_RE).to_numpy(dtype=bool)
+    has_dash_mail = labels.str.contains(_DASH_MAIL_RE).to_numpy(dtype=bool)
+
+    pct = labels.str.extract(_PREC_NAME_RE, expand=False).to_numpy(dtype=object)
+    # just a few have the '-mail' pattern, only split on the dash for those
+    if has_dash_mail.any():
+        pct_dash = labels.str.extract(_PREC_NAME_DASH_RE, expand=False).to_numpy(dtype=object)
+        pct = np.where(has_dash_mail, pct_dash, pct)
+    pct = np.where(is_pct, pct, 'Not a precinct').astype(object)
+    return(pct)
+
+
 def format_df_to_multiindex(df, descriptive_labels=True):
     """Turn single index into multiindex. 
+    The index is parsed in one pass with pandas string methods (see get_ballot_types and get_prec_names), 
+    and the (precinct, type) multiindex is built directly from the parsed arrays. 
     Args: 
         df: dataframe with election results
         descriptive_labels (bool): Determined by function check_if_descriptive
     """
-    ballot_types=[]
-    precinct=[]
-    for i, val in enumerate(df.index):
-        # determin ballot type
-        ballot_type = None
-        if descriptive_labels==True:
-            # determine ballot type. 
-            # if s contains something about mail or absentee or vbm:
-            ballot_type=get_ballot_type(val)
-
-        if descriptive_labels==False:
-            if (df.iloc[i,0]==0)|np.isnan(df.iloc[i,0]):
-                ballot_type='A'
-            elif df.iloc[i,0]>0:
-                ballot_type='V'
-        
-        # just return precinct name
-        pct = get_prec_name(val)
-                
-        ballot_types.append(ballot_type)
-        precinct.append(pct)
-    df['type']=ballot_types
-    df['precinct']=precinct
-    df.set_index(['precinct','type'],inplace=True)
+    n = len(df)
+    if descriptive_labels==True:
+        # determine ballot type. 
+        # if the label contains something about mail or absentee or vbm:
+        ballot_types = get_ballot_types(df.index)
+    else:
+        # clues are in the 'registered' column, which is the first column. 
+        registered = df.iloc[:,0]
+        if not (pd.api.types.is_numeric_dtype(registered) or 
+                pd.api.types.infer_dtype(registered, skipna=False) in ['integer','floating','mixed-integer-float','empty']):
+            raise TypeError('the first column should be the number of registered voters, not {}'.format(
+                pd.api.types.infer_dtype(registered, skipna=False)))
+        registered = pd.to_numeric(registered).to_numpy(dtype=float, na_value=np.nan)
+        ballot_types = np.full(n, None, dtype=object)
+        ballot_types[registered>0] = 'V'
+        ballot_types[(registered==0)|np.isnan(registered)] = 'A'
+
+    # just return precinct name
+    precinct = get_prec_names(df.index)
+
+    df.index = pd.MultiIndex.from_arrays([precinct, ballot_types], names=['precinct','type'])
     return(df)
 
 # Example use:
@@ -156,19 +482,9 @@ def check_if_av_format(df):
 
 def index_to_av_format(df):
     """Fix index levels, if index levels isn't already named with 'A' and 'V'. """
-    ballot_types=[]
-    precincts=[]
-    for i, val in enumerate(df.index):
-        match = re.search('mail|absent|vbm',val[1], flags=re.IGNORECASE)
-        if match:
-            ballot_type='A'
-        else:
-            ballot_type='V'
-        ballot_types.append(ballot_type)
-        precincts.append(val[0])
-    df['type']=ballot_types
-    df['precinct']=precincts
-    df.set_index(['precinct','type'],inplace=True)
+    precincts = df.index.get_level_values(0).to_numpy(dtype=object)
+    ballot_types = get_ballot_types(df.index.get_level_values(1))
+    df.index = pd.MultiIndex.from_arrays([precincts, ballot_types], names=['precinct','type'])
     return(df)
 
 def rename_index_and_cols(df):
@@ -210,33 +526,149 @@ def verify_vote_totals(vote_dict, fname):
     return
 
  
-def process_votedata(data, process_func, use_datekey=False, use_propkey=False, **kwargs):
+def copy_votedata(data):
+    """Copy the nested dictionary of election data, without copying the dataframes. 
+    Args: 
+        data (dict): dictionary of dataframes that holds the election data. 
+    Returns: 
+        dict: new dictionary, with new dictionaries for each date and proposition
+    """
+    if not isinstance(data, dict):
+        # e.g. an ElectionStore, which copies its own records
+        return(data.copy())
+    data_new = {}
+    for d in data.keys():
+        data_new[d] = dict(data[d])
+        data_new[d]['props'] = dict((p, dict(data[d]['props'][p])) for p in data[d]['props'].keys())
+    return(data_new)
+
+
+def _apply_process_func(process_func, df, date_key, prop_key, use_datekey, use_propkey, kwargs, measure=None):
+    """Apply the process function to one dataframe. Used by process_votedata, needs to be at module level so it can be pickled.
+    If measure is given (whether to trace memory), returns the result and its instrumentation record. 
+    """
+    if use_datekey==True:
+        kwargs = dict(kwargs, date_key=date_key)
+    if use_propkey==True:
+        kwargs = dict(kwargs, prop_key=prop_key)
+    if measure is None:
+        return(process_func(df, **kwargs))
+    return(inst.measure_call(process_func, (df,), kwargs, labels={'date_key':date_key, 'prop_key':prop_key}, trace_memory=measure))
+
+ 
+def _captured_call(func, *args):
+    """Call a function, capturing the instrumentation records it makes (see inst.capture). Used by run_tasks.
+    Returns:
+        result of the function (None if it failed)
+        list: the records
+        exception: None if the call worked
+    """
+    with inst.capture() as records:
+        try:
+            return(func(*args), records, None)
+        except Exception as err:
+            return(None, records, err)
+
+
+def run_tasks(func, tasks, n_workers=None, executor='process'):
+    """Call a function for each task, one after another or on a pool of processes or threads. 
+    A task that raises an exception doesn't stop the others. Used by process_votedata and run_vote_pipeline. 
+    On a pool, tasks are taken from the iterable only as workers free up (at most 2*n_workers are waiting or running), 
+    so a generator of tasks only makes the arguments of those, and each result is yielded as soon as it's done. 
+    Args: 
+        func (function): called as func(*args). Needs to be at module level for processes. 
+        tasks (iterable): (key, args) for each task
+        n_workers (int): number of workers. If None, run serially. 
+        executor (str): 'process' or 'thread'
+    Yields: 
+        tuple: (key, result, exception), in the order the tasks finish (the order of the tasks if serial). 
+            The exception is None if the call worked. 
+    """
+    # while instrument() is on, the records made in the tasks come back with the results and are emitted here
+    capture = inst.is_enabled()
+    call = functools.partial(_captured_call, func) if capture else func
+
+    def finish(key, result, err):
+        if capture and err is None:
+            result, records, err = result
+            for record in records:
+                inst.emit(record)
+        return(key, result, err)
+
+    if n_workers is None:
+        for key, args in tasks:
+            try:
+                result = call(*args)
+            except Exception as err:
+                yield(finish(key, None, err))
+            else:
+                yield(finish(key, result, None))
+        return
+    if executor=='process':
+        pool = ProcessPoolExecutor(max_workers=n_workers)
+    elif executor=='thread':
+        pool = ThreadPoolExecutor(max_workers=n_workers)
+    else:
+        raise ValueError("executor should be 'process' or 'thread', not {}".format(executor))
+    tasks = iter(tasks)
+    with pool:
+        pending = {}
+        for key, args in itertools.islice(tasks, 2*n_workers):
+            pending[pool.submit(call, *args)] = key
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = pending.pop(future)
+                # keep the workers busy while the caller handles this result
+                for key_next, args in itertools.islice(tasks, 1):
+                    pending[pool.submit(call, *args)] = key_next
+                err = future.exception()
+                yield(finish(key, None if err else future.result(), err))
+
+ 
+def process_votedata(data, process_func, use_datekey=False, use_propkey=False, n_workers=None, executor='process', errors=None, **kwargs):
     """Consolidate the absentee and regular votes for each proposition's data. This is a wrapper function that loops through the dictionary of dataframes and applies a function to each one. 
     To be used for all this data processing. 
+    Returns a new dictionary; the input dictionary and its dataframes are not changed. Each (date, prop) is independent, 
+    so with n_workers they are processed on a pool of processes or threads, and each result goes into the new dictionary as it's done 
+    (only the dataframes of the running tasks are copied at a time). Either way the new dictionary has the same order as the input. 
+    If the function fails for a (date, prop), the error is printed and that proposition is left out of the new dictionary, 
+    instead of stopping the whole run. 
+    While instrument_functions.instrument() is on, each call is recorded (time, memory, rows) with its date and prop keys. 
     Args: 
         data (dict): dictionary of dataframes that holds the election data. 
         process_func (function): the names of the function to apply to each dataframe
         use_datekey (bool): Specifies whether the process function needs a date key
         use_propkey (bool): Specifies whether the process function needs a proposition key
+        n_workers (int): number of workers. If None, run serially. 
+        executor (str): 'process' or 'thread'. Use 'thread' for functions that can't be pickled (e.g., defined in a notebook). 
+        errors (dict): if given, failed (date, prop) items are added to it as {(date, prop): exception}
+    Returns: 
+        dict: new dictionary of dataframes
     """
-    data_new = data # make a copy. I think this is necessary because otherwise it keeps overwriting when I don't want it to. 
-    for d in data_new.keys():
-        for p in data_new[d]['props'].keys():
-            #print('working on ',d,p)
-            df=data_new[d]['props'][p]['data']
-            # do some function on df
-            if use_datekey==True:
-                if use_propkey==True:
-                    df_new=process_func(df, date_key=d, prop_key=p, **kwargs)
-                else:
-                    df_new = process_func(df, date_key=d, **kwargs)
-                
-            elif use_datekey==False:
-                if use_propkey==True:
-                    df_new=process_func(df, prop_key=p, **kwargs)
-                else:
-                    df_new = process_func(df, **kwargs)
-            
+    data_new = copy_votedata(data)
+    items = [(d, p) for d in data_new.keys() for p in data_new[d]['props'].keys()]
+
+    measure = inst.trace_memory_enabled() if inst.is_enabled() else None
+
+    def task_args(d, p):
+        df = data[d]['props'][p]['data']
+        if n_workers is None or executor=='thread':
+            # copy so the function can't change the input dataframe (a process gets its own copy)
+            df = df.copy()
+        return(process_func, df, d, p, use_datekey, use_propkey, kwargs, measure)
+
+    tasks = (((d, p), task_args(d, p)) for d, p in items)
+    for (d, p), df_new, err in run_tasks(_apply_process_func, tasks, n_workers=n_workers, executor=executor):
+        if err is not None:
+            print('error for {} {}: {!r}'.format(d, p, err))
+            if errors is not None:
+                errors[(d, p)] = err
+            del data_new[d]['props'][p]
+        else:
+            if measure is not None:
+                df_new, record = df_new
+                inst.emit(record)
             #new dictionary copy with new dataframe
             data_new[d]['props'][p]['data'] = df_new
     return(data_new)
@@ -244,31 +676,34 @@ def process_votedata(data, process_func, use_datekey=False, use_propkey=False, *
 def consolidate_abs(df):
     """Consolidate any lines that have absentee votes on a separate line. 
     It's needed because a couple of the spreadsheets don't use multiindex, are in a different format.
+    The totals are calculated with a single groupby over the 'precinct' level, so numeric dtypes are kept. 
+    Args: 
+        df (DataFrame): election results with columns 'registered', 'voted', 'YES', 'NO'
+    Returns: 
+        DataFrame: one row per precinct with columns 'voted', 'YES', 'NO', 'registered'
     """
     
-    if isinstance(df.index, pd.core.index.MultiIndex):
-        
-        # for each proposition's dataframe, make a new df to hold totals
-        new_df = pd.DataFrame(index=df.index.levels[0], columns=['voted','YES','NO'])
-        for prec in df.index.levels[0]:
-            # calculate totals
-            totals = df.loc[prec].sum(axis=0)  
-            # FIXED: some of the dataframes have number of registered voters in both the regular and absentee
-            # rows. So for those the 'registered' column will be 2x the correct amount. 
-            new_df.ix[prec] = totals
-        
-        # recover registered column - create df with only the pct index and registered column
-
-        df=df.sort_index()
-        regist_temp = df.loc[(slice(None),['V']),:'registered']
-        regist_temp.index = regist_temp.index.droplevel(1)
-        
-        # merge this back with the new dataframe I just created. 
-        new_df = pd.merge(new_df, regist_temp, left_index=True, right_index=True)
+    if isinstance(df.index, pd.MultiIndex):
+        vote_cols = ['voted','YES','NO']
+        # FIXED: some of the dataframes have number of registered voters in both the regular and absentee
+        # rows. So for those the 'registered' column would be 2x the correct amount. Only take it from the 'V' rows.
+        is_v = np.asarray(df.index.get_level_values(1)=='V')
+        keyed = df[vote_cols].copy()
+        keyed['registered'] = df['registered'].where(is_v)
+        keyed['has_v'] = is_v
+
+        grouped = keyed.groupby(level=0, sort=True)
+        new_df = grouped[vote_cols].sum()
+        new_df['registered'] = grouped['registered'].first()
+        # precincts without a 'V' row have no registered count, leave them out. 
+        new_df = new_df[grouped['has_v'].any()]
+        if new_df['registered'].notnull().all():
+            new_df['registered'] = new_df['registered'].astype(df['registered'].dtype)
+        new_df.index.name = df.index.names[0]
         
-    elif isinstance(df.index, pd.core.index.Index):
-        # maybe do some other processing
-        new_df=df
+    else:
+        # single index: already one row per precinct, nothing to consolidate. 
+        new_df = df
 
     return(new_df)
 
@@ -310,47 +745,163 @@ def make_vote_variables(df,date_key,prop_key, df_prop):
     return(df)
  
 
-def split_prec_rows(df):
+_SPLIT_PREC_RE = re.compile(r'\d{4}/\d{4}')
+
+def _split_rows(df, labels, starts, n_parts, split_col='split_n'):
+    """Give each row one row per new label, copying its values. Used by split_prec_rows and format_precincts. 
+    Rows that aren't split keep their place; rows from a split go at the end, like appending them would. 
+    A split precinct that already has a row (its own, or from an earlier split) gets the values of the last 
+    split it's in, in the place of that row, like setting df.loc[precinct] for each split would. 
+    Args: 
+        df (DataFrame): election results
+        labels (Index): new labels, row i's are labels[starts[i]:starts[i]+n_parts[i]]
+        starts (array): position of each row's first label in labels
+        n_parts (array): number of labels of each row (0 to drop the row, >1 if it's split)
+        split_col (str): name of column for the number of labels of each row's original row. If None, no column is added. 
+    Returns: 
+        DataFrame: data with one row per label, indexed like labels
+    """
+    is_split = n_parts>1
+    order = np.argsort(is_split, kind='stable')
+    positions = order.repeat(n_parts[order])
+    # position of each new row among its original row's labels
+    offsets = np.arange(len(positions)) - np.repeat(np.cumsum(n_parts[order])-n_parts[order], n_parts[order])
+    new_labels = labels[starts[positions]+offsets]
+
+    # a label from a split keeps its first place, with the values of its last row
+    in_split = new_labels.isin(new_labels[is_split[positions]])
+    keep = ~(in_split & new_labels.duplicated(keep='first'))
+    codes = pd.factorize(new_labels)[0]
+    last = np.zeros(codes.max()+1 if len(codes) else 0, dtype=np.int64)
+    np.maximum.at(last, codes, np.arange(len(codes)))
+    source = positions[np.where(in_split, last[codes], np.arange(len(codes)))[keep]]
+
+    df_new = df.iloc[source].copy()
+    df_new.index = new_labels[keep]
+    if split_col is not None:
+        df_new[split_col] = n_parts[source]
+    return(df_new)
+
+
+def split_prec_rows(df, split_col='split_n'):
     """Split precincts into two rows. 
     NOTE: Because this creates a copy of the row values, don't rely on total vote counts, just look at percentage. 
+    The split is done in one pass: the index is split on '/' and the frame is reindexed once (see _split_rows). 
+    Rows from a split are added after the rows that were not split. 
+    Args: 
+        df (DataFrame): election results, indexed by precinct name
+        split_col (str): name of column recording how many precincts each row's original row was split into 
+            (1 if it wasn't split). Rows with split_col>1 have duplicated vote counts, so they can be excluded 
+            or down-weighted by 1/split_col later. If None, no column is added. 
+    Returns: 
+        DataFrame: data with one row per precinct
     """
-    for idx in df.index:
-        # look for rows with precincts that need to be split
-        if re.search('\d{4}/\d{4}',idx):
-            row_values = df.loc[idx]
-            split = idx.split('/')
-            for p in split: 
-                df.loc[p] = row_values
-    
-            # delete original row
-            df = df.drop(idx, axis=0)
-    return(df)
+    labels = label_strings(df.index)
+    # look for rows with precincts that need to be split
+    is_split = labels.str.contains(_SPLIT_PREC_RE).to_numpy(dtype=bool)
+    parts = [label.split('/') if split else (label,) for label, split in zip(labels, is_split)]
+    n_parts = np.fromiter(map(len, parts), dtype=np.int64, count=len(parts))
+    starts = np.cumsum(n_parts)-n_parts
+    new_labels = pd.Index(list(itertools.chain.from_iterable(parts)), name=df.index.name)
+    return(_split_rows(df, new_labels, starts, n_parts, split_col))
 
 
 # what to do with precincts marked "mail"? I think these are ones that are not physical places. 
-# I'll just strip off the mail part and if it doesn't match up with a physical prec during merge, then it'll be omitted.
+# They're flagged with mail_only, and if one doesn't match up with a physical prec during merge, then it'll be omitted.
 
-# further formatting of precincts. Gets rid of ones marked "mail"
-def format_precincts(df):
-    # df: dataframe with election results
-   
-    df.index = df.index.str.strip('MAIL').str.strip('mail').str.strip()
-    # strip unneeded characters
-    df.index = df.index.str.strip('PCT').str.strip('Pct').str.strip()
-    # split double precint rows
-    df_new = split_prec_rows(df)
-    
-    #print(df_new.head())
-    return(df_new)
+_PREC_KEY_RE = re.compile(r'^(?:pct\.?\s*)?(?P<mail1>mail\s*-?\s*)?(?:pct\.?\s*)?(?P<ids>\d+(?:\s*/\s*\d+)*)(?P<mail2>\s*-?\s*mail)?$', re.I)
+
+@functools.lru_cache(maxsize=None)
+def parse_precinct_label(label):
+    """Parse a precinct label like 'PCT 1101', '1101/1102' or 'PCT 9101 MAIL' into integer precinct IDs. 
+    Results are memoized, so labels that repeat across elections are only parsed once. 
+    Args: 
+        label (str): precinct label
+    Returns: 
+        tuple: integer precinct IDs (more than one for split rows, empty if the label isn't a precinct)
+        bool: whether the precinct is marked mail (mail-only)
+    """
+    m = _PREC_KEY_RE.match(str(label).strip())
+    if m is None:
+        return((), False)
+    ids = tuple(int(x) for x in m.group('ids').split('/'))
+    mail = m.group('mail1') is not None or m.group('mail2') is not None
+    return(ids, mail)
+
+def parse_precinct_labels(labels):
+    """Parse an array of precinct labels. Each distinct label is parsed once (see parse_precinct_label).
+    Args: 
+        labels: precinct labels (index, series or list)
+    Returns: 
+        array: code of each label's distinct value (-1 for missing labels)
+        array: integer IDs of all the distinct labels, one after the other
+        array: position of each distinct label's first ID in that array
+        array: number of IDs of each distinct label (0 if it isn't a precinct, >1 if it's split)
+        array: whether each distinct label is marked mail
+    """
+    codes, uniques = pd.factorize(pd.Index(labels, dtype=object))
+    parsed = [parse_precinct_label(u) for u in uniques]
+    n_ids = np.array([len(p[0]) for p in parsed]+[0], dtype=np.int64)  # last one is for code -1
+    starts = np.concatenate([[0], np.cumsum(n_ids)[:-1]])
+    flat_ids = np.fromiter((i for p in parsed for i in p[0]), dtype=np.int64, count=n_ids.sum())
+    mail = np.array([p[1] for p in parsed]+[False], dtype=bool)
+    return(codes, flat_ids, starts, n_ids, mail)
+
+def precinct_ids(labels):
+    """Integer precinct ID for each label (e.g. precname in the census data), -1 if it isn't a single precinct."""
+    codes, flat_ids, starts, n_ids, mail = parse_precinct_labels(labels)
+    single = n_ids[codes]==1
+    ids = np.full(len(codes), -1, dtype=np.int64)
+    ids[single] = flat_ids[starts[codes[single]]]
+    return(ids)
+
+# further formatting of precincts. Labels are parsed into integer precinct IDs, which are used for the census join.
+def format_precincts(df, split_col='split_n'):
+    """Index election results by integer precinct ID ('prec_id'). Rows that aren't a precinct are dropped, 
+    and precincts marked mail get mail_only=True. 
+    Rows for two precincts like '1101/1102' are split by _split_rows, like split_prec_rows does. 
+    Raises TypeError if a label isn't a string (see label_strings). 
+    Args: 
+        df (DataFrame): election results, indexed by precinct label
+        split_col (str): name of column recording how many precincts each row was split into (see split_prec_rows)
+    Returns: 
+        DataFrame: data with one row per precinct, indexed by prec_id
+    """
+    codes, flat_ids, starts, n_ids, mail = parse_precinct_labels(label_strings(df.index))
+    # each row's IDs are those of its distinct label
+    df = df.assign(mail_only=mail[codes])
+    return(_split_rows(df, pd.Index(flat_ids, name='prec_id'), starts[codes], n_ids[codes], split_col))
    
 ###### FUNCTIONS TO MERGE WITH CENSUS DATA ###### 
 
+_census_cache = OrderedDict()
+
 # load census data
 def get_census_data(yr_key):
-    # yr_key: the 6-digit election year-month key
-    censuspath = '../results/data_by_precinct/'
-    filename = 'census_by_precinct_{}.csv'.format(yr_key)
-    df = pd.read_csv(censuspath+filename, dtype={'precname':str})
+    """Load census data by precinct. Each table is only read once per session: it's kept in a cache that 
+    drops the least recently used tables when it's over census_cache_max_bytes. 
+    Census variables are read as floats, and the table is indexed on the integer precinct ID ('prec_id'), 
+    with 'precname' kept as a column. The same DataFrame is returned each time, so don't modify it. 
+    Args: 
+        yr_key (str): census/precinct key, e.g. 'ce2000pre1992' (see voting2census_key)
+    Returns: 
+        DataFrame: census data, indexed by prec_id
+    """
+    if yr_key in _census_cache:
+        _census_cache.move_to_end(yr_key)
+        return(_census_cache[yr_key])
+
+    filename = census_path+'census_by_precinct_{}.csv'.format(yr_key)
+    cols = pd.read_csv(filename, nrows=0).columns
+    dtypes = dict((c, str if c=='precname' else float) for c in cols)
+    df = pd.read_csv(filename, dtype=dtypes)
+    df.index = pd.Index(precinct_ids(df['precname']), name='prec_id')
+
+    _census_cache[yr_key] = df
+    total = sum(d.memory_usage(deep=True).sum() for d in _census_cache.values())
+    while total>census_cache_max_bytes and len(_census_cache)>1:
+        k, old = _census_cache.popitem(last=False)
+        total -= old.memory_usage(deep=True).sum()
     return(df)
 
 # This function matches election with appropriate year for census dataset and precinct boundaries. 
@@ -373,16 +924,22 @@ def voting2census_key(vote_key):
 
 # This merges voting data with census data
 def merge_vote_census(vote_df, date_key):
-    
+    # vote_df has to be indexed by prec_id already (format_precincts comes before this)
+    if vote_df.index.dtype.kind not in 'iu':
+        raise ValueError('{}: vote data should be indexed by the integer prec_id (see format_precincts), not {}'.format(
+            date_key, vote_df.index.dtype))
     census_key = voting2census_key(date_key)
     census_df = get_census_data(census_key)
     #print(census_df.head())
     #print(vote_df.head())
-    merged_df = pd.merge(vote_df, census_df, left_index=True, right_on='precname', how='inner')
+    # join on the integer precinct IDs; precname comes from the census data
+    merged_df = vote_df.join(census_df, how='inner')
+    merged_df.index.name = 'prec_id'
+    merged_df = merged_df.reset_index()
     # check how it turned out. 
-    print('\n for election ', date_key)
-    print('length vote data: ', len(vote_df), 'length census data: ', len(census_df))
-    print('length new data: ', len(merged_df))
+    inst.report('merge_vote_census', 
+        '\n for election  {}\nlength vote data:  {} length census data:  {}\nlength new data:  {}'.format(date_key, len(vote_df), len(census_df), len(merged_df)),
+        date_key=date_key, census_key=census_key, vote_rows=len(vote_df), census_rows=len(census_df), merged_rows=len(merged_df))
     return(merged_df)
 
 ##### FUNCTIONS TO MAKE SOME VARIABLES NEEDED FOR THE ANALYSIS ####### 
@@ -451,22 +1008,178 @@ def adjust_inflation(df, date_key):
     
     return(df)
     
+_YEAR_DUMMY_RE = re.compile(r'^yr_\d{4}$')
+_BOOL_COLS = ['pres_elec','nov_elec']
+
+def get_combined_columns(data):
+    """Get the unified list of columns for all the dataframes, in the order they first appear. 
+    Args: 
+        data (dict): the dictionary of dataframes that each hold election results combined with census data
+    Returns: 
+        list: column names
+        list: year dummy column names (e.g., 'yr_1996'), sorted
+    """
+    columns = {}
+    for d in data.keys():
+        for p in data[d]['props'].keys():
+            columns.update(dict.fromkeys(data[d]['props'][p]['data'].columns))
+    columns = list(columns)
+    yr_cols = sorted([c for c in columns if _YEAR_DUMMY_RE.match(str(c))])
+    return(columns, yr_cols)
+
+
+def conform_to_columns(df, columns, yr_cols):
+    """Conform a dataframe to the unified column schema. Missing year dummies and election flags (and NaN in them) 
+    are False, other missing columns are NaN. 
+    Args: 
+        df (DataFrame): election results combined with census data
+        columns (list): unified column names, from get_combined_columns
+        yr_cols (list): year dummy column names
+    Returns: 
+        DataFrame: data with exactly the given columns
+    """
+    missing_yrs = [c for c in yr_cols if c not in df.columns]
+    if missing_yrs:
+        df = df.assign(**dict.fromkeys(missing_yrs, False))
+    df = df.reindex(columns=columns)
+    bool_cols = [c for c in yr_cols+_BOOL_COLS if c in columns]
+    # NaN would be True with astype(bool)
+    df[bool_cols] = df[bool_cols].fillna(False).astype(bool)
+    return(df)
+
+
 # function puts all the dataframes together.
 def combine_dataframes(data):
-    # data: the dictionary of dataframes that each hold election results combined with census data
-    n=0
+    """Put all the dataframes together. The frames are collected and concatenated once, with a unified set of columns. 
+    Year dummies that are missing for an election are False, so the 'yr_*', 'pres_elec' and 'nov_elec' columns are boolean. 
+    Args: 
+        data (dict): the dictionary of dataframes that each hold election results combined with census data
+    Returns: 
+        DataFrame: all the data
+    """
+    columns, yr_cols = get_combined_columns(data)
+    frames = []
     for d in data.keys():
         for p in data[d]['props'].keys():
-            print('working on ',d,p)
             df=data[d]['props'][p]['data']
-            print(len(df))
-            if n==0:
-                df_new = df
-            elif n>=1:
-                df_new = pd.concat([df,df_old],axis=0)
-            df_old = df_new
-            n+=1
-    return(df_old)
+            inst.report('combine_dataframes', 'working on  {} {}\n{}'.format(d, p, len(df)), date_key=d, prop_key=p, rows=len(df))
+            frames.append(conform_to_columns(df, columns, yr_cols))
+    df_new = pd.concat(frames, axis=0)
+    return(df_new)
+
+
+def _arrow_schema(data, columns, yr_cols):
+    """Make a pyarrow schema that fits every dataframe. 
+    Columns that are numeric in every frame (and present in all of them) keep integer types, 
+    mixed or partly missing numeric columns become float64, and anything else is stored as strings. 
+    """
+    import pyarrow as pa
+
+    kinds = dict((c, set()) for c in columns)
+    for d in data.keys():
+        for p in data[d]['props'].keys():
+            df = data[d]['props'][p]['data']
+            for c in columns:
+                kinds[c].add(df[c].dtype.kind if c in df.columns else None)
+    fields = []
+    for c in columns:
+        k = kinds[c]
+        if c in yr_cols or c in _BOOL_COLS or k=={'b'}:
+            t = pa.bool_()
+        elif k<=set('iu'):
+            t = pa.int64()
+        elif k<=set('iufb')|{None}:
+            t = pa.float64()
+        else:
+            t = pa.string()
+        fields.append(pa.field(str(c), t))
+    return(pa.schema(fields))
+
+
+def write_combined_dataframes(data, filename):
+    """Streaming version of combine_dataframes. Writes each (date, prop) dataframe to a parquet file as it goes, 
+    so the full panel never has to be held in memory. Each dataframe is written as one row group. 
+    The columns are the same as for combine_dataframes (requires pyarrow). 
+    Args: 
+        data (dict): the dictionary of dataframes that each hold election results combined with census data
+        filename (str): name of parquet file to write, in results_path
+    Returns: 
+        int: number of rows written
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    columns, yr_cols = get_combined_columns(data)
+    schema = _arrow_schema(data, columns, yr_cols)
+    n_rows = 0
+    with pq.ParquetWriter(results_path+filename, schema) as writer:
+        for d in data.keys():
+            for p in data[d]['props'].keys():
+                df = conform_to_columns(data[d]['props'][p]['data'], columns, yr_cols)
+                inst.report('write_combined_dataframes', 'writing  {} {}'.format(d, p), date_key=d, prop_key=p, rows=len(df))
+                df.columns = [str(c) for c in df.columns]
+                # store strings as strings, without turning missing values into 'nan'
+                for f in schema:
+                    if f.type==pa.string():
+                        df[f.name] = df[f.name].map(lambda x: None if pd.isnull(x) else str(x)).astype(object)
+                table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+                writer.write_table(table)
+                n_rows += len(df)
+    return(n_rows)
+
+category_cols = ['precname','yr_prop','year']
+"""Repeated string columns of the combined data, stored as categoricals by compact_dataframe"""
+
+
+def make_year_dummies(df):
+    """Make the year dummy variables ('yr_1996', 'yr_1997', ...) from the 'year' column. 
+    Args: 
+        df (DataFrame): data with a 'year' column
+    Returns: 
+        DataFrame: boolean year dummies, with the same index as df
+    """
+    year = df['year'].astype('category')
+    return(pd.get_dummies(year, prefix='yr', dtype=bool))
+
+
+def compact_dataframe(df, rtol=1e-6, keep_year_dummies=False):
+    """Reduce the memory used by the combined data. 
+    The repeated strings (category_cols) become categoricals, 'pres_elec' and 'nov_elec' become booleans, 
+    float columns become float32 if that keeps them within rtol, and integer columns get the smallest integer type. 
+    Year dummies are dropped, since they can be made from 'year' with make_year_dummies. 
+    Args: 
+        df (DataFrame): combined data, from combine_dataframes
+        rtol (float): relative precision float32 columns need to keep
+        keep_year_dummies (bool): whether to keep the 'yr_*' columns (as booleans)
+    Returns: 
+        DataFrame: the compacted data
+    """
+    before = df.memory_usage(deep=True).sum()
+    df = df.copy()
+    yr_cols = [c for c in df.columns if _YEAR_DUMMY_RE.match(str(c))]
+    if yr_cols and 'year' in df.columns and not keep_year_dummies:
+        df = df.drop(yr_cols, axis=1)
+    else:
+        df[yr_cols] = df[yr_cols].fillna(False).astype(bool)
+
+    for col in df.columns:
+        values = df[col]
+        if col in category_cols:
+            df[col] = values.astype(str).astype('category')
+        elif col in _BOOL_COLS:
+            df[col] = values.fillna(False).astype(bool)
+        elif values.dtype.kind=='f' and values.dtype.itemsize>4:
+            as32 = values.astype(np.float32)
+            if np.allclose(as32.to_numpy(dtype=float), values.to_numpy(), rtol=rtol, atol=0, equal_nan=True):
+                df[col] = as32
+        elif values.dtype.kind in 'iu':
+            df[col] = pd.to_numeric(values, downcast='integer' if values.dtype.kind=='i' else 'unsigned')
+
+    after = df.memory_usage(deep=True).sum()
+    inst.report('compact_dataframe', 'memory before: {:.1f} MB, after: {:.1f} MB'.format(before/2**20, after/2**20), 
+        before_bytes=int(before), after_bytes=int(after), rows=len(df))
+    return(df)
+
 
 def rename_columns(df):
     """ rename columns to get rid of "_wgt"
@@ -508,13 +1221,99 @@ def filter_for_dates(df, prec_key):
     return(new_df)  
 
 
+prec_key_ranges = {'pre1992':(None, 200211), 'pre2002':(200211, 201210), 'pre2012':(201210, None)}
+"""Elections (yr_mo) each set of precinct boundaries is used for, as (after, up to and including). Same as filter_for_dates."""
+
+
+def get_prec_keys(yr_mo):
+    """Find the precinct boundary key for each election. 
+    Args: 
+        yr_mo (array-like): election year and month, as integers, e.g. 200211
+    Returns: 
+        ndarray: precinct keys, e.g. 'pre1992'
+    """
+    yr_mo = np.asarray(yr_mo)
+    keys = np.full(len(yr_mo), None, dtype=object)
+    for prec_key, (low, high) in prec_key_ranges.items():
+        mask = np.ones(len(yr_mo), dtype=bool)
+        if low is not None:
+            mask &= yr_mo>low
+        if high is not None:
+            mask &= yr_mo<=high
+        keys[mask] = prec_key
+    return(keys)
+
+
+def write_partitioned(df, path):
+    """Save all vote data as a parquet dataset, partitioned by precinct boundaries ('prec_key') and election ('yr_mo'),
+    e.g. path/prec_key=pre1992/yr_mo=199611/. Use read_partitioned to read only the parts that are needed. 
+    Any existing data in path is replaced, including partitions that aren't in df (e.g. an election that was dropped): 
+    the dataset is written next to it and then moved into place. 
+    Args: 
+        df (DataFrame): all voting data. If there's no 'yr_mo' column, it's made from 'yr_prop'. 
+        path (str): directory to write to
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    df = df.reset_index(drop=True)
+    if 'yr_mo' not in df.columns:
+        df['yr_mo'] = df['yr_prop'].astype(str).str[:-1].astype(int)
+    df['prec_key'] = get_prec_keys(df['yr_mo'].to_numpy())
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    path = path.rstrip('/')
+    tmp = path+'.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    ds.write_dataset(table, tmp, format='parquet', partitioning=['prec_key','yr_mo'], partitioning_flavor='hive')
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+    return()
+
+
+def read_partitioned(path, prec_key=None, start=None, end=None, columns=None):
+    """Read vote data saved by write_partitioned. The filters are applied to the partitions, so only the 
+    files (and columns) that are needed are read. 
+    Args: 
+        path (str): directory of the dataset
+        prec_key (str or list): precinct boundary key(s), e.g. 'pre1992'
+        start (int): first election to read, as yr_mo (e.g. 200011)
+        end (int): last election to read, as yr_mo
+        columns (list): columns to read. Defaults to all of them. 
+    Returns: 
+        DataFrame: the data
+    """
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    filt = None
+    conditions = []
+    if prec_key is not None:
+        keys = [prec_key] if isinstance(prec_key, str) else list(prec_key)
+        conditions.append(ds.field('prec_key').isin(keys))
+    if start is not None:
+        conditions.append(ds.field('yr_mo')>=int(start))
+    if end is not None:
+        conditions.append(ds.field('yr_mo')<=int(end))
+    for c in conditions:
+        filt = c if filt is None else filt & c
+    table = dataset.to_table(columns=columns, filter=filt)
+    return(table.to_pandas())
+
+
+hand_sheet_match = ('prop|meas', 'state|st')
+"""to_match and to_not_match of find_matching_sheets for the sheets of define_excel_params that weren't picked by hand"""
+
 def define_excel_params(vd):
     """ The excel files are all in slightly different formats! Need this huge annoying list of custom parameters. 
+    Where the sheet was picked by hand in the notebook, its name is set too (s_name), since the parameters 
+    are column positions on that sheet. The others were checked on the one sheet that find_matching_sheets 
+    finds with hand_sheet_match (see run_pipeline.apply_hand_params). 
     vd (dict): Dictionary of data frames with vote data. 
     """ 
     
     d ='200011'
     l='K'
+    vd[d]['props'][l]['s_name']='Prop K-O'
     vd[d]['props'][l]['params']={'index_col':[0,1]}
     vd[d]['props'][l]['params']['skiprows']=1
     vd[d]['props'][l]['params']['parse_cols']=[0,1,2,3,5,6]
@@ -522,6 +1321,7 @@ def define_excel_params(vd):
 
     d ='200011'
     l='L'
+    vd[d]['props'][l]['s_name']='Prop K-O'
     vd[d]['props'][l]['params']={'index_col':[0,1]}
     vd[d]['props'][l]['params']['skiprows']=1
     vd[d]['props'][l]['params']['parse_cols']=[0,1,2,3,8,9]
@@ -529,6 +1329,7 @@ def define_excel_params(vd):
 
     d ='200111'
     l='D'
+    vd[d]['props'][l]['s_name']='AMENDMENTS'
     vd[d]['props'][l]['params']={'index_col':[0,1]}
     vd[d]['props'][l]['params']['skiprows']=1
     vd[d]['props'][l]['params']['parse_cols']=[0,1,2,3,7,8]
@@ -536,6 +1337,7 @@ def define_excel_params(vd):
 
     d ='199911'
     l='J'
+    vd[d]['props'][l]['s_name']='I to K'
     vd[d]['props'][l]['params']={'index_col':[0,1]}
     vd[d]['props'][l]['params']['skiprows']=4
     vd[d]['props'][l]['params']['parse_cols']=[0,1,2,3,9,10]
@@ -543,6 +1345,7 @@ def define_excel_params(vd):
 
     d ='199911'
     l='H'
+    vd[d]['props'][l]['s_name']='E to H'
     vd[d]['props'][l]['params']={'index_col':[0,1]}
     vd[d]['props'][l]['params']['skiprows']=4
     vd[d]['props'][l]['params']['parse_cols']=[0,1,2,3,15,16]
@@ -550,6 +1353,7 @@ def define_excel_params(vd):
 
     d ='199911'
     l='I'
+    vd[d]['props'][l]['s_name']='I to K'
     vd[d]['props'][l]['params']={'index_col':[0,1]}
     vd[d]['props'][l]['params']['skiprows']=4
     vd[d]['props'][l]['params']['parse_cols']=[0,1,2,3,6,7]
@@ -578,6 +1382,7 @@ def define_excel_params(vd):
 
     d ='199711'
     l='H'
+    vd[d]['props'][l]['s_name']='E - F'
     vd[d]['props'][l]['params']={'index_col':0}
     vd[d]['props'][l]['params']['skiprows']=3
     vd[d]['props'][l]['params']['parse_cols']=[0,1,2,14,15]
@@ -592,6 +1397,7 @@ def define_excel_params(vd):
 
     d ='201511'
     l='I'
+    vd[d]['props'][l]['s_name']='205 - Local Measure I'
     vd[d]['props'][l]['params']={'index_col':[0,1]}
     vd[d]['props'][l]['params']['skiprows']=3
     vd[d]['props'][l]['params']['parse_cols']=[0,1,4,5,7,8]
@@ -599,6 +1405,7 @@ def define_excel_params(vd):
 
     d ='201511'
     l='D'
+    vd[d]['props'][l]['s_name']='180 - Local Measure D'
     vd[d]['props'][l]['params']={'index_col':[0,1]}
     vd[d]['props'][l]['params']['skiprows']=3
     vd[d]['props'][l]['params']['parse_cols']=[0,1,4,5,7,8]
@@ -637,6 +1444,7 @@ def define_excel_params(vd):
 
     d ='201311'
     l='C'
+    vd[d]['props'][l]['s_name']='Measure C & D'
     vd[d]['props'][l]['params']={'index_col':0}
     vd[d]['props'][l]['params']['skiprows']=1
     vd[d]['props'][l]['params']['parse_cols']=[0,1,2,4,5]
@@ -644,6 +1452,7 @@ def define_excel_params(vd):
 
     d ='201311'
     l='B'
+    vd[d]['props'][l]['s_name']='Measure A & B'
     vd[d]['props'][l]['params']={'index_col':0}
     vd[d]['props'][l]['params']['skiprows']=1
     vd[d]['props'][l]['params']['parse_cols']=[0,1,2,8,9]
@@ -658,6 +1467,7 @@ def define_excel_params(vd):
 
     d ='199706'
     l='F'
+    vd[d]['props'][l]['s_name']='970603'
     vd[d]['props'][l]['params']={'index_col':0}
     vd[d]['props'][l]['params']['skiprows']=3
     vd[d]['props'][l]['params']['parse_cols']=[0,1,2,20,21]
@@ -672,6 +1482,7 @@ def define_excel_params(vd):
 
     d ='201411'
     l='F'
+    vd[d]['props'][l]['s_name']='370 - Local Measure F'
     vd[d]['props'][l]['params']={'index_col':[0,1]}
     vd[d]['props'][l]['params']['skiprows']=3
     vd[d]['props'][l]['params']['parse_cols']=[0,1,4,5,7,8]
@@ -679,6 +1490,7 @@ def define_excel_params(vd):
 
     d ='199811'
     l='E'
+    vd[d]['props'][l]['s_name']='City Prop A-E'
     vd[d]['props'][l]['params']={'index_col':0}
     vd[d]['props'][l]['params']['skiprows']=3
     vd[d]['props'][l]['params']['parse_cols']=[0,1,2,17,18]
@@ -0,0 +1,370 @@
+"""election_store.py
+
+This module has ElectionStore, which holds the election data instead of the nested vote_data dictionary, without
+keeping every dataframe in memory.
+
+It's used the same way as the dictionary, so process_votedata, verify_vote_totals and combine_dataframes work with it:
+
+    store = ElectionStore.from_dict(vote_data, sov_path='../data/SOV_w_nimby/')
+    store['200806']['props']['G']['data']          # read from the excel file the first time it's used
+    store1 = dpf.process_votedata(store, dpf.consolidate_abs)   # a new store
+
+Each (date, prop) is a small record with the filename, sheet name, excel parameters and nimby value. Dataframes
+are loaded when they're used: from the store's own memory, from disk, from the store it was copied from, or from
+the excel file. The most recently used ones are kept in memory, up to max_bytes; the others are written to
+spill_path and dropped from memory.
+"""
+
+import os
+import pickle
+import shutil
+import uuid
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+import pandas as pd
+
+import data_prep_functions as dpf
+
+
+spill_path = dpf.cache_dir+'store/'
+"""Path for dataframes that are moved out of memory"""
+
+store_max_bytes = 500*2**20
+"""Default memory budget of a store"""
+
+
+def read_formatted_sheet(store, date_key, prop_key):
+    """Read a proposition's sheet and put it in the multiindex format (what the notebook does after read_vote_sheet).
+    This is the default loader of ElectionStore."""
+    data = dpf.read_vote_sheet(date_key, prop_key, vote_df=store, path=store.sov_path)
+    return(dpf.format_vote_sheet(data, date_key))
+
+
+class PropRecord(object):
+    """One proposition of an election. Works like the vote_data[date]['props'][letter] dictionary:
+    'data' gets the dataframe from the store, and other keys are the record's fields."""
+    __slots__ = ('store', 'date_key', 'prop_key', 's_name', 'params', 'nimby', 'extra')
+    fields = ('s_name', 'params', 'nimby')
+
+    def __init__(self, store, date_key, prop_key, s_name=None, params=None, nimby=None, extra=None):
+        self.store = store
+        self.date_key = date_key
+        self.prop_key = prop_key
+        self.s_name = s_name
+        self.params = params
+        self.nimby = nimby
+        self.extra = extra
+
+    def __getitem__(self, key):
+        if key=='data':
+            return(self.store.load(self.date_key, self.prop_key))
+        if key in self.fields:
+            value = getattr(self, key)
+            if value is None:
+                raise KeyError(key)
+            return(value)
+        if self.extra and key in self.extra:
+            return(self.extra[key])
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key=='data':
+            self.store.put(self.date_key, self.prop_key, value)
+        elif key in self.fields:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        return(key in self.keys())
+
+    def get(self, key, default=None):
+        try:
+            return(self[key])
+        except KeyError:
+            return(default)
+
+    def keys(self):
+        keys = [f for f in self.fields if getattr(self, f) is not None]
+        if self.store.has_data(self.date_key, self.prop_key):
+            keys.append('data')
+        return(keys+list(self.extra or {}))
+
+    def __iter__(self):
+        return(iter(self.keys()))
+
+    def __len__(self):
+        return(len(self.keys()))
+
+    def __repr__(self):
+        return('PropRecord({} {}, sheet={!r})'.format(self.date_key, self.prop_key, self.s_name))
+
+
+class ElectionRecord(object):
+    """One election (date). Works like the vote_data[date] dictionary, with 'filename', 'props' and any other keys
+    (e.g. 'sheet_names')."""
+    __slots__ = ('store', 'date_key', 'filename', 'props', 'extra')
+
+    def __init__(self, store, date_key, filename=None, extra=None):
+        self.store = store
+        self.date_key = date_key
+        self.filename = filename
+        self.props = PropsView(self)
+        self.extra = extra
+
+    def __getitem__(self, key):
+        if key=='props':
+            return(self.props)
+        if key=='filename' and self.filename is not None:
+            return(self.filename)
+        if self.extra and key in self.extra:
+            return(self.extra[key])
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key=='props':
+            self.props.clear()
+            for p in value.keys():
+                self.props[p] = value[p]
+        elif key=='filename':
+            self.filename = value
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        return(key in self.keys())
+
+    def get(self, key, default=None):
+        try:
+            return(self[key])
+        except KeyError:
+            return(default)
+
+    def keys(self):
+        keys = ['filename'] if self.filename is not None else []
+        return(keys+['props']+list(self.extra or {}))
+
+    def __iter__(self):
+        return(iter(self.keys()))
+
+    def __len__(self):
+        return(len(self.keys()))
+
+    def __repr__(self):
+        return('ElectionRecord({}, props={})'.format(self.date_key, list(self.props.keys())))
+
+
+class PropsView(MutableMapping):
+    """The propositions of an election: {letter: PropRecord}."""
+    __slots__ = ('election', 'records')
+
+    def __init__(self, election):
+        self.election = election
+        self.records = {}
+
+    def __getitem__(self, prop_key):
+        return(self.records[prop_key])
+
+    def __setitem__(self, prop_key, value):
+        election = self.election
+        if value is self.records.get(prop_key):
+            return
+        if prop_key in self.records:
+            del self[prop_key]
+        record = PropRecord(election.store, election.date_key, prop_key)
+        self.records[prop_key] = record
+        for k in (value.keys() if value is not None else []):
+            record[k] = value[k]
+
+    def __delitem__(self, prop_key):
+        del self.records[prop_key]
+        self.election.store.drop(self.election.date_key, prop_key)
+
+    def __iter__(self):
+        return(iter(self.records))
+
+    def __len__(self):
+        return(len(self.records))
+
+
+class ElectionStore(MutableMapping):
+    """Election data by date and proposition, with dataframes loaded when they're used and kept in memory
+    up to a memory budget. See the module docstring.
+    Args:
+        max_bytes (int): memory budget for the dataframes. Defaults to store_max_bytes
+        sov_path (str): path to the excel files, for the loader
+        loader (function): makes a proposition's dataframe the first time it's needed, given
+            (store, date_key, prop_key). Defaults to read_formatted_sheet
+        parent (ElectionStore): store this one was copied from. Dataframes that haven't been set in this store
+            come from the parent. The reference is dropped once they've all been set (or dropped) here, so a chain
+            of copies (e.g. process_votedata stages) doesn't keep every earlier store alive.
+    """
+
+    def __init__(self, max_bytes=None, sov_path=None, loader=None, parent=None):
+        self.max_bytes = store_max_bytes if max_bytes is None else max_bytes
+        self.sov_path = sov_path
+        self.loader = read_formatted_sheet if loader is None else loader
+        self.parent = parent
+        self.elections = {}
+        self._resident = OrderedDict()  # (date, prop): (dataframe, bytes), least recently used first
+        self._spilled = {}  # (date, prop): file
+        self._set = set()  # (date, prop) with a dataframe set in this store
+        self._inherited = set()  # (date, prop) that still come from the parent
+        self.spill_dir = spill_path+uuid.uuid4().hex+'/'
+        weakref.finalize(self, shutil.rmtree, self.spill_dir, True)
+
+    ######## the vote_data dictionary interface ########
+
+    def __getitem__(self, date_key):
+        return(self.elections[date_key])
+
+    def __setitem__(self, date_key, value):
+        if date_key in self.elections:
+            del self[date_key]
+        election = ElectionRecord(self, date_key)
+        self.elections[date_key] = election
+        for k in value.keys():
+            election[k] = value[k]
+
+    def __delitem__(self, date_key):
+        election = self.elections.pop(date_key)
+        for p in list(election.props.keys()):
+            self.drop(date_key, p)
+
+    def __iter__(self):
+        return(iter(self.elections))
+
+    def __len__(self):
+        return(len(self.elections))
+
+    def __repr__(self):
+        return('ElectionStore({} elections, {} propositions, {:.1f} MB in memory)'.format(
+            len(self), sum(len(e.props) for e in self.elections.values()), self.memory_usage()/2**20))
+
+    @classmethod
+    def from_dict(cls, vote_data, **kwargs):
+        """Make a store from the nested vote_data dictionary (dataframes that are already there are added to the store).
+        kwargs are passed to ElectionStore."""
+        store = cls(**kwargs)
+        for d in vote_data.keys():
+            store[d] = vote_data[d]
+        return(store)
+
+    def to_dict(self):
+        """The nested vote_data dictionary, with all the dataframes loaded."""
+        return(dict((d, dict((k, dict((p, dict(e.props[p])) for p in e.props) if k=='props' else e[k]) for k in e.keys()))
+                    for d, e in self.elections.items()))
+
+    def copy(self):
+        """New store with the same records. Its dataframes come from this store until they're set in the new one,
+        so nothing is copied until it's needed (this is what copy_votedata does for a store)."""
+        new = ElectionStore(max_bytes=self.max_bytes, sov_path=self.sov_path, loader=self.loader, parent=self)
+        for d, e in self.elections.items():
+            election = ElectionRecord(new, d, e.filename, dict(e.extra) if e.extra else None)
+            new.elections[d] = election
+            for p, r in e.props.items():
+                election.props.records[p] = PropRecord(new, d, p, r.s_name, r.params, r.nimby, dict(r.extra) if r.extra else None)
+                new._inherited.add((d, p))
+        return(new)
+
+    def add_nimby(self, df_prop):
+        """Record the vote that equals nimby for each proposition, from the proposals dataframe (see lookup_nimby_value)."""
+        for d, e in self.elections.items():
+            for p, r in e.props.items():
+                r.nimby = dpf.lookup_nimby_value(d, p, df_prop)
+        return()
+
+    ######## dataframes ########
+
+    def has_data(self, date_key, prop_key):
+        """Whether a proposition has a dataframe (in memory, on disk, in the parent store, or from the loader)."""
+        key = (date_key, prop_key)
+        if key in self._set:
+            return(True)
+        if self.parent is not None:
+            return(self.parent.has_data(date_key, prop_key))
+        election = self.elections.get(date_key)
+        record = election.props.records.get(prop_key) if election is not None else None
+        return(record is not None and record.s_name is not None and record.params is not None and self.sov_path is not None)
+
+    def load(self, date_key, prop_key):
+        """Get a proposition's dataframe."""
+        key = (date_key, prop_key)
+        if key in self._resident:
+            self._resident.move_to_end(key)
+            return(self._resident[key][0])
+        if key in self._spilled:
+            df = pd.read_pickle(self._spilled[key])
+        elif key in self._set:
+            raise KeyError(key)
+        elif self.parent is not None and self.parent.has_data(date_key, prop_key):
+            # the parent keeps it; it only moves into this store when it's set here
+            return(self.parent.load(date_key, prop_key))
+        elif self.has_data(date_key, prop_key):
+            df = self.loader(self, date_key, prop_key)
+            self._set.add(key)
+        else:
+            raise KeyError('data')
+        self._keep(key, df)
+        return(df)
+
+    def put(self, date_key, prop_key, df):
+        """Set a proposition's dataframe."""
+        key = (date_key, prop_key)
+        self._forget(key)
+        self._set.add(key)
+        self._release(key)
+        self._keep(key, df)
+        return()
+
+    def drop(self, date_key, prop_key):
+        """Remove a proposition's dataframe from memory and disk."""
+        key = (date_key, prop_key)
+        self._forget(key)
+        self._set.discard(key)
+        self._release(key)
+        return()
+
+    def memory_usage(self):
+        """Bytes used by the dataframes in memory."""
+        return(sum(size for df, size in self._resident.values()))
+
+    def _keep(self, key, df):
+        """Keep a dataframe in memory, moving the least recently used ones to disk if it's over the budget."""
+        self._resident[key] = (df, int(df.memory_usage(deep=True).sum()))
+        total = self.memory_usage()
+        while total>self.max_bytes and len(self._resident)>1:
+            old_key, (old_df, size) = self._resident.popitem(last=False)
+            self._spill(old_key, old_df)
+            total -= size
+        return()
+
+    def _spill(self, key, df):
+        """Write a dataframe to disk. It's written every time, since it could have been changed in memory."""
+        os.makedirs(self.spill_dir, exist_ok=True)
+        filename = self.spill_dir+'{}{}.pkl'.format(*key)
+        with open(filename+'.tmp', 'wb') as f:
+            pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(filename+'.tmp', filename)
+        self._spilled[key] = filename
+        return()
+
+    def _release(self, key):
+        """The dataframe of key doesn't come from the parent any more. Drop the parent when none do."""
+        self._inherited.discard(key)
+        if not self._inherited:
+            self.parent = None
+        return()
+
+    def _forget(self, key):
+        self._resident.pop(key, None)
+        filename = self._spilled.pop(key, None)
+        if filename is not None and os.path.exists(filename):
+            os.remove(filename)
+        return()
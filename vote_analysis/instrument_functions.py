@@ -0,0 +1,230 @@
+"""instrument_functions.py
+
+This module records how long the processing functions take and how much memory they use.
+
+Nothing is recorded unless it's turned on with instrument(), e.g.:
+
+    with inst.instrument(log_file='../results/timings.jsonl') as records:
+        vote_data1 = dpf.process_votedata(vote_data, dpf.consolidate_abs)
+    inst.summarize(records)
+
+Each call of a processing function (for each election and proposition, in process_votedata) gives one record
+with the wall time, peak memory, input and output row counts and dataframe memory usage. Records are kept
+in a list, and can also be written to a JSON-lines log or passed to a callback.
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+
+
+_sinks = []
+"""Functions that get each record, while instrument() is on"""
+
+_trace_memory = []
+"""Whether each active instrument() traces memory"""
+
+_mem_stack = []
+"""Peak memory of the calls being measured, for nested calls. Only used in the main thread (see measure_call)."""
+
+_lock = threading.Lock()
+"""Lock for sending records to the sinks from several threads"""
+
+_local = threading.local()
+"""Records captured in this thread (see capture)"""
+
+
+def is_enabled():
+    """Whether any records are being collected (or captured in this thread)."""
+    return(len(_sinks)>0 or getattr(_local, 'captured', None) is not None)
+
+
+def emit(record):
+    """Send a record to everything that's collecting them, or to the capture list if this thread is capturing."""
+    captured = getattr(_local, 'captured', None)
+    if captured is not None:
+        captured.append(record)
+        return()
+    with _lock:
+        for sink in list(_sinks):
+            sink(record)
+    return()
+
+
+@contextmanager
+def capture():
+    """Keep the records made in this thread in a list instead of sending them, e.g. in a worker process, where the
+    sinks of the main process can't be reached. The list goes back with the task's result and is emitted there
+    (see dpf.run_tasks).
+    Yields:
+        list: the records
+    """
+    previous = getattr(_local, 'captured', None)
+    _local.captured = []
+    try:
+        yield _local.captured
+    finally:
+        _local.captured = previous
+
+
+def report(event, message, **fields):
+    """Report something about the processing. Sent as a record while instrument() is on, otherwise printed.
+    Args:
+        event (str): name of the function or step
+        message (str): message to print when nothing is being recorded
+        fields: values to put in the record
+    """
+    if is_enabled():
+        record = {'kind':'event', 'name':event, 'time':time.time(), 'pid':os.getpid()}
+        record.update(fields)
+        emit(record)
+    else:
+        print(message)
+    return()
+
+
+def frame_stats(obj):
+    """Number of rows and memory used by a dataframe (or the first dataframe in a tuple or list)."""
+    if isinstance(obj, (tuple, list)):
+        obj = next((o for o in obj if isinstance(o, (pd.DataFrame, pd.Series))), None)
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return(len(obj), int(obj.memory_usage(deep=True).sum()))
+    return(None, None)
+
+
+def measure_call(func, args, kwargs, name=None, labels=None, trace_memory=True):
+    """Call a function and measure it. The record isn't emitted, so this can be used in worker processes.
+    tracemalloc is shared by all the threads of a process, so peak memory is only measured in the main thread
+    (of this process or a worker process); calls in other threads get peak_mem_bytes None.
+    Args:
+        func (function): function to call
+        args (tuple), kwargs (dict): its arguments
+        name (str): name for the record. Defaults to the function's name
+        labels (dict): other values to put in the record, e.g. date_key and prop_key
+        trace_memory (bool): whether to measure peak memory with tracemalloc
+    Returns:
+        result of the function
+        dict: the record
+    """
+    rows_in, mem_in = frame_stats(args[0] if args else None)
+    trace_memory = trace_memory and threading.current_thread() is threading.main_thread()
+    started = trace_memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    if trace_memory:
+        current, peak = tracemalloc.get_traced_memory()
+        if _mem_stack:
+            _mem_stack[-1] = max(_mem_stack[-1], peak)
+        tracemalloc.reset_peak()
+        _mem_stack.append(0)
+    start_time = time.time()
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        seconds = time.perf_counter()-start
+        peak_mem = None
+        if trace_memory:
+            peak = max(_mem_stack.pop(), tracemalloc.get_traced_memory()[1])
+            peak_mem = peak-current
+            if _mem_stack:
+                _mem_stack[-1] = max(_mem_stack[-1], peak)
+        if started:
+            tracemalloc.stop()
+    rows_out, mem_out = frame_stats(result)
+
+    record = {'kind':'call', 'name':name or func.__name__, 'time':start_time, 'pid':os.getpid(), 'seconds':seconds,
+              'peak_mem_bytes':peak_mem, 'rows_in':rows_in, 'rows_out':rows_out, 'mem_in_bytes':mem_in, 'mem_out_bytes':mem_out}
+    if labels:
+        record.update(labels)
+    return(result, record)
+
+
+def tracked(func):
+    """Decorator that records each call of a function while instrument() is on."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not is_enabled():
+            return(func(*args, **kwargs))
+        result, record = measure_call(func, args, kwargs, trace_memory=any(_trace_memory))
+        emit(record)
+        return(result)
+    return(wrapper)
+
+
+def trace_memory_enabled():
+    """Whether peak memory is being measured."""
+    return(any(_trace_memory))
+
+
+@contextmanager
+def instrument(log_file=None, callback=None, trace_memory=True):
+    """Turn on recording of the processing functions.
+    Args:
+        log_file (str): if given, records are appended to this file as JSON lines
+        callback (function): if given, called with each record
+        trace_memory (bool): whether to measure peak memory. This uses tracemalloc, which slows things down.
+    Yields:
+        list: the records (dictionaries)
+    """
+    records = []
+    f = open(log_file, 'a') if log_file else None
+
+    def sink(record):
+        records.append(record)
+        if f is not None:
+            f.write(json.dumps(record, default=str)+'\n')
+        if callback is not None:
+            callback(record)
+
+    _sinks.append(sink)
+    _trace_memory.append(trace_memory)
+    try:
+        yield records
+    finally:
+        _sinks.remove(sink)
+        _trace_memory.pop()
+        if f is not None:
+            f.close()
+
+
+def read_log(log_file):
+    """Read records from a JSON-lines log.
+    Returns:
+        list: the records
+    """
+    with open(log_file) as f:
+        return([json.loads(line) for line in f if line.strip()])
+
+
+def summarize(records, top=10):
+    """Summarize the records, to find the hot spots.
+    Args:
+        records (list): records from instrument() or read_log()
+        top (int): number of slowest calls to print
+    Returns:
+        DataFrame: by function name: number of calls, total, mean and max seconds, and max peak memory,
+            sorted by total seconds
+    """
+    calls = pd.DataFrame([r for r in records if r.get('kind')=='call'])
+    if len(calls)==0:
+        print('no calls recorded')
+        return(pd.DataFrame())
+    if 'peak_mem_bytes' not in calls.columns:
+        calls['peak_mem_bytes'] = None
+    calls['peak_mem_bytes'] = calls['peak_mem_bytes'].astype(float)
+    summary = calls.groupby('name').agg(calls=('seconds','size'), total_s=('seconds','sum'), mean_s=('seconds','mean'),
+                                        max_s=('seconds','max'), max_peak_mem_mb=('peak_mem_bytes','max'))
+    summary['max_peak_mem_mb'] = summary['max_peak_mem_mb']/2**20
+    summary = summary.sort_values('total_s', ascending=False)
+
+    label_cols = [c for c in ['name','date_key','prop_key','seconds','peak_mem_bytes','rows_in','rows_out'] if c in calls.columns]
+    print('Slowest calls:\n', calls.sort_values('seconds', ascending=False)[label_cols].head(top).to_string(index=False))
+    print('\nBy function:\n', summary.to_string())
+    return(summary)
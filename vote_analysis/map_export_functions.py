@@ -0,0 +1,354 @@
+"""map_export_functions.py
+
+This module writes the precinct results as small GeoJSON or TopoJSON files for the web maps.
+It replaces minifygeojson.sh (the npm minify-geojson tool): it keeps only the properties the maps use, shortens
+the property keys, rounds the coordinates, and can simplify the boundaries. Features are written straight
+from the GeoDataFrame, so there's no full-size file in between.
+
+Simplification is done on the boundaries shared between precincts (the TopoJSON arcs), so neighboring
+precincts still fit together afterwards, in both output formats.
+"""
+
+import json
+import string
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+import data_prep_functions as dpf
+from spatial_processing_functions import load_prec_shp
+
+
+map_properties = ['pct_nimby', 'med_inc_adj', 'turnout', 'owned', 'precname', 'yr_prop']
+""" properties used by the maps """
+
+mapspath = dpf.results_path+'maps/'
+""" path to map files """
+
+
+def make_key_map(properties):
+    """Short keys for the properties: 'a', 'b', ..., 'z', 'aa', 'ab', ...
+    Returns:
+        dict: {property: short key}
+    """
+    letters = string.ascii_lowercase
+    keys = []
+    for i in range(len(properties)):
+        key = ''
+        i += 1
+        while i>0:
+            i, r = divmod(i-1, 26)
+            key = letters[r]+key
+        keys.append(key)
+    return(dict(zip(properties, keys)))
+
+
+def to_json_value(v):
+    """Convert numpy and missing values so they can be written as JSON."""
+    if v is None:
+        return(None)
+    if isinstance(v, (np.bool_, bool)):
+        return(bool(v))
+    if isinstance(v, (np.integer,)):
+        return(int(v))
+    if isinstance(v, (float, np.floating)):
+        return(None if np.isnan(v) else float(v))
+    if pd.isnull(v):
+        return(None)
+    return(v)
+
+
+def to_wgs84(gdf):
+    """Reproject to longitude/latitude (EPSG:4326), if it isn't already."""
+    if gdf.crs is not None and gdf.crs.to_epsg()!=4326:
+        gdf = gdf.to_crs(epsg=4326)
+    return(gdf)
+
+
+######## TOPOLOGY ########
+
+def geometry_rings(geom):
+    """Rings of a polygon or multipolygon, as a list of polygons, each a list of coordinate arrays (exterior first)."""
+    if geom is None or geom.is_empty:
+        return([])
+    if geom.geom_type=='Polygon':
+        polys = [geom]
+    elif geom.geom_type=='MultiPolygon':
+        polys = list(geom.geoms)
+    else:
+        raise ValueError('can only export polygons, not {}'.format(geom.geom_type))
+    return([[np.asarray(p.exterior.coords)]+[np.asarray(r.coords) for r in p.interiors] for p in polys])
+
+
+def quantize_ring(coords, translate, scale):
+    """Put a ring's coordinates on the integer grid, dropping repeated points. Returns None if it collapses."""
+    q = np.round((coords[:, :2]-translate)/scale).astype(np.int64)
+    keep = np.ones(len(q), dtype=bool)
+    keep[1:] = np.any(q[1:]!=q[:-1], axis=1)
+    q = q[keep]
+    if len(q)<4:
+        return(None)
+    return([tuple(p) for p in q.tolist()])
+
+
+def build_topology(geoms, translate, scale):
+    """Find the arcs (shared boundaries) of a set of polygons on an integer grid.
+    Rings are cut at junctions, the points where boundaries meet or split, and arcs that are the same
+    (in either direction) are only stored once. A reversed arc is referred to as ~index, like in TopoJSON.
+    Args:
+        geoms (list): shapely polygons or multipolygons
+        translate (array): grid origin (x, y)
+        scale (array): grid cell size (x, y)
+    Returns:
+        list: for each geometry, its polygons as lists of rings as lists of arc indexes
+        list: the arcs, each a list of (x, y) integer points
+    """
+    quantized = []
+    for geom in geoms:
+        polys = []
+        for rings in geometry_rings(geom):
+            q_rings = [quantize_ring(r, translate, scale) for r in rings]
+            if q_rings[0] is None:
+                continue  # exterior collapsed
+            polys.append([r for r in q_rings if r is not None])
+        quantized.append(polys)
+
+    # a junction is a point with more than two different neighbors
+    neighbors = defaultdict(set)
+    for polys in quantized:
+        for rings in polys:
+            for ring in rings:
+                pts = ring[:-1]
+                n = len(pts)
+                for i, p in enumerate(pts):
+                    neighbors[p].add(pts[i-1])
+                    neighbors[p].add(pts[(i+1) % n])
+    junctions = set(p for p, nb in neighbors.items() if len(nb)>2)
+    del neighbors
+
+    arcs = []
+    arc_index = {}
+
+    def get_arc(points):
+        key = tuple(points)
+        if key in arc_index:
+            return(arc_index[key])
+        rkey = key[::-1]
+        if rkey in arc_index:
+            return(~arc_index[rkey])
+        arc_index[key] = len(arcs)
+        arcs.append(list(points))
+        return(len(arcs)-1)
+
+    def ring_arcs(ring):
+        pts = ring[:-1]
+        cuts = [i for i, p in enumerate(pts) if p in junctions]
+        if not cuts:
+            # no junctions: one closed arc, starting at the smallest point so identical rings match
+            start = pts.index(min(pts))
+            pts = pts[start:]+pts[:start]
+            return([get_arc(pts+[pts[0]])])
+        start = cuts[0]
+        pts = pts[start:]+pts[:start]
+        pts = pts+[pts[0]]
+        cuts = [i-start for i in cuts]+[len(pts)-1]
+        return([get_arc(pts[a:b+1]) for a, b in zip(cuts[:-1], cuts[1:])])
+
+    topo_geoms = [[[ring_arcs(ring) for ring in rings] for rings in polys] for polys in quantized]
+    return(topo_geoms, arcs)
+
+
+def arc_points(arcs, i):
+    """Points of arc i (reversed if i is negative)."""
+    return(arcs[i] if i>=0 else arcs[~i][::-1])
+
+
+def ring_points(arcs, arc_ids):
+    """Join a ring's arcs back into a list of points."""
+    pts = list(arc_points(arcs, arc_ids[0]))
+    for i in arc_ids[1:]:
+        pts.extend(arc_points(arcs, i)[1:])
+    return(pts)
+
+
+def simplify_arcs(topo_geoms, arcs, tolerance):
+    """Simplify each arc (Douglas-Peucker, on the grid). The ends of the arcs are kept, so shared boundaries
+    still match. Arcs of rings that would collapse are left as they were.
+    Args:
+        topo_geoms (list): geometries from build_topology
+        arcs (list): arcs from build_topology
+        tolerance (float): tolerance in grid units
+    Returns:
+        list: the simplified arcs
+    """
+    from shapely.geometry import LineString
+
+    simplified = []
+    for arc in arcs:
+        if len(arc)<=2:
+            simplified.append(arc)
+            continue
+        line = LineString(arc).simplify(tolerance, preserve_topology=False)
+        pts = [tuple(int(round(c)) for c in p) for p in line.coords]
+        if arc[0]==arc[-1] and len(pts)<4:
+            pts = arc
+        simplified.append(pts)
+
+    for polys in topo_geoms:
+        for rings in polys:
+            for arc_ids in rings:
+                if len(ring_points(simplified, arc_ids))<4:
+                    for i in arc_ids:
+                        j = i if i>=0 else ~i
+                        simplified[j] = arcs[j]
+    return(simplified)
+
+
+def prepare_topology(gdf, translate, scale, simplify):
+    """Build the topology of the unique geometries in gdf (each precinct is usually there once per election).
+    Returns:
+        array: for each row of gdf, the index of its unique geometry
+        list: topology of each unique geometry, see build_topology
+        list: arcs
+    """
+    wkb = gdf.geometry.to_wkb()
+    codes, uniques = pd.factorize(wkb)
+    first = pd.Series(np.arange(len(codes))).groupby(codes).first().to_numpy()
+    unique_geoms = list(gdf.geometry.iloc[first])
+    topo_geoms, arcs = build_topology(unique_geoms, translate, scale)
+    if simplify:
+        arcs = simplify_arcs(topo_geoms, arcs, simplify/np.mean(scale))
+    return(codes, topo_geoms, arcs)
+
+
+def feature_properties(row, properties, key_map):
+    """Properties of a feature, with short keys if key_map is given."""
+    props = {}
+    for prop in properties:
+        key = key_map[prop] if key_map else prop
+        props[key] = to_json_value(row[prop])
+    return(props)
+
+
+######## EXPORT ########
+
+def export_geojson(gdf, filename, properties=None, short_keys=True, precision=5, simplify=None):
+    """Write a compact GeoJSON file.
+    Args:
+        gdf (GeoDataFrame): precincts with results
+        filename (str): file to write
+        properties (list): properties to keep. Defaults to map_properties
+        short_keys (bool): whether to shorten the property keys. The key map is added to the file as 'keyMap' ({short: long}).
+        precision (int): number of decimals to keep in the coordinates
+        simplify (float): if given, simplification tolerance in degrees
+    Returns:
+        int: number of features written
+    """
+    if properties is None:
+        properties = map_properties
+    gdf = to_wgs84(gdf)
+    key_map = make_key_map(properties) if short_keys else None
+    scale = np.array([10.**-precision]*2)
+    codes, topo_geoms, arcs = prepare_topology(gdf, np.zeros(2), scale, simplify)
+
+    def coords(polys):
+        return([[[[round(x*scale[0], precision), round(y*scale[1], precision)] for x, y in ring_points(arcs, ring)]
+                 for ring in rings] for rings in polys])
+
+    sep = (',', ':')
+    with open(filename, 'w') as f:
+        f.write('{"type":"FeatureCollection"')
+        if key_map:
+            f.write(',"keyMap":'+json.dumps(dict((v, k) for k, v in key_map.items()), separators=sep))
+        f.write(',"features":[')
+        for n, (code, (_, row)) in enumerate(zip(codes, gdf[properties].iterrows())):
+            polys = topo_geoms[code]
+            if not polys:
+                geometry = None
+            elif len(polys)==1:
+                geometry = {'type':'Polygon', 'coordinates':coords(polys)[0]}
+            else:
+                geometry = {'type':'MultiPolygon', 'coordinates':coords(polys)}
+            feature = {'type':'Feature', 'properties':feature_properties(row, properties, key_map), 'geometry':geometry}
+            f.write((',' if n else '')+json.dumps(feature, separators=sep))
+        f.write(']}')
+    return(len(codes))
+
+
+def export_topojson(gdf, filename, properties=None, short_keys=True, quantization=1e5, simplify=None, object_name='precincts'):
+    """Write a TopoJSON file, where boundaries shared by precincts (and repeated precincts) are stored once.
+    Args:
+        gdf (GeoDataFrame): precincts with results
+        filename (str): file to write
+        properties (list): properties to keep. Defaults to map_properties
+        short_keys (bool): whether to shorten the property keys. The key map is added to the file as 'keyMap' ({short: long}).
+        quantization (float): number of grid steps across the map in each direction
+        simplify (float): if given, simplification tolerance in degrees
+        object_name (str): name of the object in the topology
+    Returns:
+        int: number of geometries written
+    """
+    if properties is None:
+        properties = map_properties
+    gdf = to_wgs84(gdf)
+    key_map = make_key_map(properties) if short_keys else None
+    xmin, ymin, xmax, ymax = gdf.total_bounds
+    translate = np.array([xmin, ymin])
+    scale = np.array([(xmax-xmin) or 1., (ymax-ymin) or 1.])/(quantization-1)
+    codes, topo_geoms, arcs = prepare_topology(gdf, translate, scale, simplify)
+
+    sep = (',', ':')
+    with open(filename, 'w') as f:
+        f.write('{"type":"Topology","bbox":'+json.dumps([float(v) for v in gdf.total_bounds], separators=sep))
+        f.write(',"transform":'+json.dumps({'scale':scale.tolist(), 'translate':translate.tolist()}, separators=sep))
+        if key_map:
+            f.write(',"keyMap":'+json.dumps(dict((v, k) for k, v in key_map.items()), separators=sep))
+        f.write(',"objects":{'+json.dumps(object_name)+':{"type":"GeometryCollection","geometries":[')
+        for n, (code, (_, row)) in enumerate(zip(codes, gdf[properties].iterrows())):
+            polys = topo_geoms[code]
+            if not polys:
+                geometry = {'type':None}
+            elif len(polys)==1:
+                geometry = {'type':'Polygon', 'arcs':polys[0]}
+            else:
+                geometry = {'type':'MultiPolygon', 'arcs':polys}
+            geometry['properties'] = feature_properties(row, properties, key_map)
+            f.write((',' if n else '')+json.dumps(geometry, separators=sep))
+        f.write(']}},"arcs":[')
+        for n, arc in enumerate(arcs):
+            # arcs are delta-encoded
+            pts = np.asarray(arc, dtype=np.int64)
+            pts[1:] = np.diff(pts, axis=0)
+            f.write((',' if n else '')+json.dumps(pts.tolist(), separators=sep))
+        f.write(']}')
+    return(len(codes))
+
+
+def export_maps(all_data, prec_keys=('pre1992', 'pre2002', 'pre2012'), topojson=False, **kwargs):
+    """Write the map file for each set of precinct boundaries (this was the last step of sf_voting_project.ipynb
+    plus minifygeojson.sh).
+    Args:
+        all_data (DataFrame): all voting data, with a 'yr_mo' column
+        prec_keys (list): precinct boundary keys
+        topojson (bool): write TopoJSON instead of GeoJSON
+        kwargs: passed to export_geojson or export_topojson
+    Returns:
+        list: names of files written
+    """
+    filenames = []
+    for prec_key in prec_keys:
+        prec_df = load_prec_shp(prec_key[-4:])
+        vote_df = dpf.filter_for_dates(all_data, prec_key)
+        properties = kwargs.get('properties') or map_properties
+        cols = ['precname']+[c for c in properties if c!='precname']
+        merged = pd.merge(prec_df[['precname', 'geometry']], vote_df[cols], on='precname')
+        if topojson:
+            filename = mapspath+'results_{}.topojson'.format(prec_key)
+            export_topojson(merged, filename, **kwargs)
+        else:
+            filename = mapspath+'results_{}.geojson'.format(prec_key)
+            export_geojson(merged, filename, **kwargs)
+        print('saved as '+filename)
+        filenames.append(filename)
+    return(filenames)
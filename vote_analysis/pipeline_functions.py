@@ -0,0 +1,224 @@
+"""pipeline_functions.py
+
+This module runs the vote data processing stages (the vote_data1 ... vote_data7 steps in sf_voting_project.ipynb)
+for each (date, prop), and saves the output of every stage on disk.
+
+Each saved output is keyed by a hash of the stage's input, the stage's code (the function and the helpers it
+uses from its module, see code_version) and anything else it reads
+(the proposals table, the census data). So when a new election is added, or one stage is changed,
+only the stages that are affected get recomputed before the final combine.
+"""
+
+import os
+import re
+import glob
+import pickle
+import hashlib
+import inspect
+import functools
+
+import pandas as pd
+
+import data_prep_functions as dpf
+
+
+cache_path = dpf.cache_dir+'pipeline/'
+"""Path to saved stage outputs"""
+
+
+def census_file_hash(date_key, prop_key, kwargs):
+    """Hash of the census data used to merge with an election."""
+    census_key = dpf.voting2census_key(date_key)
+    return(dpf.hash_file(dpf.census_path+'census_by_precinct_{}.csv'.format(census_key)))
+
+
+def nimby_value(date_key, prop_key, kwargs):
+    """The vote that equals nimby for a proposition, which is all make_vote_variables reads from the proposals table."""
+    return(str(dpf.lookup_nimby_value(date_key, prop_key, kwargs['df_prop'])))
+
+
+vote_stages = [
+    {'name':'consolidate', 'func':dpf.consolidate_abs},
+    {'name':'make_vote_variables', 'func':dpf.make_vote_variables, 'use_datekey':True, 'use_propkey':True, 'kwargs':['df_prop'], 'depends':nimby_value},
+    {'name':'format_precincts', 'func':dpf.format_precincts},
+    {'name':'merge_vote_census', 'func':dpf.merge_vote_census, 'use_datekey':True, 'depends':census_file_hash},
+    {'name':'make_election_dummies', 'func':dpf.make_election_dummies, 'use_datekey':True, 'use_propkey':True},
+    {'name':'fix_yr_built_moved', 'func':dpf.fix_yr_built_moved, 'use_datekey':True},
+    {'name':'adjust_inflation', 'func':dpf.adjust_inflation, 'use_datekey':True},
+]
+"""The stages, in order. Each stage is a dictionary with:
+    name (str): stage name
+    func (function): function applied to each dataframe, as in process_votedata
+    use_datekey, use_propkey (bool): whether the function needs the date and proposition keys
+    kwargs (list): names of extra keyword arguments the function needs
+    depends (function): returns a string for anything else the output depends on, given (date_key, prop_key, kwargs)
+    version (str): optional, change it to recompute a stage when something code_version doesn't follow changes
+        (e.g. a function in another module)
+"""
+
+
+def referenced_names(code):
+    """Global names used by a code object, including in its comprehensions, lambdas and nested functions."""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= referenced_names(const)
+    return(names)
+
+
+def is_constant(value):
+    """Whether a global is a constant that's part of a function's code: a string, number, regex, or a tuple or
+    frozenset of those. Lists and dictionaries aren't, since they can change (e.g. a cache of dataframes)."""
+    if value is None or isinstance(value, (str, bytes, int, float, re.Pattern)):
+        return(True)
+    if isinstance(value, (tuple, frozenset)):
+        return(all(is_constant(v) for v in value))
+    return(False)
+
+
+def function_source(func):
+    """Source code of a function, or its bytecode if the source isn't available."""
+    try:
+        return(inspect.getsource(func).encode())
+    except (OSError, TypeError):
+        return(func.__code__.co_code)
+
+
+@functools.lru_cache(maxsize=None)
+def code_version(func):
+    """Hash of the source code of a function and of the helpers and constants it uses from its own module
+    (split_prec_rows, _PREC_KEY_RE, ..., see is_constant), following the helpers' helpers too. So saved outputs are recomputed when
+    any of them changes, but not when something else in the module does (e.g. define_excel_params).
+    Functions in other modules aren't followed; use the stage's version for those."""
+    h = hashlib.sha1()
+    seen = set()
+    func = inspect.unwrap(func)
+    todo = [func]
+    while todo:
+        f = todo.pop()
+        h.update(f.__qualname__.encode())
+        h.update(function_source(f))
+        for name in sorted(referenced_names(f.__code__)):
+            if name in seen or name not in f.__globals__:
+                continue
+            seen.add(name)
+            value = inspect.unwrap(f.__globals__[name]) if callable(f.__globals__[name]) else f.__globals__[name]
+            if inspect.isfunction(value):
+                if value.__module__==func.__module__:
+                    todo.append(value)
+            elif is_constant(value):
+                h.update(name.encode())
+                h.update(repr(value).encode())
+    return(h.hexdigest())
+
+
+def hash_dataframe(df):
+    """Hash of a dataframe's contents, including the index, columns and dtypes."""
+    h = hashlib.sha1()
+    h.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    h.update(pickle.dumps([list(df.columns), [str(t) for t in df.dtypes], list(df.index.names)]))
+    return(h.hexdigest())
+
+
+def stage_key(input_key, stage, date_key, prop_key, kwargs):
+    """Key for a stage's output: hash of the input key, the stage's name and code, and what else it depends on."""
+    h = hashlib.sha1()
+    h.update(input_key.encode())
+    h.update(stage['name'].encode())
+    h.update(code_version(stage['func']).encode())
+    h.update(str(stage.get('version', '')).encode())
+    if 'depends' in stage:
+        h.update(stage['depends'](date_key, prop_key, kwargs).encode())
+    return(h.hexdigest())
+
+
+def stage_filename(stage_name, date_key, prop_key, key):
+    """Name of the file with a stage's saved output."""
+    return(cache_path+'{}/{}{}_{}.pkl'.format(stage_name, date_key, prop_key, key[:16]))
+
+
+def run_stage(stage, df, date_key, prop_key, kwargs):
+    """Apply one stage's function to a dataframe."""
+    stage_kwargs = dict((k, kwargs[k]) for k in stage.get('kwargs', []))
+    if stage.get('use_datekey', False):
+        stage_kwargs['date_key'] = date_key
+    if stage.get('use_propkey', False):
+        stage_kwargs['prop_key'] = prop_key
+    return(stage['func'](df, **stage_kwargs))
+
+
+def run_branch(df, date_key, prop_key, stages, kwargs):
+    """Run all the stages for one (date, prop), using saved outputs where the keys match.
+    Args:
+        df (DataFrame): election results for the proposition, as read from the excel file
+        date_key (str): election date key
+        prop_key (str): proposition letter
+        stages (list): stages to run, see vote_stages
+        kwargs (dict): extra keyword arguments for the stages
+    Returns:
+        DataFrame: output of the last stage
+        list: names of the stages that were recomputed
+    """
+    key = hash_dataframe(df)
+    current = df  # output of the last stage, if it's loaded
+    prev_file = None
+    recomputed = []
+    for stage in stages:
+        key = stage_key(key, stage, date_key, prop_key, kwargs)
+        filename = stage_filename(stage['name'], date_key, prop_key, key)
+        if os.path.exists(filename):
+            current = None
+        else:
+            if current is None:
+                current = pd.read_pickle(prev_file)
+            current = run_stage(stage, current.copy(), date_key, prop_key, kwargs)
+            recomputed.append(stage['name'])
+            # remove outputs from older inputs or code for this stage
+            for old in glob.glob(glob.escape(cache_path+'{}/{}{}_'.format(stage['name'], date_key, prop_key))+'*'):
+                os.remove(old)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            current.to_pickle(filename+'.tmp')
+            os.replace(filename+'.tmp', filename)
+        prev_file = filename
+    if current is None:
+        current = pd.read_pickle(prev_file)
+    return(current, recomputed)
+
+
+def run_vote_pipeline(data, stages=None, n_workers=None, executor='process', errors=None, **kwargs):
+    """Run the processing stages for every (date, prop) in the election data, only recomputing what changed.
+    Args:
+        data (dict): dictionary of dataframes that holds the election data (as read from the excel files)
+        stages (list): stages to run. Defaults to vote_stages
+        n_workers (int): number of workers, if the propositions should be run in parallel. If None, run serially.
+        executor (str): 'process' or 'thread'
+        errors (dict): if given, failed (date, prop) items are added to it as {(date, prop): exception}
+        kwargs: extra keyword arguments needed by the stages, i.e. df_prop (the proposals dataframe)
+    Returns:
+        dict: new dictionary with the processed dataframes, ready for combine_dataframes
+    """
+    if stages is None:
+        stages = vote_stages
+    data_new = dpf.copy_votedata(data)
+    items = [(d, p) for d in data_new.keys() for p in data_new[d]['props'].keys()]
+
+    tasks = (((d, p), (data[d]['props'][p]['data'], d, p, stages, kwargs)) for d, p in items)
+    for (d, p), result, err in dpf.run_tasks(run_branch, tasks, n_workers=n_workers, executor=executor):
+        if err is not None:
+            print('error for {} {}: {!r}'.format(d, p, err))
+            if errors is not None:
+                errors[(d, p)] = err
+            del data_new[d]['props'][p]
+        else:
+            df_new, recomputed = result
+            if recomputed:
+                print('{} {}: recomputed {}'.format(d, p, ', '.join(recomputed)))
+            data_new[d]['props'][p]['data'] = df_new
+    return(data_new)
+
+
+def clear_pipeline_cache():
+    """Remove all saved stage outputs."""
+    for f in glob.glob(cache_path+'*/*'):
+        os.remove(f)
+    return()
@@ -0,0 +1,331 @@
+"""run_pipeline.py
+
+Runs the processing steps of the notebooks from the command line:
+
+    python run_pipeline.py ingest      # read the SOV workbooks (sf_voting_project.ipynb, up to verify_vote_totals)
+    python run_pipeline.py crosswalk   # crosswalks and census data by precinct (precincts-join-census.ipynb)
+    python run_pipeline.py merge       # process the elections, merge with census data, combine and check them
+    python run_pipeline.py export      # map files for each set of precinct boundaries
+
+Each step saves its output in the results folder, where the next step reads it. The folders default to
+'../data/' and '../results/' (run from vote_analysis/, like the notebooks) and can be changed, e.g.:
+
+    python run_pipeline.py merge --data-root ~/sf_data/ --results-root /tmp/results/ --workers 4
+
+geopandas and shapely are only imported by crosswalk and export, so ingest and merge start quickly.
+"""
+
+import argparse
+import collections
+import os
+import pickle
+import re
+import sys
+from datetime import date
+
+import pandas as pd
+
+import catalog_functions as cf
+import data_prep_functions as dpf
+import election_store as es
+import map_export_functions as mef
+import pipeline_functions as pf
+import spatial_processing_functions as spf
+import validation_functions as vf
+
+
+sov_folder = 'SOV_w_nimby/'
+"""Folder of the SOV workbooks, in the data folder"""
+
+proposals_file = 'BallotPropositions_nimby2.xlsx'
+"""Table of the ballot propositions and their nimby value, in the data folder"""
+
+ingest_file = 'vote_data.pkl'
+"""Output of ingest (the vote_data dictionary with the formatted sheets), in the results folder"""
+
+combined_folder = 'voting_data/'
+"""Output of merge as a partitioned parquet dataset (see write_partitioned), in the results folder"""
+
+_FILENAME_RE = re.compile(r'(\d{2})(\d{2})\d{2}')
+
+
+######## PATHS ########
+
+def set_paths(data_root=None, results_root=None, cache_dir=None):
+    """Set the data, results and cache folders for all the modules. They're also set as environment variables
+    (VOTE_DATA_ROOT, VOTE_RESULTS_ROOT and VOTE_CACHE_DIR), which the modules read when they're imported,
+    so worker processes use the same folders.
+    Args:
+        data_root (str): folder with the original data. Defaults to '../data/'
+        results_root (str): folder for the results. Defaults to '../results/'
+        cache_dir (str): folder for the caches. Defaults to the 'cache' folder in results_root
+    Returns:
+        dict: the folders that are used
+    """
+    for var, path in [('VOTE_DATA_ROOT', data_root), ('VOTE_RESULTS_ROOT', results_root), ('VOTE_CACHE_DIR', cache_dir)]:
+        if path is not None:
+            os.environ[var] = os.path.join(os.path.expanduser(path), '')
+    data_root = os.environ.get('VOTE_DATA_ROOT', '../data/')
+    results_root = os.environ.get('VOTE_RESULTS_ROOT', '../results/')
+    cache_dir = os.environ.get('VOTE_CACHE_DIR', results_root+'cache/')
+
+    spf.datapath = data_root
+    spf.resultspath = results_root
+    spf.crosswalkpath = results_root+'crosswalks/'
+    dpf.results_path = results_root
+    dpf.cache_dir = cache_dir
+    dpf.sheet_cache_path = cache_dir+'sheets/'
+    dpf.census_path = results_root+'data_by_precinct/'
+    pf.cache_path = cache_dir+'pipeline/'
+    es.spill_path = cache_dir+'store/'
+    cf.catalog_file = cache_dir+'sov_catalog.json'
+    mef.mapspath = results_root+'maps/'
+    # only if it's been imported, since it needs requests
+    if 'census_api_functions' in sys.modules:
+        sys.modules['census_api_functions'].cache_path = cache_dir+'census_api/'
+    return({'data_root':data_root, 'results_root':results_root, 'cache_dir':cache_dir})
+
+
+######## INPUTS ########
+
+def election_key(filename):
+    """Election date key of a SOV workbook, e.g. 'SOV081104.xls' -> '200811'. None if the name doesn't have a date."""
+    m = _FILENAME_RE.search(os.path.basename(filename))
+    if m is None:
+        return(None)
+    yr, mo = m.groups()
+    return(('19' if yr[0]=='9' else '20')+yr+mo)
+
+
+def load_proposals(filename=None):
+    """Load the ballot propositions table, with a 'Date_str' column of election date keys (e.g. '200811').
+    Args:
+        filename (str): defaults to proposals_file in the data folder
+    """
+    filename = spf.datapath+proposals_file if filename is None else filename
+    proposals = pd.read_excel(filename)
+    proposals['Date_str'] = proposals['Year'].astype(str)+proposals['Month2'].astype(str).str.zfill(2)
+    return(proposals)
+
+
+def make_vote_data(filenames, proposals):
+    """Make the vote_data dictionary: {date: {'filename', 'props': {letter: {}}}} for the elections with propositions.
+    Args:
+        filenames (list): SOV workbooks
+        proposals (DataFrame): from load_proposals
+    """
+    vote_data = {}
+    for f in sorted(filenames):
+        d = election_key(f)
+        if d is None:
+            print('{}: no date in the file name'.format(f))
+            continue
+        letters = list(proposals.loc[proposals['Date_str']==d, 'Letter'])
+        if not letters:
+            continue
+        vote_data[d] = {'filename':f, 'props':dict((p, {}) for p in letters)}
+    return(vote_data)
+
+
+def _tree():
+    return(collections.defaultdict(_tree))
+
+
+def notebook_sheet(filename):
+    """The sheet the notebook used for a workbook whose sheet wasn't picked by hand: the one sheet that
+    find_matching_sheets finds with dpf.hand_sheet_match. None if there isn't exactly one."""
+    with dpf.open_workbook_file(filename) as xl:
+        sheets = dpf.find_matching_sheets(xl, *dpf.hand_sheet_match)
+    return(sheets[0] if len(sheets)==1 else None)
+
+
+def apply_hand_params(vote_data, sov_path=None):
+    """Use the hand-checked parameters of define_excel_params for the propositions that are in vote_data.
+    define_excel_params is run on an empty tree that takes any key, and then each proposition's parameters are
+    copied, so one that isn't in vote_data (e.g. a workbook that's missing) only skips its own parameters.
+    The parameters are column positions, so they're set together with the sheet they were checked on: the one
+    in define_excel_params, or else the one the notebook found (see notebook_sheet). If that sheet isn't known,
+    the catalog's sheet and parameters are kept.
+    Args:
+        vote_data (dict): after apply_catalog
+        sov_path (str): folder of the workbooks. Defaults to the SOV folder in the data folder
+    Returns:
+        dict: vote_data
+    """
+    sov_path = spf.datapath+sov_folder if sov_path is None else sov_path
+    hand = dpf.define_excel_params(_tree())
+    skipped, unchecked, moved = [], [], []
+    sheets = {}
+    for d in hand:
+        for p in hand[d]['props']:
+            checked = hand[d]['props'][p]
+            if 'params' not in checked:
+                continue
+            if d not in vote_data or p not in vote_data[d]['props']:
+                skipped.append(d+p)
+                continue
+            if 's_name' in checked:
+                s_name = checked['s_name']
+            else:
+                if d not in sheets:
+                    filename = sov_path+vote_data[d]['filename']
+                    sheets[d] = notebook_sheet(filename) if os.path.exists(filename) else None
+                s_name = sheets[d]
+            if s_name is None:
+                unchecked.append(d+p)
+                continue
+            record = vote_data[d]['props'][p]
+            if record.get('s_name') not in (None, s_name):
+                moved.append('{}{} ({!r} instead of {!r})'.format(d, p, s_name, record['s_name']))
+            record['s_name'] = s_name
+            record['params'] = checked['params']
+        if d in vote_data:
+            vote_data[d]['sheet_names'] = list(dict.fromkeys(
+                vote_data[d]['props'][p]['s_name'] for p in vote_data[d]['props'] if 's_name' in vote_data[d]['props'][p]))
+    if skipped:
+        print('hand-checked parameters not used, not in the data: {}'.format(', '.join(skipped)))
+    if unchecked:
+        print('WARNING: hand-checked parameters not used, the sheet they were checked on is not known: {}'.format(', '.join(unchecked)))
+    if moved:
+        print('hand-checked sheets used instead of the catalog\'s: {}'.format(', '.join(moved)))
+    return(vote_data)
+
+
+def load_ingested(filename=None):
+    """Load the output of ingest."""
+    filename = dpf.results_path+ingest_file if filename is None else filename
+    if not os.path.exists(filename):
+        raise FileNotFoundError('{} not found, run ingest first'.format(filename))
+    with open(filename, 'rb') as f:
+        return(pickle.load(f))
+
+
+######## STEPS ########
+
+def ingest(n_workers=None, hand_params=True):
+    """Read the proposition results from the SOV workbooks. The sheets and cells come from the catalog (see
+    catalog_functions), and the hand-checked parameters of define_excel_params are used where they apply.
+    Saves ingest_file, and the yes percentages as verify_percentages.csv (see verify_vote_totals).
+    Args:
+        n_workers (int): number of processes to read the workbooks. If None, one after another.
+        hand_params (bool): use define_excel_params (see apply_hand_params). If False, only the catalog is used (e.g. for new workbooks)
+    Returns:
+        dict: vote_data, with the formatted sheets in 'data'
+    """
+    sov_path = spf.datapath+sov_folder
+    filenames = [f for f in os.listdir(sov_path) if f.lower().endswith(('.xls','.xlsx'))]
+    vote_data = make_vote_data(filenames, load_proposals())
+
+    catalog = cf.build_catalog(sov_path, filenames=[vote_data[d]['filename'] for d in vote_data], n_workers=n_workers,
+                               letters=dict((vote_data[d]['filename'], list(vote_data[d]['props'])) for d in vote_data))
+    vote_data = cf.apply_catalog(vote_data, catalog)
+    if hand_params:
+        vote_data = apply_hand_params(vote_data, sov_path)
+
+    errors = {}
+    sheets = dpf.read_all_workbooks(vote_data, sov_path, n_workers=n_workers, errors=errors)
+    for d in list(vote_data.keys()):
+        for p in list(vote_data[d]['props'].keys()):
+            if p in sheets.get(d, {}):
+                vote_data[d]['props'][p]['data'] = dpf.format_vote_sheet(sheets[d][p], d)
+            else:
+                del vote_data[d]['props'][p]
+        if not vote_data[d]['props']:
+            del vote_data[d]
+    os.makedirs(dpf.results_path, exist_ok=True)
+    dpf.verify_vote_totals(vote_data, fname='verify_percentages.csv')
+
+    with open(dpf.results_path+ingest_file, 'wb') as f:
+        pickle.dump(vote_data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    print('{} propositions from {} elections, saved as {}'.format(
+        sum(len(vote_data[d]['props']) for d in vote_data), len(vote_data), dpf.results_path+ingest_file))
+    return(vote_data)
+
+
+def crosswalk(n_workers=None, method=None):
+    """Make the precinct x block group crosswalks, and interpolate the census data to precincts for each
+    census/precinct key (saved in data_by_precinct, see save_census_data).
+    Args:
+        n_workers (int): number of processes for the intersections. Defaults to the number of cpus.
+        method (str): 'blocks' or 'area', see census_by_precinct. Defaults to spf.interpolation_method
+    Returns:
+        dict: {census key: census data by precinct}
+    """
+    spf.get_crosswalks(sorted(set(spf.census2bg_key.values())), n_workers=n_workers)
+    os.makedirs(spf.resultspath+'data_by_precinct/', exist_ok=True)
+    census = {}
+    for census_key in spf.census2bg_key.keys():
+        print('\n', census_key)
+        census[census_key] = spf.census_by_precinct(census_key, method=method)
+        spf.save_census_data(census[census_key], census_key)
+    return(census)
+
+
+def merge(n_workers=None):
+    """Process the ingested elections (see pipeline_functions), merge them with the census data and combine them.
+    Saves voting_data_all_<date>.csv like the notebook, and combined_folder for export.
+    Args:
+        n_workers (int): number of processes for the propositions. If None, one after another.
+    Returns:
+        DataFrame: all the data
+    """
+    vote_data = load_ingested()
+    data = pf.run_vote_pipeline(vote_data, n_workers=n_workers, df_prop=load_proposals())
+    all_data = dpf.rename_columns(dpf.combine_dataframes(data))
+    vf.validate(all_data)
+
+    filename = dpf.results_path+'voting_data_all_{}.csv'.format(date.today().strftime('%m%d%Y'))
+    all_data.to_csv(filename, index=False)
+    dpf.write_partitioned(all_data, dpf.results_path+combined_folder)
+    print('saved as {} and {}'.format(filename, dpf.results_path+combined_folder))
+    return(all_data)
+
+
+def export(topojson=False, simplify=None):
+    """Write the map files from the output of merge (see export_maps).
+    Args:
+        topojson (bool): write TopoJSON instead of GeoJSON
+        simplify (float): simplification tolerance, see export_geojson and export_topojson
+    Returns:
+        list: names of files written
+    """
+    path = dpf.results_path+combined_folder
+    if not os.path.exists(path):
+        raise FileNotFoundError('{} not found, run merge first'.format(path))
+    all_data = dpf.read_partitioned(path)
+    os.makedirs(mef.mapspath, exist_ok=True)
+    return(mef.export_maps(all_data, topojson=topojson, simplify=simplify))
+
+
+def main(argv=None):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--data-root', help="folder with the original data (default '../data/')")
+    common.add_argument('--results-root', help="folder for the results (default '../results/')")
+    common.add_argument('--cache-dir', help="folder for the caches (default the 'cache' folder in the results)")
+    common.add_argument('--workers', type=int, help='number of worker processes')
+
+    parser = argparse.ArgumentParser(description='Run the SF voting data pipeline.')
+    steps = parser.add_subparsers(dest='step', required=True)
+    p = steps.add_parser('ingest', parents=[common], help='read the SOV workbooks')
+    p.add_argument('--catalog-only', action='store_true', help="don't use the hand-checked excel parameters")
+    p = steps.add_parser('crosswalk', parents=[common], help='make the crosswalks and the census data by precinct')
+    p.add_argument('--method', choices=['blocks','area'], help='how to interpolate the census data')
+    steps.add_parser('merge', parents=[common], help='process, merge and combine the election data')
+    p = steps.add_parser('export', parents=[common], help='write the map files')
+    p.add_argument('--topojson', action='store_true', help='write TopoJSON instead of GeoJSON')
+    p.add_argument('--simplify', type=float, help='simplification tolerance')
+    args = parser.parse_args(argv)
+
+    set_paths(args.data_root, args.results_root, args.cache_dir)
+    if args.step=='ingest':
+        return(ingest(n_workers=args.workers, hand_params=not args.catalog_only))
+    elif args.step=='crosswalk':
+        return(crosswalk(n_workers=args.workers, method=args.method))
+    elif args.step=='merge':
+        return(merge(n_workers=args.workers))
+    else:
+        return(export(topojson=args.topojson, simplify=args.simplify))
+
+
+if __name__ == '__main__':
+    main()
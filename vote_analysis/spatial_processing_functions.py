@@ -2,22 +2,54 @@
 
 This module contains the functions needed for processing the census geography and SF precinct data. 
 
+geopandas, shapely and scipy are imported in the functions that use them, so loading census data 
+(load_census_data, get_vars_to_use) doesn't need them. 
+
 """
 
-from geopandas import GeoDataFrame, read_file
-from geopandas.tools import overlay
 import pandas as pd
+import numpy as np
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import glob
+import os
+
+import instrument_functions as inst
+
+datapath = os.environ.get('VOTE_DATA_ROOT', '../data/')
+""" path to original data. Can be set with the VOTE_DATA_ROOT environment variable (see run_pipeline.set_paths). """
+
+resultspath = os.environ.get('VOTE_RESULTS_ROOT', '../results/')
+""" path to any results data that was already collected. Can be set with VOTE_RESULTS_ROOT. """
+
+crosswalkpath = resultspath+'crosswalks/'
+""" path to cached precinct x block group crosswalks """
+
+crosswalk_cols = ['precname','geoid','intersect_area','area_m']
+""" columns of the precinct x block group crosswalk that are used downstream """
 
-datapath='../data/'
-""" path to original data """
+interpolation_method = 'blocks'
+""" how census data is interpolated to precincts: 'blocks' (by the population of the census blocks in each precinct, 
+where there's a block file for the block group year) or 'area' (by area). See census_by_precinct. """
 
-resultspath = '../results/'
-""" path to any results data that was already collected """
+block_weight_col = 'pop'
+""" block column used for the 'blocks' weights: 'pop' or 'housing' """
+
+census2bg_key = {'ce2000pre1992':'bg2000pre1992','ce2000pre2002':'bg2000pre2002','ce2007pre2002':'bg2000pre2002','ce2012pre2012':'bg2010pre2012'}
+""" block group/precinct crosswalk to use for each census/precinct combination """
+
+
+def prec_shp_filename(p_yr):
+    """Get name of precinct boundary file, given a year."""
+    return('spatial/Precincts_{}/Precincts_{}.shp'.format(p_yr, p_yr))
 
 
 def load_prec_shp(p_yr):
     """Load precinct boundary files, given a year."""
-    filename = 'spatial/Precincts_{}/Precincts_{}.shp'.format(p_yr, p_yr)
+    from geopandas import read_file
+
+    filename = prec_shp_filename(p_yr)
     pre_df = read_file(datapath+filename)
     
     # For some reason, the 1992 shapefile has one row with a precname and no geom. After mapping it, 
@@ -40,6 +72,18 @@ def reproject_prec(pre_df, new_crs='epsg:26910'):
     return(pre_df)
 
 
+def bg_shp_filename(bg_yr):
+    """Get name of block group boundary file, given a bg/census year."""
+    if bg_yr == '2010':
+        filename = 'spatial/tl_2010_06075_bg10/tl_2010_06075_bg10.shp'  # shapefile for SF block groups as defined in 2010
+    elif bg_yr =='2000':
+        filename = 'spatial/tl_2009_06075_bg00/tl_2009_06075_bg00.shp'
+    else: 
+        print('bg boundaries not available')
+        filename = None
+    return(filename)
+
+
 def load_bg_shp(bg_yr, new_crs='epsg:26910'):
     """Load block group boundaries
     Args: 
@@ -48,13 +92,9 @@ def load_bg_shp(bg_yr, new_crs='epsg:26910'):
     Returns: 
         DataFrame: block group boundaries
     """
+    from geopandas import read_file
 
-    if bg_yr == '2010':
-        filename = 'spatial/tl_2010_06075_bg10/tl_2010_06075_bg10.shp'  # shapefile for SF block groups as defined in 2010
-    elif bg_yr =='2000':
-        filename = 'spatial/tl_2009_06075_bg00/tl_2009_06075_bg00.shp'
-    else: 
-        print('bg boundaries not available')
+    filename = bg_shp_filename(bg_yr)
     bg_df = read_file(datapath+filename)
     
     # convert GEOID to string for merging later
@@ -75,34 +115,522 @@ def load_bg_shp(bg_yr, new_crs='epsg:26910'):
 
 
 
-def merge_precinct_bg(pre_df, bg_df, yr_name):
+def valid_geometries(geoms):
+    """Geometries as a shapely array, with invalid ones made valid (like overlay does)."""
+    import shapely
+
+    arr = np.asarray(geoms.values if hasattr(geoms, 'values') else geoms, dtype=object)
+    invalid = ~shapely.is_valid(arr)
+    if invalid.any():
+        arr = arr.copy()
+        arr[invalid] = shapely.make_valid(arr[invalid])
+    return(arr)
+
+
+def pair_areas(pre_geoms, bg_geoms):
+    """Intersection areas of all overlapping pairs of two arrays of (valid) geometries. See intersect_areas.
+    Returns: 
+        array: index of each pair's precinct
+        array: index of each pair's block group
+        array: intersection area, > 0
+    """
+    import shapely
+
+    tree = shapely.STRtree(bg_geoms)
+    pre_idx, bg_idx = tree.query(pre_geoms, predicate='intersects')
+    a = pre_geoms[pre_idx]
+    b = bg_geoms[bg_idx]
+
+    area = np.full(len(pre_idx), np.nan)
+    shapely.prepare(pre_geoms)
+    inside = shapely.covers(a, b)  # block group inside the precinct
+    area[inside] = shapely.area(b[inside])
+    rest = np.flatnonzero(~inside)
+    shapely.prepare(bg_geoms)
+    around = shapely.covers(b[rest], a[rest])  # precinct inside the block group
+    area[rest[around]] = shapely.area(a[rest[around]])
+    rest = rest[~around]
+    # pairs that only touch along an edge or at a point have no area (overlay leaves them out too)
+    touch = shapely.touches(a[rest], b[rest])
+    area[rest[touch]] = 0
+    rest = rest[~touch]
+    area[rest] = shapely.area(shapely.intersection(a[rest], b[rest]))
+    shapely.destroy_prepared(pre_geoms)
+    shapely.destroy_prepared(bg_geoms)
+
+    keep = area>0
+    return(pre_idx[keep], bg_idx[keep], area[keep])
+
+
+def pairs_frame(pre_df, bg_df, pre_idx, bg_idx, area, pre_cols, bg_cols):
+    """Table of intersecting pairs, with the columns to keep from each side and intersect_area."""
+    df = pd.concat([pd.DataFrame(pre_df[pre_cols]).iloc[pre_idx].reset_index(drop=True), 
+                    pd.DataFrame(bg_df[bg_cols]).iloc[bg_idx].reset_index(drop=True)], axis=1)
+    df['intersect_area'] = area
+    return(df)
+
+
+def check_crs(pre_df, bg_df):
+    """Make sure both sets of boundaries are in the same crs."""
+    if pre_df.crs != bg_df.crs:
+        raise ValueError('precincts and block groups have different crs: {} and {}'.format(pre_df.crs, bg_df.crs))
+    return()
+
+
+@inst.tracked
+def intersect_areas(pre_df, bg_df, pre_cols=['precname'], bg_cols=['geoid']):
+    """Area of the intersection of each precinct and block group, without building the intersected geometries 
+    (the same areas as overlay(pre_df, bg_df, how="intersection").geometry.area). 
+    Candidate pairs come from one bulk query of the block group spatial index. Block groups inside a precinct 
+    (and precincts inside a block group) just use their own area; only the pairs that cross are intersected. 
+    Args: 
+        pre_df (geoDataFrame): precincts
+        bg_df (geoDataFrame): block groups, in the same crs
+        pre_cols, bg_cols (list): columns to keep from each
+    Returns: 
+        DataFrame: precname, geoid and intersect_area, one row per pair that overlaps
+    """
+    check_crs(pre_df, bg_df)
+    pre_idx, bg_idx, area = pair_areas(valid_geometries(pre_df.geometry), valid_geometries(bg_df.geometry))
+    return(pairs_frame(pre_df, bg_df, pre_idx, bg_idx, area, pre_cols, bg_cols))
+
+
+######## PARALLEL INTERSECTION ########
+
+def pack_wkb(geoms):
+    """Pack geometries into one WKB buffer, to send to a worker process (much cheaper to pickle than the geometries).
+    Returns: 
+        bytes: WKB of all the geometries, one after the other
+        array: offset of each geometry in the buffer, plus the end
+    """
+    import shapely
+
+    wkb = shapely.to_wkb(geoms)
+    lengths = np.fromiter((len(w) for w in wkb), dtype=np.int64, count=len(wkb))
+    return(b''.join(wkb), np.concatenate([[0], np.cumsum(lengths)]))
+
+
+def unpack_wkb(buf, offsets):
+    """Geometries from a buffer made by pack_wkb."""
+    import shapely
+
+    view = memoryview(buf)
+    return(shapely.from_wkb(np.array([view[i:j].tobytes() for i, j in zip(offsets[:-1], offsets[1:])], dtype=object)))
+
+
+def make_tiles(geoms, n_tiles):
+    """Split geometries into about n_tiles spatial partitions with about the same number of geometries: 
+    columns by the x of their bounding box center, then rows within each column by y. 
+    Each geometry is in exactly one tile, even if it crosses the tile edges. 
+    Returns: 
+        list: array of geometry indices for each tile
+    """
+    import shapely
+
+    bounds = shapely.bounds(geoms)
+    cx = (bounds[:,0]+bounds[:,2])/2
+    cy = (bounds[:,1]+bounds[:,3])/2
+    nx = max(1, int(np.ceil(np.sqrt(n_tiles))))
+    ny = max(1, int(np.ceil(n_tiles/nx)))
+    tiles = []
+    for col in np.array_split(np.argsort(cx, kind='stable'), nx):
+        for tile in np.array_split(col[np.argsort(cy[col], kind='stable')], ny):
+            if len(tile):
+                tiles.append(np.sort(tile))
+    return(tiles)
+
+
+def tile_pair_areas(pre_buf, pre_offsets, bg_buf, bg_offsets):
+    """Intersection areas for one tile, in a worker process. Geometries are passed as WKB (see pack_wkb). 
+    Returns the same as pair_areas, with indices into the tile's geometries."""
+    return(pair_areas(unpack_wkb(pre_buf, pre_offsets), unpack_wkb(bg_buf, bg_offsets)))
+
+
+def submit_tiles(pool, pre_geoms, bg_geoms, n_tiles):
+    """Send the tiles of one pair of boundaries to a process pool. 
+    Each tile has the precincts assigned to it (see make_tiles) and every block group that reaches into their 
+    bounding box, so each precinct's pairs are all calculated in exactly one tile: no pair is lost or counted twice. 
+    Returns: 
+        list: (precinct indices, block group indices, future) for each tile
+    """
+    import shapely
+
+    bg_tree = shapely.STRtree(bg_geoms)
+    tasks = []
+    for pre_ids in make_tiles(pre_geoms, n_tiles):
+        bg_ids = np.sort(bg_tree.query(shapely.box(*shapely.total_bounds(pre_geoms[pre_ids]))))
+        if len(bg_ids)==0:
+            continue
+        future = pool.submit(tile_pair_areas, *pack_wkb(pre_geoms[pre_ids]), *pack_wkb(bg_geoms[bg_ids]))
+        tasks.append((pre_ids, bg_ids, future))
+    return(tasks)
+
+
+def collect_tiles(tasks):
+    """Merge the tile results from submit_tiles into one set of pairs (in the original indices), sorted by precinct."""
+    results = [(pre_ids[i], bg_ids[j], area) for pre_ids, bg_ids, future in tasks for i, j, area in [future.result()]]
+    if not results:
+        return(np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=float))
+    pre_idx, bg_idx, area = (np.concatenate(x) for x in zip(*results))
+    order = np.lexsort((bg_idx, pre_idx))
+    return(pre_idx[order], bg_idx[order], area[order])
+
+
+@inst.tracked
+def parallel_intersect_areas(boundaries, n_workers=None, tiles_per_worker=4, pre_cols=['precname'], bg_cols=['geoid']):
+    """Intersection areas for one or more pairs of precinct and block group boundaries, on a process pool. 
+    Each pair is split into spatial tiles (see submit_tiles), and the tiles of all the pairs run on the same pool. 
+    Gives the same table as intersect_areas for each pair. 
+    Args: 
+        boundaries (dict): {yr_key: (pre_df, bg_df)}
+        n_workers (int): number of processes. Defaults to the number of cpus.
+        tiles_per_worker (int): tiles per pair of boundaries for each worker (more tiles balance the load better)
+        pre_cols, bg_cols (list): columns to keep from each
+    Returns: 
+        dict: {yr_key: DataFrame with precname, geoid and intersect_area}
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    geoms = {}
+    for yr_key, (pre_df, bg_df) in boundaries.items():
+        check_crs(pre_df, bg_df)
+        geoms[yr_key] = (valid_geometries(pre_df.geometry), valid_geometries(bg_df.geometry))
+
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        tasks = dict((yr_key, submit_tiles(pool, pre_geoms, bg_geoms, n_workers*tiles_per_worker)) 
+                     for yr_key, (pre_geoms, bg_geoms) in geoms.items())
+        results = {}
+        for yr_key, (pre_df, bg_df) in boundaries.items():
+            pre_idx, bg_idx, area = collect_tiles(tasks[yr_key])
+            results[yr_key] = pairs_frame(pre_df, bg_df, pre_idx, bg_idx, area, pre_cols, bg_cols)
+    return(results)
+
+
+@inst.tracked
+def merge_precinct_bg(pre_df, bg_df, yr_name, engine='overlay', n_workers=None):
     """Merge block group boundaries with precinct. (Might take a few minutes.)
     Args: 
         pre_df (geoDataFrame): precinct 
         bg_df (geoDataFrame): block groups
         yr_name (str): year
+        engine (str): 'overlay' keeps the intersected geometries and all columns. 'strtree' only calculates the 
+            areas (see intersect_areas), which is much faster, and returns precname, the precinct area_m, geoid 
+            and intersect_area. 'parallel' does the same on a process pool (see parallel_intersect_areas).
+        n_workers (int): number of processes for the 'parallel' engine
     Returns: 
         DataFrame: merged block group boundaries and precinct. 
     """
+    from geopandas.tools import overlay
 
-    print('working on intersection for year {}'.format(yr_name))
-    newdf = overlay(pre_df, bg_df, how="intersection")
-    # intersection has both precinct and block group IDs. 
-    #newdf.head()
-    # create a field with the area, will later divide by the total precinct area
-    newdf['intersect_area']=newdf.geometry.area
-    
-    # drop the unneeded columns to clean up
-    try:
-        cols_to_drop = ['BLKGRPCE10', 'COUNTYFP10', 'FUNCSTAT10', 'INTPTLAT10', 'INTPTLON10', 'MTFCC10','NAMELSAD10', 'STATEFP10']
-        newdf = newdf.drop(cols_to_drop, axis=1)
-    except ValueError:
-        print('cols not present')
-    print(newdf.columns)
-    print('New df has {} precincts'.format(len(pre_df.precname.unique())))  # just checking how many precincts. 
+    inst.report('merge_precinct_bg', 'working on intersection for year {}'.format(yr_name), yr_name=yr_name, step='start')
+    if engine in ['strtree','parallel']:
+        if 'area_m' not in pre_df.columns:
+            pre_df = pre_df.assign(area_m=pre_df.geometry.area)
+        if engine=='strtree':
+            newdf = intersect_areas(pre_df, bg_df, pre_cols=['precname','area_m'])
+        else:
+            newdf = parallel_intersect_areas({yr_name:(pre_df, bg_df)}, n_workers=n_workers, pre_cols=['precname','area_m'])[yr_name]
+    elif engine=='overlay':
+        newdf = overlay(pre_df, bg_df, how="intersection")
+        # intersection has both precinct and block group IDs. 
+        #newdf.head()
+        # create a field with the area, will later divide by the total precinct area
+        newdf['intersect_area']=newdf.geometry.area
+        
+        # drop the unneeded columns to clean up
+        try:
+            cols_to_drop = ['BLKGRPCE10', 'COUNTYFP10', 'FUNCSTAT10', 'INTPTLAT10', 'INTPTLON10', 'MTFCC10','NAMELSAD10', 'STATEFP10']
+            newdf = newdf.drop(cols_to_drop, axis=1)
+        except (KeyError, ValueError):  # newer pandas raises KeyError
+            print('cols not present')
+    else:
+        raise ValueError("engine should be 'overlay', 'strtree' or 'parallel', not {}".format(engine))
+    n_prec = len(pre_df.precname.unique())  # just checking how many precincts. 
+    inst.report('merge_precinct_bg', '{}\nNew df has {} precincts'.format(newdf.columns, n_prec), 
+        yr_name=yr_name, step='done', columns=list(newdf.columns), precincts=n_prec, rows=len(newdf))
     
     return(newdf)
 
+def hash_shapefile(filename):
+    """Hash the contents of a shapefile and its sidecar files (.shx, .dbf, .prj, ...).
+    Args: 
+        filename (str): path to the .shp file
+    Returns: 
+        str: hex digest
+    """
+    h = hashlib.sha1()
+    stem = os.path.splitext(filename)[0]
+    for f in sorted(glob.glob(glob.escape(stem)+'.*')):
+        h.update(os.path.basename(f).encode())
+        with open(f, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(1<<20), b''):
+                h.update(chunk)
+    return(h.hexdigest())
+
+
+def crosswalk_key(yr_key, new_crs='epsg:26910'):
+    """Cache key for a precinct x block group crosswalk: a hash of both shapefiles and the crs. 
+    Args: 
+        yr_key (str): block group and precinct years, e.g. 'bg2000pre1992'
+        new_crs (str): crs the areas are calculated in
+    Returns: 
+        str: hex digest
+    """
+    h = hashlib.sha1()
+    h.update(hash_shapefile(datapath+bg_shp_filename(yr_key[2:6])).encode())
+    h.update(hash_shapefile(datapath+prec_shp_filename(yr_key[9:13])).encode())
+    h.update(new_crs.lower().encode())
+    return(h.hexdigest())
+
+
+def make_crosswalk(newdf):
+    """Keep only the crosswalk columns from the intersection made by merge_precinct_bg. 
+    Args: 
+        newdf (DataFrame): intersected block groups and precincts
+    Returns: 
+        DataFrame: precname, geoid, intersect_area and area_m
+    """
+    # both inputs have an area_m column. When they get suffixed, the precinct (first) one is area_m_1.
+    if 'area_m' not in newdf.columns:
+        newdf = newdf.rename(columns={'area_m_1':'area_m'})
+    xwalk = pd.DataFrame(newdf[crosswalk_cols])
+    xwalk['precname'] = xwalk['precname'].astype(str)
+    xwalk['geoid'] = xwalk['geoid'].astype(str)
+    xwalk = xwalk.reset_index(drop=True)
+    return(xwalk)
+
+
+def crosswalk_filename(yr_key, new_crs='epsg:26910'):
+    """Name of the saved crosswalk for a pair of boundary years, with the key of the current shapefiles."""
+    key = crosswalk_key(yr_key, new_crs)
+    return(crosswalkpath+'{}_{}.parquet'.format(yr_key, key[:16]))
+
+
+def load_boundaries(yr_key, new_crs='epsg:26910'):
+    """Load and reproject the precinct and block group boundaries for a crosswalk key, e.g. 'bg2000pre1992'."""
+    bgs = load_bg_shp(yr_key[2:6], new_crs=new_crs)
+    precincts = load_prec_shp(yr_key[9:13])
+    precincts = reproject_prec(precincts, new_crs=new_crs)
+    return(precincts, bgs)
+
+
+def save_crosswalk(xwalk, yr_key, filename):
+    """Save a crosswalk, removing tables for older versions of the shapefiles."""
+    os.makedirs(crosswalkpath, exist_ok=True)
+    # the name ends with '_' and 16 characters of the key (see crosswalk_filename and block_crosswalk_filename)
+    prefix = filename[:-len('.parquet')-17]
+    for f in glob.glob(glob.escape(prefix)+'_'+'?'*16+'.parquet'):
+        os.remove(f)
+    tmp = filename+'.tmp'
+    xwalk.to_parquet(tmp, index=False)
+    os.replace(tmp, filename)
+    print('saved crosswalk as '+filename)
+    return()
+
+
+@inst.tracked
+def get_crosswalk(yr_key, new_crs='epsg:26910', use_cache=True, engine='strtree', n_workers=None):
+    """Get the precinct x block group area crosswalk for a pair of boundary years. 
+    It's computed once (with merge_precinct_bg) and saved as parquet in crosswalkpath, keyed by a hash 
+    of the input shapefiles and the crs. Later calls just load the saved table. 
+    Args: 
+        yr_key (str): block group and precinct years, e.g. 'bg2000pre1992', 'bg2000pre2002', 'bg2010pre2012'
+        new_crs (str): crs to calculate areas in
+        use_cache (bool): if False, always recompute (and overwrite the cached table)
+        engine (str): how to calculate the intersections, see merge_precinct_bg
+        n_workers (int): number of processes for the 'parallel' engine
+    Returns: 
+        DataFrame: precname, geoid, intersect_area and area_m
+    """
+    filename = crosswalk_filename(yr_key, new_crs)
+    if use_cache and os.path.exists(filename):
+        return(pd.read_parquet(filename))
+
+    precincts, bgs = load_boundaries(yr_key, new_crs=new_crs)
+    xwalk = make_crosswalk(merge_precinct_bg(precincts, bgs, yr_key, engine=engine, n_workers=n_workers))
+    save_crosswalk(xwalk, yr_key, filename)
+    return(xwalk)
+
+
+@inst.tracked
+def get_crosswalks(yr_keys, new_crs='epsg:26910', use_cache=True, n_workers=None):
+    """Get the crosswalks for several pairs of boundary years (like the bgXprec loop in precincts-join-census), 
+    computing the missing ones together on one process pool (see parallel_intersect_areas). 
+    Args: 
+        yr_keys (list): block group and precinct years, e.g. ['bg2000pre1992', 'bg2000pre2002', 'bg2010pre2012']
+        new_crs (str): crs to calculate areas in
+        use_cache (bool): if False, always recompute (and overwrite the cached tables)
+        n_workers (int): number of processes. Defaults to the number of cpus.
+    Returns: 
+        dict: {yr_key: DataFrame with precname, geoid, intersect_area and area_m}
+    """
+    filenames = dict((yr_key, crosswalk_filename(yr_key, new_crs)) for yr_key in yr_keys)
+    xwalks = {}
+    boundaries = {}
+    for yr_key in yr_keys:
+        if use_cache and os.path.exists(filenames[yr_key]):
+            xwalks[yr_key] = pd.read_parquet(filenames[yr_key])
+        else:
+            precincts, bgs = load_boundaries(yr_key, new_crs=new_crs)
+            if 'area_m' not in precincts.columns:
+                precincts['area_m'] = precincts.geometry.area
+            boundaries[yr_key] = (precincts, bgs)
+
+    if boundaries:
+        areas = parallel_intersect_areas(boundaries, n_workers=n_workers, pre_cols=['precname','area_m'])
+        for yr_key in boundaries.keys():
+            xwalks[yr_key] = make_crosswalk(areas[yr_key])
+            save_crosswalk(xwalks[yr_key], yr_key, filenames[yr_key])
+    return(dict((yr_key, xwalks[yr_key]) for yr_key in yr_keys))
+
+
+######## BLOCK WEIGHTS ########
+
+def block_shp_filename(bg_yr):
+    """Get name of the census block file (with population and housing units), given a bg/census year."""
+    if bg_yr == '2010':
+        filename = 'spatial/tabblock2010_06_pophu/tabblock2010_06_pophu.shp'  # CA blocks with 2010 population and housing units
+    else: 
+        print('block boundaries not available for {}'.format(bg_yr))
+        filename = None
+    return(filename)
+
+
+def load_block_shp(bg_yr, new_crs='epsg:26910'):
+    """Load census blocks as points, with their population and housing units. 
+    Args: 
+        bg_yr (str): bg/census year 
+        new_crs (str): desired reprojected crs
+    Returns: 
+        geoDataFrame: geoid (block), bg_geoid (the block group it's in), pop, housing, and a point inside each block
+    """
+    from geopandas import read_file
+    import shapely
+
+    filename = block_shp_filename(bg_yr)
+    blocks = read_file(datapath+filename)
+    blocks = blocks.rename(columns={'BLOCKID10':'geoid','POP10':'pop','HOUSING10':'housing'})
+    blocks['geoid'] = blocks['geoid'].astype(str)
+    blocks = blocks[blocks['geoid'].str.startswith('06075')]  # the state file: only keep SF
+    # block geoids are the block group geoid and 3 more digits
+    blocks['bg_geoid'] = blocks['geoid'].str[:12]
+    blocks = blocks.to_crs(new_crs)
+    blocks = blocks.set_geometry(shapely.point_on_surface(valid_geometries(blocks.geometry)))
+    print('Year {}: total {} blocks'.format(bg_yr, len(blocks)))
+    return(blocks[['geoid','bg_geoid','pop','housing','geometry']].reset_index(drop=True))
+
+
+def assign_blocks(pre_geoms, points):
+    """Find the precinct each block point is in, with one bulk query of the precinct spatial index. 
+    A point on the boundary between precincts goes to the one with the lowest index, whatever order the 
+    index returns them in. 
+    Returns: 
+        array: index of each block that's in a precinct
+        array: index of its precinct
+    """
+    import shapely
+
+    tree = shapely.STRtree(pre_geoms)
+    block_idx, pre_idx = tree.query(points, predicate='intersects')
+    order = np.lexsort((pre_idx, block_idx))
+    block_idx, pre_idx = block_idx[order], pre_idx[order]
+    block_idx, first = np.unique(block_idx, return_index=True)
+    return(block_idx, pre_idx[first])
+
+
+@inst.tracked
+def block_crosswalk(pre_df, blocks, weight_col='pop', fallback=None):
+    """Precinct x block group crosswalk weighted by the census blocks in each precinct, instead of by area: 
+    the weight of a block group in a precinct is the share of the precinct's population (or housing units) 
+    that lives in the blocks of that block group. So parks, water and empty land don't count. 
+    It has the same columns as the area crosswalk, with intersect_area = weight * area_m, so it works with 
+    make_weight_matrix and calc_variables, and area_m is still the area of the precinct. 
+    Args: 
+        pre_df (geoDataFrame): precincts, with precname and area_m
+        blocks (geoDataFrame): block points (or polygons, which use a point inside each one) in the same crs, 
+            with bg_geoid and weight_col (see load_block_shp)
+        weight_col (str): column to weight by, e.g. 'pop' or 'housing'
+        fallback (DataFrame): area crosswalk (see get_crosswalk) to use for precincts with no blocks 
+            or no population in them. If None, those precincts are left out.
+    Returns: 
+        DataFrame: precname, geoid, intersect_area, area_m and the weight_col total of each pair
+    """
+    import shapely
+
+    check_crs(pre_df, blocks)
+    points = valid_geometries(blocks.geometry)
+    polygons = ~np.isin(shapely.get_type_id(points), [0, 4])  # not points or multipoints
+    if polygons.any():
+        points = points.copy()
+        points[polygons] = shapely.point_on_surface(points[polygons])
+    block_idx, pre_idx = assign_blocks(valid_geometries(pre_df.geometry), points)
+
+    pairs = pd.DataFrame({'precname':pre_df['precname'].astype(str).to_numpy()[pre_idx], 
+                          'geoid':blocks['bg_geoid'].astype(str).to_numpy()[block_idx], 
+                          weight_col:pd.to_numeric(blocks[weight_col], errors='coerce').fillna(0).to_numpy(dtype=float)[block_idx]})
+    pairs = pairs.groupby(['precname','geoid'], sort=False)[weight_col].sum().reset_index()
+    total = pairs.groupby('precname', sort=False)[weight_col].transform('sum')
+    pairs = pairs[(total>0).to_numpy()]
+    total = total[total>0]
+
+    area_m = pre_df.groupby(pre_df['precname'].astype(str))['area_m'].first()
+    pairs['area_m'] = area_m.reindex(pairs['precname']).to_numpy()
+    pairs['intersect_area'] = pairs[weight_col]/total*pairs['area_m']
+    xwalk = pairs[crosswalk_cols+[weight_col]]
+
+    missing = area_m.index.difference(pairs['precname'].unique())
+    if len(missing):
+        if fallback is not None:
+            rows = pd.DataFrame(fallback[crosswalk_cols])
+            rows = rows[rows['precname'].astype(str).isin(missing)]
+            xwalk = pd.concat([xwalk, rows.assign(**{weight_col:np.nan})], ignore_index=True)
+            print('{} precincts with no {} use area weights'.format(len(missing), weight_col))
+        else:
+            print('{} precincts with no {} are left out'.format(len(missing), weight_col))
+    return(xwalk.reset_index(drop=True))
+
+
+def block_crosswalk_filename(yr_key, weight_col='pop', new_crs='epsg:26910'):
+    """Name of the saved block crosswalk for a pair of boundary years, with a hash of the block, block group and 
+    precinct shapefiles (the block group ones are used for the fallback), the weight and the crs."""
+    h = hashlib.sha1()
+    h.update(crosswalk_key(yr_key, new_crs).encode())
+    h.update(hash_shapefile(datapath+block_shp_filename(yr_key[2:6])).encode())
+    h.update(weight_col.encode())
+    return(crosswalkpath+'{}_blocks_{}_{}.parquet'.format(yr_key, weight_col, h.hexdigest()[:16]))
+
+
+def has_blocks(bg_yr):
+    """Whether there's a block file for a bg/census year."""
+    filename = block_shp_filename(bg_yr)
+    return(filename is not None and os.path.exists(datapath+filename))
+
+
+@inst.tracked
+def get_block_crosswalk(yr_key, weight_col=None, new_crs='epsg:26910', use_cache=True):
+    """Get the block-weighted precinct x block group crosswalk for a pair of boundary years (see block_crosswalk), 
+    with the area crosswalk for precincts that have no population. Saved in crosswalkpath like get_crosswalk. 
+    Args: 
+        yr_key (str): block group and precinct years, e.g. 'bg2010pre2012'. There has to be a block file for the 
+            block group year (see block_shp_filename).
+        weight_col (str): 'pop' or 'housing'. Defaults to block_weight_col
+        new_crs (str): crs to calculate areas in
+        use_cache (bool): if False, always recompute (and overwrite the cached table)
+    Returns: 
+        DataFrame: precname, geoid, intersect_area, area_m and weight_col
+    """
+    weight_col = block_weight_col if weight_col is None else weight_col
+    filename = block_crosswalk_filename(yr_key, weight_col, new_crs)
+    if use_cache and os.path.exists(filename):
+        return(pd.read_parquet(filename))
+
+    precincts = reproject_prec(load_prec_shp(yr_key[9:13]), new_crs=new_crs)
+    blocks = load_block_shp(yr_key[2:6], new_crs=new_crs)
+    xwalk = block_crosswalk(precincts, blocks, weight_col, fallback=get_crosswalk(yr_key, new_crs=new_crs, use_cache=use_cache))
+    save_crosswalk(xwalk, yr_key, filename)
+    return(xwalk)
+
+
 def make_geoid_field(df):
     """Make correctly formatted geoid string column in census dataframe
     Args: 
@@ -144,6 +672,7 @@ def get_vars_to_use():
     return(list(vars_df[vars_df['use_in_final']=='yes']['name']))
 
 
+@inst.tracked
 def calc_variables(df, var_list):
     """Calculate area-weighted values for variables. 
     Formula: x_pre=A_intersect1 / A_pre * x_bg1 +  A_intersect2 / A_pre * x_bg2
@@ -160,10 +689,11 @@ def calc_variables(df, var_list):
     return(df)
 
 
+@inst.tracked
 def agg_vars_by_prec(df):
     """Aggregate back together by precinct 'precname' and check results."""
 
-    df_grouped = df.groupby(by='precname').sum()
+    df_grouped = df.groupby(by='precname').sum(numeric_only=True)
     # check if area totals are correct. They should be about 1. 
     print("Sum >1.1 or <.97:\n", df_grouped[(df_grouped.prop_area >1.1)|(df_grouped.prop_area <.97)]['prop_area'])
     return(df_grouped)
@@ -185,4 +715,119 @@ def rename_wgt_cols(df, var_list):
     df.columns = new_cols
     return(df)
 
-    
+
+WeightMatrix = namedtuple('WeightMatrix', ['matrix','precnames','geoids','area_m'])
+""" Sparse precinct x block group matrix of area weights (intersect_area / area_m), with its row and column labels
+and the area of each precinct. """
+
+
+@inst.tracked
+def make_weight_matrix(xwalk):
+    """Make the sparse precinct x block group weight matrix from a crosswalk. 
+    Args: 
+        xwalk (DataFrame): crosswalk with precname, geoid, intersect_area and area_m (see get_crosswalk)
+    Returns: 
+        WeightMatrix: weights, rows are precincts and columns are block groups
+    """
+    from scipy import sparse
+
+    prec_codes, precnames = pd.factorize(xwalk['precname'], sort=True)
+    bg_codes, geoids = pd.factorize(xwalk['geoid'], sort=True)
+    wgt = (xwalk['intersect_area']/xwalk['area_m']).to_numpy(dtype=float)
+    # any repeated precinct/block group pairs are summed
+    W = sparse.csr_matrix((wgt, (prec_codes, bg_codes)), shape=(len(precnames), len(geoids)))
+    area_m = xwalk.groupby('precname')['area_m'].first().reindex(precnames).to_numpy(dtype=float)
+    return(WeightMatrix(W, pd.Index(precnames, name='precname'), pd.Index(geoids, name='geoid'), area_m))
+
+
+_weight_matrices = {}
+
+def weight_method(bg_key, method=None):
+    """The interpolation method used for a block group/precinct key: method (defaults to interpolation_method), 
+    or 'area' if it's 'blocks' and there's no block file for the block group year."""
+    method = interpolation_method if method is None else method
+    if method == 'blocks' and not has_blocks(bg_key[2:6]):
+        print('{}: no census blocks, using area weights'.format(bg_key))
+        method = 'area'
+    return(method)
+
+
+def get_weight_matrix(bg_key, method=None):
+    """Get the weight matrix for a block group/precinct key, e.g. 'bg2000pre2002'. 
+    It's only made once per session, so census years that share block groups (like ce2000pre2002 and ce2007pre2002) reuse it. 
+    Args: 
+        bg_key (str): block group and precinct years
+        method (str): 'blocks' or 'area'. Defaults to interpolation_method. 'blocks' uses area weights 
+            if there's no block file for the block group year.
+    """
+    method = weight_method(bg_key, method)
+    if (bg_key, method) not in _weight_matrices:
+        xwalk = get_block_crosswalk(bg_key) if method == 'blocks' else get_crosswalk(bg_key)
+        _weight_matrices[(bg_key, method)] = make_weight_matrix(xwalk)
+    return(_weight_matrices[(bg_key, method)])
+
+
+@inst.tracked
+def interpolate_vars(weights, census_df, var_list):
+    """Calculate area-weighted values for all variables at once, as a sparse-dense matrix product. 
+    Gives the same values as calc_variables followed by agg_vars_by_prec. Only block groups that are in the census data 
+    are used (like an inner merge on geoid), and missing census values count as 0. 
+    Args: 
+        weights (WeightMatrix): precinct x block group weights, from make_weight_matrix or get_weight_matrix
+        census_df (DataFrame): census data by block group, with a 'geoid' column
+        var_list (list): names of variables to calculate
+    Returns: 
+        DataFrame: indexed by precname, with a '_wgt' column for each variable, 'prop_area' (the sum of 
+            the weights, should be about 1) and 'area_m'
+    """
+    census = census_df.drop_duplicates('geoid').set_index('geoid')
+    pos = census.index.get_indexer(weights.geoids)
+    matched = np.flatnonzero(pos>=0)
+
+    W = weights.matrix[:, matched]
+    X = census[var_list].to_numpy(dtype=float)[pos[matched]]
+    X = np.nan_to_num(X, nan=0.0)
+
+    # precincts that don't overlap any block group with census data are left out
+    keep = W.getnnz(axis=1)>0
+    df = pd.DataFrame((W @ X)[keep], index=weights.precnames[keep], columns=[var+'_wgt' for var in var_list])
+    df['prop_area'] = np.asarray(W.sum(axis=1)).ravel()[keep]
+    df['area_m'] = weights.area_m[keep]
+    return(df)
+
+
+def check_prop_area(prop_area, low=.97, high=1.1):
+    """Print precincts where the area weights don't add up to about 1, i.e. where the block groups don't cover 
+    the precinct. Block weights always add up to 1, so for the blocks method this is given the area weights' sum 
+    (see census_by_precinct). 
+    Args: 
+        prop_area (Series): sum of area weights by precinct
+    """
+    print("Sum >{} or <{}:\n".format(high, low), prop_area[(prop_area >high)|(prop_area <low)])
+    return()
+
+
+@inst.tracked
+def census_by_precinct(census_key, var_list=None, method=None):
+    """Interpolate census data to precincts, for a census/precinct key. 
+    Args: 
+        census_key (str): e.g. 'ce2007pre2002'
+        var_list (list): variables to use. Defaults to get_vars_to_use()
+        method (str): 'blocks' (population-weighted, see block_crosswalk) or 'area'. Defaults to interpolation_method
+    Returns: 
+        DataFrame: weighted census variables by precinct (the '_wgt' columns), 'area_m' and 'prop_area' 
+            (kept so it can be checked in the merged data, see validation_functions). prop_area is the sum of the 
+            area weights for either method, since the block weights always add up to 1.
+    """
+    if var_list is None:
+        var_list = get_vars_to_use()
+    census_df = load_census_data(census_key[2:6])
+    bg_key = census2bg_key[census_key]
+    method = weight_method(bg_key, method)
+    df = interpolate_vars(get_weight_matrix(bg_key, method=method), census_df, var_list)
+    if method == 'blocks':
+        # block weights add up to 1 for every precinct with people in it, so check the area coverage instead
+        area = interpolate_vars(get_weight_matrix(bg_key, method='area'), census_df, [])
+        df['prop_area'] = area['prop_area'].reindex(df.index)
+    check_prop_area(df['prop_area'])
+    return(df)
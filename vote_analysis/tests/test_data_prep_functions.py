@@ -0,0 +1,128 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import data_prep_functions as dpf
+
+
+# Expected outputs are those of the original loop versions (get_ballot_type and get_prec_name on each label,
+# df.loc[precinct] = row for each split, and str.strip of 'MAIL' and 'PCT').
+
+DESCRIPTIVE = [
+    'PCT 1101 - Election Day Reporting',
+    'PCT 1101 - Vote By Mail / Absentee Reporting',
+    'PCT 1101/1102 - Election Day Reporting',
+    'PCT 1101/1102 - VBM Reporting',
+    'Pct 2201-MAIL',
+    'PCT 9101 MAIL - Election Day Reporting',
+    'Totals',
+    'Electionwide - Absentee',
+]
+
+NON_DESCRIPTIVE = ['PCT 1101   1', 'PCT 1101   1', 'PCT 1102/1103   2', 'Not a precinct', 'PCT 2201-MAIL   3']
+
+
+def sheet(labels, registered):
+    return(pd.DataFrame({'REG':registered, 'YES':range(len(labels))}, index=pd.Index(labels, dtype=object)))
+
+
+def test_multiindex_descriptive_labels():
+    df = dpf.format_df_to_multiindex(sheet(DESCRIPTIVE, [100]*len(DESCRIPTIVE)), descriptive_labels=True)
+    assert df.index.names==['precinct','type']
+    assert df.index.tolist()==[
+        ('PCT 1101', 'V'), ('PCT 1101', 'A'), ('PCT 1101/1102', 'V'), ('PCT 1101/1102', 'A'),
+        ('Pct 2201', 'A'), ('PCT 9101 MAIL', 'A'), ('Not a precinct', 'V'), ('Not a precinct', 'A')]
+    assert df['YES'].tolist()==list(range(len(DESCRIPTIVE)))
+
+
+def test_multiindex_non_descriptive_labels():
+    # the ballot type comes from registered: 0 or NaN is absentee, more than 0 is election day, otherwise unknown
+    df = dpf.format_df_to_multiindex(sheet(NON_DESCRIPTIVE, [500, 0, np.nan, 12.0, -1]), descriptive_labels=False)
+    assert df.index.get_level_values(0).tolist()==['PCT 1101', 'PCT 1101', 'PCT 1102/1103', 'Not a precinct', 'PCT 2201']
+    types = df.index.get_level_values(1).tolist()
+    assert types[:4]==['V', 'A', 'A', 'V']
+    assert pd.isna(types[4])
+
+
+@pytest.mark.parametrize('descriptive', [True, False])
+def test_multiindex_nan_label_raises(descriptive):
+    with pytest.raises(TypeError):
+        dpf.format_df_to_multiindex(sheet(NON_DESCRIPTIVE[:2]+[np.nan], [1, 0, 1]), descriptive_labels=descriptive)
+
+
+@pytest.mark.parametrize('registered', [[500, 'x', 0, 1, 1], [500, '0', 0, 1, 1]])
+def test_multiindex_text_registered_raises(registered):
+    with pytest.raises(TypeError):
+        dpf.format_df_to_multiindex(sheet(NON_DESCRIPTIVE, registered), descriptive_labels=False)
+
+
+def test_index_to_av_format():
+    idx = pd.MultiIndex.from_tuples([('PCT 1101', 'Election Day'), ('PCT 1101', 'Vote by Mail'), ('PCT 1102', 'ABSENTEE'),
+                                     ('PCT 1102', 'VBM'), ('PCT 1103', 'Polling Place')])
+    df = dpf.index_to_av_format(pd.DataFrame({'YES':range(5)}, index=idx))
+    assert df.index.names==['precinct','type']
+    assert df.index.tolist()==[('PCT 1101', 'V'), ('PCT 1101', 'A'), ('PCT 1102', 'A'), ('PCT 1102', 'A'), ('PCT 1103', 'V')]
+
+
+def test_index_to_av_format_nan_type_raises():
+    idx = pd.MultiIndex.from_tuples([('PCT 1101', 'Election Day'), ('PCT 1103', np.nan)])
+    with pytest.raises(TypeError):
+        dpf.index_to_av_format(pd.DataFrame({'YES':range(2)}, index=idx))
+
+
+def split(labels):
+    return(dpf.split_prec_rows(pd.DataFrame({'YES':range(len(labels))}, index=pd.Index(labels, dtype=object))))
+
+
+@pytest.mark.parametrize('labels, index, values, split_n', [
+    (['1101', '1102/1103', '1104'], ['1101', '1104', '1102', '1103'], [0, 2, 1, 1], [1, 1, 2, 2]),
+    # a split precinct that has its own row keeps that row's place, with the split row's values
+    (['1101', '1102/1103', '1104', '1104/1105'], ['1101', '1104', '1102', '1103', '1105'], [0, 3, 1, 1, 3], [1, 2, 2, 2, 2]),
+    (['1102/1103', '1102', '1104'], ['1102', '1104', '1103'], [0, 2, 0], [2, 1, 2]),
+    (['1101/1102', '1102/1103', '1101'], ['1101', '1102', '1103'], [0, 1, 1], [2, 2, 2]),
+    (['PCT 1101', 'Not a precinct', 'PCT 1102/1103'], ['PCT 1101', 'Not a precinct', 'PCT 1102', '1103'], [0, 1, 2, 2], [1, 1, 2, 2]),
+    ([], [], [], []),
+])
+def test_split_prec_rows(labels, index, values, split_n):
+    df = split(labels)
+    assert df.index.tolist()==index
+    assert df['YES'].tolist()==values
+    assert df['split_n'].tolist()==split_n
+
+
+@pytest.mark.parametrize('labels', [[1101, 1102], ['1101', np.nan]])
+def test_split_prec_rows_non_string_labels_raise(labels):
+    with pytest.raises(TypeError):
+        split(labels)
+
+
+def test_format_precincts():
+    labels = ['PCT 1101', 'PCT 1102/1103', 'PCT 9101 MAIL', 'MAIL 9102', 'Pct 1104', '1105', '1103', 'Not a precinct']
+    df = dpf.format_precincts(pd.DataFrame({'YES':range(len(labels))}, index=pd.Index(labels, dtype=object)))
+    # the same precincts, order and values as the original string IDs, without the rows that aren't precincts
+    assert df.index.name=='prec_id'
+    assert df.index.dtype==np.int64
+    assert df.index.tolist()==[1101, 9101, 9102, 1104, 1105, 1103, 1102]
+    assert df['YES'].tolist()==[0, 2, 3, 4, 5, 1, 1]
+    assert df['mail_only'].tolist()==[False, True, True, False, False, False, False]
+    assert df['split_n'].tolist()==[1, 1, 1, 1, 1, 2, 2]
+
+
+@pytest.mark.parametrize('label, expected', [
+    ('PCT 1101', ((1101,), False)),
+    ('1101/1102', ((1101, 1102), False)),
+    ('PCT 1101 / 1102', ((1101, 1102), False)),
+    ('PCT 9101 MAIL', ((9101,), True)),
+    ('Mail-9102', ((9102,), True)),
+    ('pct. 2201-mail', ((2201,), True)),
+    ('Not a precinct', ((), False)),
+    ('Totals', ((), False)),
+])
+def test_parse_precinct_label(label, expected):
+    assert dpf.parse_precinct_label(label)==expected
+
+
+def test_format_precincts_nan_label_raises():
+    df = pd.DataFrame({'YES':range(2)}, index=pd.Index(['PCT 1101', np.nan], dtype=object))
+    with pytest.raises(TypeError):
+        dpf.format_precincts(df)
@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+gpd = pytest.importorskip('geopandas')
+shapely = pytest.importorskip('shapely')
+from shapely.geometry import Polygon, box
+
+import spatial_processing_functions as spf
+
+
+CRS = 'epsg:26910'
+
+# overlay warns about the pairs that only touch, which it drops
+pytestmark = pytest.mark.filterwarnings('ignore:`keep_geom_type=True`:UserWarning')
+
+
+@pytest.fixture
+def boundaries():
+    """Precincts and block groups that touch, are nested in each other, and have an invalid (bow-tie) precinct."""
+    pre_df = gpd.GeoDataFrame({'precname':['1101','1102','1103','1104']}, geometry=[
+        box(0, 0, 100, 100),
+        box(100, 0, 200, 100),  # touches 1101
+        Polygon([(200, 0), (300, 100), (300, 0), (200, 100)]),  # bow-tie, invalid
+        box(0, 100, 300, 200),
+    ], crs=CRS)
+    pre_df['area_m'] = pre_df.geometry.area
+    bg_df = gpd.GeoDataFrame({'geoid':['060750000001','060750000002','060750000003','060750000004','060750000005']}, geometry=[
+        box(0, 0, 150, 50),  # crosses 1101 and 1102
+        box(150, 0, 300, 100),  # crosses 1102 and the bow-tie
+        box(10, 110, 40, 140),  # inside 1104
+        box(-50, 50, 0, 100),  # only touches 1101
+        box(-100, -100, 400, 400),  # every precinct is inside it
+    ], crs=CRS)
+    bg_df['area_m'] = bg_df.geometry.area
+    assert not pre_df.geometry.is_valid.all()
+    return(pre_df, bg_df)
+
+
+@pytest.fixture
+def grid():
+    """A grid of precincts and a rotated grid of block groups, so most pairs cross."""
+    pre_df = gpd.GeoDataFrame({'precname':['{:04d}'.format(1000+i) for i in range(64)]},
+                              geometry=[box(i*50, j*50, (i+1)*50, (j+1)*50) for i in range(8) for j in range(8)], crs=CRS)
+    pre_df['area_m'] = pre_df.geometry.area
+    cells = [shapely.affinity.rotate(box(i*70-100, j*70-100, (i+1)*70-100, (j+1)*70-100), 20, origin=(200, 200))
+             for i in range(9) for j in range(9)]
+    bg_df = gpd.GeoDataFrame({'geoid':['06075{:07d}'.format(i) for i in range(len(cells))]}, geometry=cells, crs=CRS)
+    bg_df['area_m'] = bg_df.geometry.area
+    return(pre_df, bg_df)
+
+
+def crosswalk(pre_df, bg_df, engine, **kwargs):
+    xwalk = spf.make_crosswalk(spf.merge_precinct_bg(pre_df, bg_df, 'test', engine=engine, **kwargs))
+    return(xwalk.groupby(['precname','geoid'])[['intersect_area','area_m']].sum().sort_index())
+
+
+def assert_same_crosswalk(a, b):
+    assert list(a.index)==list(b.index)
+    assert np.allclose(a['intersect_area'], b['intersect_area'])
+    assert np.allclose(a['area_m'], b['area_m'])
+
+
+@pytest.mark.parametrize('data', ['boundaries', 'grid'])
+def test_strtree_matches_overlay(data, request):
+    pre_df, bg_df = request.getfixturevalue(data)
+    assert_same_crosswalk(crosswalk(pre_df, bg_df, 'overlay'), crosswalk(pre_df, bg_df, 'strtree'))
+
+
+@pytest.mark.parametrize('data', ['boundaries', 'grid'])
+def test_parallel_matches_overlay(data, request):
+    pre_df, bg_df = request.getfixturevalue(data)
+    assert_same_crosswalk(crosswalk(pre_df, bg_df, 'overlay'), crosswalk(pre_df, bg_df, 'parallel', n_workers=2))
+
+
+def test_parallel_tiles_match_strtree(grid):
+    pre_df, bg_df = grid
+    tiled = spf.parallel_intersect_areas({'a':grid, 'b':(pre_df.iloc[::2], bg_df)}, n_workers=2, tiles_per_worker=5)
+    for key, (p, b) in [('a', grid), ('b', (pre_df.iloc[::2], bg_df))]:
+        expected = spf.intersect_areas(p, b)
+        pd.testing.assert_frame_equal(tiled[key].sort_values(['precname','geoid']).reset_index(drop=True),
+                                      expected.sort_values(['precname','geoid']).reset_index(drop=True),
+                                      check_exact=False)
+
+
+def test_touching_pairs_are_left_out(boundaries):
+    xwalk = crosswalk(*boundaries, 'strtree')
+    assert ('1101', '060750000004') not in xwalk.index
+    assert (xwalk['intersect_area']>0).all()
+
+
+def test_interpolate_vars_matches_groupby(grid):
+    pre_df, bg_df = grid
+    xwalk = spf.make_crosswalk(spf.merge_precinct_bg(pre_df, bg_df, 'test', engine='strtree'))
+    rng = np.random.default_rng(0)
+    var_list = ['pop', 'med_inc']
+    # one block group isn't in the census data, and one value is missing
+    census = pd.DataFrame({'geoid':bg_df['geoid'].iloc[1:].to_numpy(), 'pop':rng.random(len(bg_df)-1)*1000,
+                           'med_inc':rng.random(len(bg_df)-1)*1e5})
+    census.loc[3, 'med_inc'] = np.nan
+
+    merged = pd.merge(xwalk, census, on='geoid')
+    expected = spf.agg_vars_by_prec(spf.calc_variables(merged, var_list))
+    got = spf.interpolate_vars(spf.make_weight_matrix(xwalk), census, var_list)
+
+    assert list(got.index)==list(expected.index)
+    for col in [v+'_wgt' for v in var_list]+['prop_area']:
+        assert np.allclose(got[col], expected[col]), col
@@ -0,0 +1,151 @@
+"""validation_functions.py
+
+This module checks the combined election and census data (the output of combine_dataframes) for problems.
+
+All the checks run at once, vectorized over the whole long-format table, so this is cheap enough to run every time
+the data is processed:
+
+    report = vf.validate(all_data)
+    print(report.summary)
+
+Row checks (one flag per row):
+    yes_no_gt_voted: YES+NO is more than the ballots received
+    registered_lt_voted: fewer registered voters than ballots received
+    turnout_gt_1: turnout over 1
+    prop_area: area weights that don't add up to about 1, i.e. the block groups don't cover the precinct (if there's 
+        a prop_area column; it's the area weights' sum for both interpolation methods, see census_by_precinct)
+    missing_<col>: missing census value, e.g. missing_med_inc_wgt
+    duplicate_precinct: more than one row for a precinct in the same election
+Totals by election (like verify_vote_totals) are in report.totals, with the number of split precinct rows
+(which have copied vote counts, see split_prec_rows).
+"""
+
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+import instrument_functions as inst
+
+
+ValidationReport = namedtuple('ValidationReport', ['summary','failures','totals'])
+""" Result of validate:
+    summary (DataFrame): by check: description, number of rows checked and number that failed, and whether it passed
+    failures (DataFrame): one row per failed check and data row: check, row (index in the data), the election and
+        precinct, and the value that failed
+    totals (DataFrame): by election: YES, NO, voted and registered totals, yes_pct, precincts and split rows
+"""
+
+check_descriptions = {
+    'yes_no_gt_voted': 'YES+NO more than ballots received',
+    'registered_lt_voted': 'fewer registered voters than ballots received',
+    'turnout_gt_1': 'turnout over 1',
+    'prop_area': 'area weights outside {} to {}',
+    'missing': 'missing {}',
+    'duplicate_precinct': 'more than one row for a precinct in an election',
+}
+""" Description of each check """
+
+
+def find_column(df, col):
+    """Name of a column in the data, also looking for it without '_wgt' (after rename_columns). None if it's not there."""
+    if col in df.columns:
+        return(col)
+    if col.endswith('_wgt') and col[:-4] in df.columns:
+        return(col[:-4])
+    return(None)
+
+
+def row_checks(df, prop_area_range=(.97, 1.1), required_cols=['med_inc_wgt'], group_col='yr_prop', prec_col='precname'):
+    """Flags for each row check, as one boolean array (rows x checks), with the value tested for each check.
+    Checks that need columns the data doesn't have are left out.
+    Returns:
+        list: names of the checks
+        list: descriptions of the checks
+        array: boolean, True where a row fails a check
+        array: the values that were tested (float, rows x checks)
+    """
+    names, descriptions, flags, values = [], [], [], []
+
+    def add(name, description, flag, value):
+        names.append(name)
+        descriptions.append(description)
+        flags.append(np.asarray(flag, dtype=bool))
+        values.append(np.asarray(value, dtype=float))
+
+    def num(col):
+        return(pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=float))
+
+    if {'YES','NO','voted'}.issubset(df.columns):
+        yes_no = num('YES')+num('NO')
+        add('yes_no_gt_voted', check_descriptions['yes_no_gt_voted'], yes_no>num('voted'), yes_no)
+    if {'registered','voted'}.issubset(df.columns):
+        registered = num('registered')
+        add('registered_lt_voted', check_descriptions['registered_lt_voted'], registered<num('voted'), registered)
+    if 'turnout' in df.columns:
+        turnout = num('turnout')
+        add('turnout_gt_1', check_descriptions['turnout_gt_1'], turnout>1, turnout)
+    if 'prop_area' in df.columns:
+        low, high = prop_area_range
+        prop_area = num('prop_area')
+        add('prop_area', check_descriptions['prop_area'].format(low, high), (prop_area<low)|(prop_area>high), prop_area)
+    for col in required_cols:
+        found = find_column(df, col)
+        if found is not None:
+            add('missing_'+col, check_descriptions['missing'].format(found), df[found].isna().to_numpy(), np.nan)
+    if group_col in df.columns and prec_col in df.columns:
+        dup = df.duplicated([group_col, prec_col], keep=False).to_numpy()
+        add('duplicate_precinct', check_descriptions['duplicate_precinct'], dup, num('split_n') if 'split_n' in df.columns else np.nan)
+
+    n = len(df)
+    flags = np.column_stack(flags) if flags else np.zeros((n, 0), dtype=bool)
+    values = np.column_stack([np.broadcast_to(v, n) for v in values]) if values else np.zeros((n, 0))
+    return(names, descriptions, flags, values)
+
+
+def election_totals(df, group_col='yr_prop', split_col='split_n'):
+    """Vote totals by election, like verify_vote_totals but for the combined data.
+    Split precinct rows are counted once for each precinct, so the totals are a bit higher than the official ones.
+    """
+    cols = [c for c in ['YES','NO','voted','registered'] if c in df.columns]
+    grouped = df.groupby(group_col, observed=True)
+    totals = grouped[cols].sum()
+    if {'YES','NO'}.issubset(cols):
+        totals['yes_pct'] = totals['YES']/(totals['YES']+totals['NO'])
+    totals['precincts'] = grouped.size()
+    if split_col in df.columns:
+        totals['split_rows'] = (df[split_col]>1).groupby(df[group_col], observed=True).sum()
+    return(totals)
+
+
+def validate(df, prop_area_range=(.97, 1.1), required_cols=['med_inc_wgt'], group_col='yr_prop', prec_col='precname'):
+    """Run all the checks on the combined data.
+    Args:
+        df (DataFrame): combined data, from combine_dataframes (before or after rename_columns)
+        prop_area_range (tuple): lowest and highest sum of area weights that's OK
+        required_cols (list): census columns that shouldn't be missing
+        group_col (str): column with the election (date and proposition)
+        prec_col (str): column with the precinct name
+    Returns:
+        ValidationReport: summary, failures and totals
+    """
+    names, descriptions, flags, values = row_checks(df, prop_area_range, required_cols, group_col, prec_col)
+
+    n_failed = flags.sum(axis=0)
+    summary = pd.DataFrame({'description':descriptions, 'rows':len(df), 'failed':n_failed, 'passed':n_failed==0},
+                           index=pd.Index(names, name='check'))
+
+    rows, checks = np.nonzero(flags)
+    failures = pd.DataFrame({'check':np.asarray(names, dtype=object)[checks] if len(names) else np.array([], dtype=object),
+                             'row':df.index.to_numpy()[rows]})
+    for col in [group_col, prec_col]:
+        if col in df.columns:
+            failures[col] = df[col].to_numpy()[rows]
+    failures['value'] = values[rows, checks]
+
+    totals = election_totals(df, group_col) if group_col in df.columns else pd.DataFrame()
+    failed = summary[~summary.passed]
+    inst.report('validate',
+        'all {} checks passed'.format(len(summary)) if len(failed)==0 else 'failed checks:\n{}'.format(failed[['description','failed']].to_string()),
+        rows=len(df), checks=len(summary), failed=dict(zip(failed.index, failed.failed.tolist())))
+    return(ValidationReport(summary, failures, totals))